@@ -0,0 +1,115 @@
+#!/usr/bin/python
+
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+'''
+Check touchstone files against a limit mask (see nanotiny/limits.py for the JSON format),
+e.g. return loss and insertion loss of a filter in production.
+Print the margin of each mask segment for each file and a summary of all files.
+'''
+
+import argparse
+import csv
+import os
+import sys
+
+from nanotiny.batch import find_files, map_files
+from nanotiny.limits import LimitMask, passed
+from nanotiny.touchstone import load_network
+
+
+mask = None # the mask of this (worker) process, the compiled grids are kept for the following files
+
+
+def init_worker( mask_file ):
+    global mask
+    mask = LimitMask.load( mask_file )
+
+
+# return ( points, margins ) or ( None, error message ), runs in the worker processes
+def check_file( snp ):
+    try:
+        nw = load_network( snp )
+    except ( OSError, ValueError ) as error: # e.g. removed since the files were listed
+        return None, str( error )
+    try:
+        return nw.f.size, mask.evaluate( nw )
+    except ValueError as error:
+        return None, f'{snp}: {error}'
+
+
+def format_margin( margin ):
+    return '-' if margin != margin else f'{margin:.2f}' # NaN: no point of the sweep inside the segment
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser( description='Check touchstone files against a limit mask, print the margins in dB' )
+    ap.add_argument( 'mask',
+        help = 'limit mask (JSON)' )
+    ap.add_argument( 'files', nargs = '*', default = [ '.' ],
+        help = 'touchstone files, glob patterns or directories, default = current directory' )
+    ap.add_argument( '-r', '--recursive', action = 'store_true',
+        help = 'search the directories and "**" patterns recursively' )
+    ap.add_argument( '-j', '--jobs', type = int, default = os.cpu_count(),
+        help = f'check the files in JOBS processes, default = {os.cpu_count()} (number of CPUs)' )
+    ap.add_argument( '-f', '--failed', action = 'store_true',
+        help = 'list only the failed files' )
+    ap.add_argument( '--csv', action = 'store_true',
+        help = 'write the results as CSV with margin and frequency of the worst point per segment' )
+
+    options = ap.parse_intermixed_args()
+
+    try:
+        init_worker( options.mask ) # check the mask before starting the workers
+    except ( OSError, ValueError ) as error:
+        print( error )
+        sys.exit( 2 )
+    names = [ segment.name for segment in mask.segments ]
+
+    files = find_files( options.files, options.recursive )
+    if not files:
+        print( 'no touchstone files found' )
+        sys.exit( 2 )
+
+    width = max( len( snp ) for snp in files )
+    if options.csv:
+        writer = csv.writer( sys.stdout )
+        writer.writerow( [ 'file', 'result', 'points' ] + [ f'{name} {column}' for name in names for column in ( 'margin', 'frequency' ) ] )
+    else:
+        print( f'{"file":{width}} result ' + ' '.join( f'{name:>10}' for name in names ) )
+
+    worst = [ ( float( 'inf' ), None, None ) ] * len( names ) # margin, frequency, file per segment
+    failed = [ 0 ] * len( names )
+    results = { 'PASS': 0, 'FAIL': 0, 'ERROR': 0 }
+    # the files of one chunk are checked by the same worker, sharing the compiled grid
+    checks = map_files( check_file, files, options.jobs, init_worker, ( options.mask, ) )
+    for snp, ( points, margins ) in zip( files, checks ):
+        if points is None: # error message
+            results[ 'ERROR' ] += 1
+            print( margins, file=sys.stderr )
+            if options.csv:
+                writer.writerow( [ snp, 'ERROR', '' ] )
+            continue
+        result = 'PASS' if passed( margins ) else 'FAIL'
+        results[ result ] += 1
+        for n, ( margin, frequency ) in enumerate( margins ):
+            if not margin >= 0:
+                failed[ n ] += 1
+            if margin < worst[ n ][ 0 ]:
+                worst[ n ] = ( margin, frequency, snp )
+        if options.failed and result == 'PASS':
+            continue
+        if options.csv:
+            writer.writerow( [ snp, result, points ] + [ value for margin in margins for value in margin ] )
+        else:
+            print( f'{snp:{width}} {result:6} ' + ' '.join( f'{format_margin( margin ):>10}' for margin, _ in margins ) )
+
+    if not options.csv:
+        print()
+        print( f'{mask.name}: {results[ "PASS" ]} passed, {results[ "FAIL" ]} failed, {results[ "ERROR" ]} errors' )
+        for name, n, ( margin, frequency, snp ) in zip( names, failed, worst ):
+            if snp is None:
+                print( f'  {name}: no file with points in the segment, {n} failed' )
+            else:
+                print( f'  {name}: worst margin {margin:.2f} dB at {frequency:.0f} Hz in {snp}, {n} failed' )
+    sys.exit( 0 if results[ 'FAIL' ] + results[ 'ERROR' ] == 0 else 1 )
@@ -2,43 +2,193 @@
 
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import hashlib
 import os
+import sqlite3
+from datetime import datetime
 
 import argparse as ap
 from glob import iglob
 
-from skrf import Network
+import numpy as np
 
+from nanotiny.batch import map_files
+from nanotiny.history import SweepHistory
+from nanotiny.touchstone import load_network
 
 
-def check_nw( nw ):
 
-    found, frw, val = 0, 0, 0
+CACHE_VERSION = 1 # increment if the check or the stored results change
 
-    for f, s11 in zip( nw.f, nw.s[:,0,0] ): # frequency and S11
-        a = abs( s11 )
-        if a > 1:
-            found += 1
-            if a > abs( val ):
-                frq = f
-                val = s11
-    if found:
-        return ( found, frq, val )
 
 
+# cache file in the user cache dir
+def default_cache():
+    cache_dir = os.environ.get( 'XDG_CACHE_HOME' ) or os.path.join( os.path.expanduser( '~' ), '.cache' )
+    return os.path.join( cache_dir, 'nanotiny', 'check_s11.sqlite' )
+
+
+
+class ResultCache:
+    '''
+    Check results of touchstone files in a sqlite database, a result is valid as long as
+    size and modification time (and the content hash, if used) of the file are unchanged.
+    The database uses WAL mode and waits for locks, so concurrent runs can share the cache.
+    '''
+
+    def __init__( self, filename ):
+        os.makedirs( os.path.dirname( os.path.abspath( filename ) ), exist_ok=True )
+        self.db = sqlite3.connect( filename, timeout=60 )
+        self.db.execute( 'PRAGMA journal_mode=WAL' )
+        with self.db:
+            if self.db.execute( 'PRAGMA user_version' ).fetchone()[ 0 ] != CACHE_VERSION:
+                self.db.execute( 'DROP TABLE IF EXISTS results' )
+                self.db.execute( f'PRAGMA user_version = {CACHE_VERSION}' )
+            self.db.execute( 'CREATE TABLE IF NOT EXISTS results ( path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, '
+                'digest BLOB, points INTEGER, found INTEGER, frequency REAL, real REAL, imag REAL, error TEXT )' )
+        self.pending = [] # results not yet written
+
+
+    # remove all results
+    def clear( self ):
+        with self.db:
+            self.db.execute( 'DELETE FROM results' )
+
+
+    # cached ( points, check ) like check_file() or None if the file was changed since
+    # key: ( size, mtime, digest ) of the file, digest None: do not compare the content hash
+    def lookup( self, path, key ):
+        row = self.db.execute( 'SELECT size, mtime, digest, points, found, frequency, real, imag, error '
+            'FROM results WHERE path = ?', ( path, ) ).fetchone()
+        if row is None:
+            return None
+        size, mtime, digest, points, found, frequency, real, imag, error = row
+        if ( size, mtime ) != key[ :2 ] or key[ 2 ] is not None and digest != key[ 2 ]:
+            return None
+        if error is not None:
+            return None, error
+        return points, ( found, frequency, complex( real, imag ) ) if found else None
+
+
+    def store( self, path, key, points, check ):
+        if points is None: # error message
+            result = ( None, None, None, None, None, check )
+        elif check:
+            found, frequency, s = check
+            result = ( points, found, float( frequency ), s.real, s.imag, None )
+        else:
+            result = ( points, 0, None, None, None, None )
+        self.pending.append( ( path, ) + key + result )
+        if len( self.pending ) >= 1000:
+            self.flush()
+
+
+    def flush( self ):
+        if self.pending:
+            with self.db: # one transaction
+                self.db.executemany( 'INSERT OR REPLACE INTO results VALUES ( ?, ?, ?, ?, ?, ?, ?, ?, ?, ? )', self.pending )
+            self.pending = []
 
-def check_files( pattern, verbose ):
-    for snp in [ fff for fff in iglob( pattern, recursive=True ) if os.path.isfile( fff ) ]:
-        nw = Network( snp )
-        check = check_nw( nw )
-        if check:
-            n, f, s = check
-            if verbose:
-                print( f'{snp}: {n} of {nw.f.size} points with |S| > 1, worst at {f} Hz: |{s}| = {abs(s)}' )
-            else:
-                print( snp )
-        elif verbose:
-            print( f'{snp}: ok' )
+
+    def close( self ):
+        self.flush()
+        self.db.close()
+
+
+
+# cache key of a file ( size, mtime, content hash or None )
+def file_key( snp, use_hash=False ):
+    stat = os.stat( snp )
+    digest = None
+    if use_hash:
+        with open( snp, 'rb' ) as infile:
+            digest = hashlib.blake2b( infile.read(), digest_size=16 ).digest()
+    return stat.st_size, stat.st_mtime_ns, digest
+
+
+
+def check_nw( nw ):
+    return check_s11( nw.f, nw.s[:,0,0] )
+
+
+
+# return ( number of points with |S11| > 1, frequency and S11 of the 1st point with the max. |S11| ) or None
+def check_s11( frequencies, s11s ):
+    a = np.abs( s11s )
+    over = a > 1 # NaN is never over
+    found = int( np.count_nonzero( over ) )
+    if found:
+        worst = int( np.argmax( np.where( over, a, 0 ) ) )
+        return ( found, frequencies[ worst ], s11s[ worst ] )
+
+
+
+# check one touchstone file, return ( points, check_nw() result ) or ( None, error message )
+# runs in the worker processes of check_files()
+def check_file( snp ):
+    try:
+        nw = load_network( snp )
+    except ( OSError, ValueError ) as error: # e.g. removed since the files were listed
+        return None, str( error )
+    return nw.f.size, check_nw( nw )
+
+
+
+def report( snp, points, check, verbose ):
+    if points is None: # error
+        print( check )
+    elif check:
+        n, f, s = check
+        if verbose:
+            print( f'{snp}: {n} of {points} points with |S| > 1, worst at {f} Hz: |{s}| = {abs(s)}' )
+        else:
+            print( snp )
+    elif verbose:
+        print( f'{snp}: ok' )
+
+
+
+# check the files in jobs processes, the results are reported in the order of the files as soon as available
+# cache: ResultCache, only new or changed files are read, use_hash: compare also the content of the files
+def check_files( pattern, verbose, jobs=1, cache=None, use_hash=False ):
+    files = [ fff for fff in iglob( pattern, recursive=True ) if os.path.isfile( fff ) ]
+    cached, keys = {}, {}
+    if cache:
+        for snp in files:
+            try:
+                keys[ snp ] = file_key( snp, use_hash )
+            except OSError: # removed in the meantime, report the error of the check
+                continue
+            result = cache.lookup( os.path.abspath( snp ), keys[ snp ] )
+            if result:
+                cached[ snp ] = result
+    todo = [ snp for snp in files if snp not in cached ]
+    results = map_files( check_file, todo, jobs )
+    for snp in files:
+        if snp in cached:
+            points, check = cached[ snp ]
+        else:
+            points, check = next( results )
+            if cache and snp in keys:
+                cache.store( os.path.abspath( snp ), keys[ snp ], points, check )
+        report( snp, points, check, verbose )
+
+
+
+# check each sweep of a sweep history file, the sweeps are read one by one from the memory map
+def check_history( filename, verbose ):
+    with SweepHistory( filename ) as history:
+        for n in range( len( history ) ):
+            check = check_s11( history.frequencies, history.sweep( n )[ :, 0 ] )
+            name = f'{filename}[{n}] {datetime.fromtimestamp( history[ n ][ "time" ] )}'
+            if check:
+                found, f, s = check
+                if verbose:
+                    print( f'{name}: {found} of {history.points} points with |S| > 1, worst at {f} Hz: |{s}| = {abs(s)}' )
+                else:
+                    print( name )
+            elif verbose:
+                print( f'{name}: ok' )
 
 
 
@@ -49,15 +199,43 @@ if __name__ == '__main__':
                         help='check only the touchstone file INFILE' )
     group.add_argument( '-r', '--recursive', action='store_true',
                         help='check also all touchstone files in subdirectories' );
+    group.add_argument( '-H', '--history',
+                        help='check all sweeps of the sweep history file HISTORY' );
     parser.add_argument( '-v', '--verbose', action='store_true',
                         help='display all checked files, more mismatch details' );
+    parser.add_argument( '-j', '--jobs', type=int, default=os.cpu_count(),
+                        help=f'check the files in JOBS processes, default = {os.cpu_count()} (number of CPUs)' );
+    parser.add_argument( '-c', '--cache', nargs='?', const=default_cache(), metavar='CACHE',
+                        help=f'keep the results in CACHE and check only new or changed files, default = {default_cache()}' );
+    parser.add_argument( '--hash', action='store_true',
+                        help='with --cache: detect changed files also by the content hash, not only by size and time' );
+    parser.add_argument( '--clear-cache', action='store_true',
+                        help='with --cache: forget all cached results before checking' );
 
     args = parser.parse_args()
-
-if args.infile:
-    check_files( args.infile.name, args.verbose )
-elif args.recursive:
-    check_files( '**/*.s?p', args.verbose )
-else:
-    check_files( '*.s?p', args.verbose )
+    jobs = max( 1, args.jobs or 1 )
+    if ( args.hash or args.clear_cache ) and not args.cache:
+        parser.error( '--hash and --clear-cache need --cache' )
+
+    cache = None
+    if args.cache:
+        try:
+            cache = ResultCache( args.cache )
+            if args.clear_cache:
+                cache.clear()
+        except ( OSError, sqlite3.Error ) as error:
+            parser.error( f'cache {args.cache}: {error}' )
+
+    try:
+        if args.history:
+            check_history( args.history, args.verbose )
+        elif args.infile:
+            check_files( args.infile.name, args.verbose, 1, cache, args.hash )
+        elif args.recursive:
+            check_files( '**/*.s?p', args.verbose, jobs, cache, args.hash )
+        else:
+            check_files( '*.s?p', args.verbose, jobs, cache, args.hash )
+    finally:
+        if cache: # keep the results checked so far, also after ^C
+            cache.close()
 
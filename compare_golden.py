@@ -0,0 +1,140 @@
+#!/usr/bin/python
+
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+'''
+Compare touchstone files with a golden reference file, e.g. the sweeps of a production lot
+with a known good device. Print the max and RMS deviation in magnitude and phase of each file,
+ranked with the largest deviation first, optionally check the deviations against tolerances.
+'''
+
+import argparse
+import csv
+import os
+import sys
+
+import numpy as np
+
+from nanotiny.batch import find_files, map_files
+from nanotiny.golden import GoldenReference
+from nanotiny.touchstone import load_network
+
+
+SORT_COLUMNS = { 'magnitude': 0, 'rms': 1, 'phase': 2 } # column of the deviations ( max dB, RMS dB, max deg, RMS deg )
+
+golden = None # the reference of this (worker) process, the resampled grids are kept for the following files
+
+
+def init_worker( golden_file, parameters ):
+    global golden
+    reference = load_network( golden_file )
+    if not parameters: # S11 and S21 if the reference has them, the parameters measured by NanoVNA
+        parameters = [ 'S11', 'S21' ] if reference.s.shape[ 1 ] > 1 else [ 'S11' ]
+    golden = GoldenReference( reference, parameters )
+
+
+# return ( points, deviations ) or ( None, error message ), runs in the worker processes
+def compare_file( snp ):
+    try:
+        nw = load_network( snp )
+    except ( OSError, ValueError ) as error: # e.g. removed since the files were listed
+        return None, str( error )
+    try:
+        return golden.compare( nw )
+    except ValueError as error:
+        return None, f'{snp}: {error}'
+
+
+# largest deviation in column of all parameters, NaN (e.g. from NaN in the data) is ranked first
+def largest( deviations, column ):
+    values = np.array( [ deviation[ column ] for deviation in deviations ] )
+    return float( 'inf' ) if np.isnan( values ).any() else float( np.max( values ) )
+
+
+# all max deviations within the tolerances in dB and degree, None = no tolerance
+def within( deviations, magnitude, phase ):
+    return all( ( magnitude is None or max_db <= magnitude ) and ( phase is None or max_deg <= phase )
+                for max_db, _, max_deg, _ in deviations )
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser( description='Compare touchstone files with a golden reference, rank the largest deviations first' )
+    ap.add_argument( 'golden',
+        help = 'golden reference touchstone file' )
+    ap.add_argument( 'files', nargs = '*', default = [ '.' ],
+        help = 'touchstone files, glob patterns or directories, default = current directory' )
+    ap.add_argument( '-r', '--recursive', action = 'store_true',
+        help = 'search the directories and "**" patterns recursively' )
+    ap.add_argument( '-j', '--jobs', type = int, default = os.cpu_count(),
+        help = f'compare the files in JOBS processes, default = {os.cpu_count()} (number of CPUs)' )
+    ap.add_argument( '-p', '--parameter', action = 'append', metavar = 'SIJ',
+        help = 'compare the S-parameter SIJ, repeat for more, default = S11 and S21 (S11 only for a 1-port reference)' )
+    ap.add_argument( '-m', '--magnitude', type = float,
+        help = 'tolerance of the magnitude in dB, files with a larger deviation fail' )
+    ap.add_argument( '-a', '--phase', type = float,
+        help = 'tolerance of the phase in degree, files with a larger deviation fail' )
+    ap.add_argument( '-s', '--sort', choices = ( 'magnitude', 'phase', 'rms' ), default = 'magnitude',
+        help = 'rank by max magnitude, max phase or RMS magnitude deviation, default = magnitude' )
+    ap.add_argument( '-n', '--top', type = int,
+        help = 'list only the TOP files with the largest deviation' )
+    ap.add_argument( '--csv', action = 'store_true',
+        help = 'write the ranking as CSV' )
+
+    options = ap.parse_intermixed_args()
+
+    try:
+        init_worker( options.golden, options.parameter ) # check the reference before starting the workers
+    except ( OSError, ValueError ) as error:
+        print( error )
+        sys.exit( 2 )
+    parameters = golden.parameters
+    golden_file = os.path.abspath( options.golden )
+
+    files = [ snp for snp in find_files( options.files, options.recursive ) if os.path.abspath( snp ) != golden_file ]
+    if not files:
+        print( 'no touchstone files found' )
+        sys.exit( 2 )
+
+    compared = [] # ( snp, points, deviations )
+    errors = 0
+    # the files of one chunk are compared by the same worker, sharing the resampled grid
+    comparisons = map_files( compare_file, files, options.jobs, init_worker, ( options.golden, parameters ) )
+    for snp, ( points, deviations ) in zip( files, comparisons ):
+        if points is None: # error message
+            errors += 1
+            print( deviations, file=sys.stderr )
+        else:
+            compared.append( ( snp, points, deviations ) )
+
+    # rank by the largest deviation of all parameters
+    column = SORT_COLUMNS[ options.sort ]
+    compared.sort( key=lambda result: largest( result[ 2 ], column ), reverse=True )
+
+    check = options.magnitude is not None or options.phase is not None
+    failed = sum( not within( deviations, options.magnitude, options.phase ) for _, _, deviations in compared )
+
+    ranking = compared[ :options.top ] if options.top is not None else compared
+    if options.csv:
+        writer = csv.writer( sys.stdout )
+        writer.writerow( [ 'file', 'result', 'points' ]
+            + [ f'{parameter} {name}' for parameter in parameters for name in ( 'max dB', 'rms dB', 'max deg', 'rms deg' ) ] )
+        for snp, points, deviations in ranking:
+            result = ( 'PASS' if within( deviations, options.magnitude, options.phase ) else 'FAIL' ) if check else ''
+            writer.writerow( [ snp, result, points ] + [ value for deviation in deviations for value in deviation ] )
+    else:
+        width = max( [ len( 'file' ) ] + [ len( snp ) for snp, _, _ in ranking ] )
+        result_header = 'result ' if check else ''
+        print( f'{"":{width}} {" " * len( result_header )}'
+            + ' '.join( f'{parameter:^31}' for parameter in parameters ) )
+        print( f'{"file":{width}} {result_header}'
+            + ' '.join( f'{"max dB":>7} {"rms dB":>7} {"max deg":>7} {"rms deg":>7}' for _ in parameters ) )
+        for snp, points, deviations in ranking:
+            result = f'{"PASS" if within( deviations, options.magnitude, options.phase ) else "FAIL":6} ' if check else ''
+            print( f'{snp:{width}} {result}'
+                + ' '.join( ' '.join( f'{value:7.2f}' for value in deviation ) for deviation in deviations ) )
+        print()
+        summary = f'{golden.name}: {len( compared )} compared'
+        if check:
+            summary += f', {len( compared ) - failed} passed, {failed} failed'
+        print( f'{summary}, {errors} errors' )
+    sys.exit( 0 if failed + errors == 0 else 1 )
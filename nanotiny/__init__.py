@@ -0,0 +1,17 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+'''
+Library for the communication with NanoVNA and tinySA via USB serial.
+Use it in own scripts to keep one connection to the device open
+for many measurements instead of calling the command line tools, e.g.:
+
+    from nanotiny import Session
+
+    with Session() as nanovna:
+        start, stop, points = nanovna.sweep()
+        scan = nanovna.scan( start, stop, points, outmask=7 )
+        print( scan[ 'freq' ], scan[ 'S11r' ], scan[ 'S11i' ] )
+'''
+
+from .device import VID, PID, getdevice, getdevices, finddevice, detect_device, device_id, device_filename
+from .session import Session
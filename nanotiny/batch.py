@@ -0,0 +1,73 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+'''
+Helpers for the tools that process many touchstone files, e.g. a production lot:
+find_files() expands the file arguments, map_files() runs a function for each file in worker processes,
+GridCache keeps values computed from a frequency grid for the following files with the same grid.
+'''
+
+import collections
+from concurrent.futures import ProcessPoolExecutor
+import glob
+import hashlib
+import os
+
+import numpy as np
+
+
+MAX_CHUNK = 64 # max files sent to a worker at once
+MAX_GRIDS = 64 # frequency grids kept per GridCache
+
+
+# all files matching the patterns (or the files themselves), each file only once, in order of the patterns
+# a directory matches the touchstone files in it (and its subdirectories if recursive)
+def find_files( patterns, recursive=False ):
+    files = {}
+    for pattern in patterns:
+        if os.path.isdir( pattern ):
+            pattern = os.path.join( pattern, '**' if recursive else '', '*.s?p' )
+        for snp in sorted( glob.iglob( pattern, recursive=recursive ) ):
+            if os.path.isfile( snp ):
+                files[ snp ] = None
+    return list( files )
+
+
+# yield function( file ) for the files in their order, computed by jobs worker processes
+# that are set up by initializer( *initargs ), the files of one chunk are processed by the same worker
+# with one job (or one file) the function runs in this process, the caller has to set it up
+def map_files( function, files, jobs, initializer=None, initargs=(), max_chunk=MAX_CHUNK ):
+    jobs = max( 1, jobs or 1 )
+    if jobs == 1 or len( files ) < 2:
+        yield from map( function, files )
+        return
+    # small files, send them in chunks to reduce the process communication
+    chunksize = max( 1, min( max_chunk, len( files ) // ( 4 * jobs ) ) )
+    with ProcessPoolExecutor( max_workers=jobs, initializer=initializer, initargs=initargs ) as executor:
+        yield from executor.map( function, files, chunksize=chunksize )
+
+
+class GridCache:
+    '''
+    Values computed by function( frequencies ) once per frequency grid, e.g. the points of a limit line,
+    calling the cache with a grid returns the value of the function for this grid.
+    The grids are identified by a hash, the max_grids least recently used grids are kept.
+    '''
+
+    def __init__( self, function, max_grids=MAX_GRIDS ):
+        self.function = function
+        self.max_grids = max_grids
+        self.values = collections.OrderedDict() # grid digest -> value, least recently used first
+
+
+    def __call__( self, frequencies ):
+        frequencies = np.ascontiguousarray( frequencies, dtype=np.float64 )
+        digest = hashlib.blake2b( frequencies.tobytes(), digest_size=16 ).digest()
+        value = self.values.get( digest )
+        if value is None:
+            value = self.function( frequencies )
+            self.values[ digest ] = value
+            if len( self.values ) > self.max_grids:
+                self.values.popitem( last=False )
+        else:
+            self.values.move_to_end( digest )
+        return value
@@ -0,0 +1,361 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+'''
+Device broker, owns the serial port of one NanoVNA or tinySA and shares it
+between many local clients via a Unix socket.
+A client gets the device for one transaction (e.g. one command and its response)
+by a lease, the clients waiting for a lease are served first come, first served.
+All messages are framed by a header (see FRAME_HEADER) with type and payload size:
+HELLO (broker -> client): device info as JSON, sent after connect
+LOCK (client -> broker): request a lease, answered by GRANT when the device is free
+DATA (both directions): bytes to the device resp. from the device, only while the lease is held
+UNLOCK (client -> broker): release the lease, the device must be back at the prompt,
+output without a lease is dropped and the broker resyncs to the prompt before the next GRANT
+'''
+
+import collections
+import contextlib
+import json
+import os
+import selectors
+import socket
+import struct
+import tempfile
+import time
+
+import serial
+
+from .device import getdevice, finddevice, detect_device
+
+
+FRAME_HEADER = '<BI' # type, payload size
+FRAME_HEADER_SIZE = struct.calcsize( FRAME_HEADER )
+HELLO, LOCK, GRANT, DATA, UNLOCK = range( 1, 6 )
+
+CR = b'\r'
+PROMPT = b'ch> '
+
+
+# socket in the user runtime dir or in the temp dir
+def default_socket():
+    runtime_dir = os.environ.get( 'XDG_RUNTIME_DIR' )
+    if runtime_dir:
+        return os.path.join( runtime_dir, 'nanotiny.sock' )
+    return os.path.join( tempfile.gettempdir(), f'nanotiny-{os.getuid()}.sock' )
+
+
+# add the client options --broker and --broker-socket to the argument parser ap
+def add_broker_arguments( ap, help='use the device shared by nanotiny_broker.py' ):
+    ap.add_argument( '--broker', action = 'store_true',
+        help = help )
+    ap.add_argument( '--broker-socket', metavar = 'SOCKET',
+        help = f'connect to the broker at SOCKET, implies --broker, default = {default_socket()}' )
+
+
+# broker argument of Session from the parsed options: None = direct access, '' = default socket
+def broker_socket( options ):
+    if options.broker_socket:
+        return options.broker_socket
+    return '' if options.broker else None
+
+
+def frame( frame_type, payload=b'' ):
+    return struct.pack( FRAME_HEADER, frame_type, len( payload ) ) + payload
+
+
+# remove the first complete frame from buffer, return ( type, payload ) or None if incomplete
+def take_frame( buffer ):
+    if len( buffer ) < FRAME_HEADER_SIZE:
+        return None
+    frame_type, size = struct.unpack_from( FRAME_HEADER, buffer )
+    if len( buffer ) < FRAME_HEADER_SIZE + size:
+        return None
+    payload = bytes( buffer[ FRAME_HEADER_SIZE:FRAME_HEADER_SIZE + size ] )
+    del buffer[ :FRAME_HEADER_SIZE + size ]
+    return frame_type, payload
+
+
+class Broker:
+    '''
+    Serve the device on the Unix socket path until stop() is called or ^C.
+    device: serial device (e.g. /dev/ttyACM0), autodetect on USB if None
+    '''
+
+    def __init__( self, device=None, path=None, baudrate=9600, verbose=False ):
+        if device is None:
+            info = getdevice()
+            device = info.device
+        else:
+            info = finddevice( device )
+        name, width, height = detect_device( info ) or ( 'NanoVNA-H', 320, 240 )
+        self.hello = json.dumps( { 'device': device, 'name': name, 'width': width, 'height': height } ).encode()
+        self.path = path or default_socket()
+        self.verbose = verbose
+        self.serial = serial.Serial( device, baudrate=baudrate, timeout=1 )
+        self.resync()
+        self.clients = {} # socket -> receive buffer
+        self.queue = collections.deque() # clients waiting for a lease
+        self.owner = None # client holding the lease
+        self.dirty = False # owner left or output without a lease, resync before the next grant
+        self.running = False
+
+
+    # drop pending data and wait for a fresh prompt
+    def resync( self ):
+        self.serial.reset_input_buffer()
+        self.serial.write( CR )
+        self.serial.read_until( PROMPT )
+
+
+    def log( self, text ):
+        if self.verbose:
+            print( text )
+
+
+    def serve_forever( self ):
+        with contextlib.suppress( FileNotFoundError ):
+            os.unlink( self.path ) # left over from a previous broker
+        listener = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+        listener.bind( self.path )
+        listener.listen()
+        self.selector = selectors.DefaultSelector()
+        self.selector.register( listener, selectors.EVENT_READ, 'accept' )
+        self.selector.register( self.serial.fileno(), selectors.EVENT_READ, 'serial' )
+        self.running = True
+        try:
+            while self.running:
+                for key, _ in self.selector.select( timeout=0.5 ):
+                    if key.data == 'accept':
+                        self.accept( listener )
+                    elif key.data == 'serial':
+                        self.forward()
+                    else:
+                        self.receive( key.fileobj )
+        finally:
+            for client in list( self.clients ):
+                self.disconnect( client )
+            self.selector.close()
+            listener.close()
+            os.unlink( self.path )
+            self.serial.close()
+
+
+    def stop( self ):
+        self.running = False
+
+
+    def accept( self, listener ):
+        client, _ = listener.accept()
+        self.clients[ client ] = bytearray()
+        self.selector.register( client, selectors.EVENT_READ, 'client' )
+        client.sendall( frame( HELLO, self.hello ) )
+        self.log( f'client {client.fileno()} connected' )
+
+
+    def disconnect( self, client ):
+        self.selector.unregister( client )
+        del self.clients[ client ]
+        if client in self.queue:
+            self.queue.remove( client )
+        self.log( f'client {client.fileno()} disconnected' )
+        client.close()
+        if client is self.owner: # lease not released, e.g. killed in the middle of a transaction
+            self.owner = None
+            self.dirty = True
+            self.grant()
+
+
+    # serial data for the owner of the lease, drop unsolicited data
+    def forward( self ):
+        data = self.serial.read( self.serial.in_waiting or 1 )
+        if data and not self.owner: # e.g. late output of the last lease, not at the prompt
+            self.dirty = True
+        elif data:
+            try:
+                self.owner.sendall( frame( DATA, data ) )
+            except OSError:
+                self.disconnect( self.owner )
+
+
+    def receive( self, client ):
+        if client not in self.clients: # disconnected in the same select round
+            return
+        try:
+            data = client.recv( 65536 )
+        except OSError:
+            data = b''
+        if not data:
+            self.disconnect( client )
+            return
+        buffer = self.clients[ client ]
+        buffer += data
+        while client in self.clients:
+            received = take_frame( buffer )
+            if received is None:
+                break
+            frame_type, payload = received
+            if frame_type == LOCK:
+                self.queue.append( client )
+                self.grant()
+            elif frame_type == DATA and client is self.owner:
+                self.serial.write( payload )
+            elif frame_type == UNLOCK and client is self.owner:
+                self.owner = None
+                self.grant()
+
+
+    # give the lease to the next waiting client
+    def grant( self ):
+        if self.owner or not self.queue:
+            return
+        if self.dirty:
+            self.resync()
+            self.dirty = False
+        self.owner = self.queue.popleft()
+        try:
+            self.owner.sendall( frame( GRANT ) )
+        except OSError:
+            self.disconnect( self.owner )
+
+
+class BrokerPort:
+    '''
+    Client side of the broker with the subset of the serial.Serial interface used by the tools,
+    read and write is only allowed inside a lease: "with port.lease(): ..."
+    '''
+
+    def __init__( self, path=None, timeout=1 ):
+        self.path = path or default_socket()
+        self.timeout = timeout
+        self.socket = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+        try:
+            self.socket.connect( self.path )
+        except OSError as error:
+            raise OSError( f'broker not available at {self.path} - {error.strerror}' )
+        self.frames = bytearray() # received, not yet split frames
+        self.buffer = bytearray() # received data from the device
+        self.depth = 0 # nesting of lease()
+        self.granted = False
+        frame_type, payload = self.receive_frame( None )
+        if frame_type != HELLO:
+            raise OSError( 'broker protocol error' )
+        self.info = json.loads( payload )
+
+
+    def close( self ):
+        self.socket.close()
+
+
+    # receive one frame, return ( type, payload ) or ( None, None ) on timeout
+    def receive_frame( self, timeout ):
+        while True:
+            received = take_frame( self.frames )
+            if received is not None:
+                return received
+            self.socket.settimeout( timeout )
+            try:
+                data = self.socket.recv( 65536 )
+            except socket.timeout:
+                return None, None
+            if not data:
+                raise OSError( 'broker closed the connection' )
+            self.frames += data
+
+
+    # wait for device data until timeout, return False on timeout
+    def fill( self, timeout ):
+        frame_type, payload = self.receive_frame( timeout )
+        if frame_type == DATA:
+            self.buffer += payload
+        return frame_type is not None
+
+
+    @contextlib.contextmanager
+    def lease( self ):
+        if self.depth == 0:
+            self.socket.sendall( frame( LOCK ) )
+            while True: # wait for our turn
+                frame_type, payload = self.receive_frame( None )
+                if frame_type == GRANT:
+                    break
+                if frame_type == DATA: # late data of the previous lease
+                    self.buffer += payload
+            self.buffer.clear()
+        self.depth += 1
+        try:
+            yield self
+        finally:
+            self.depth -= 1
+            if self.depth == 0:
+                self.socket.sendall( frame( UNLOCK ) )
+
+
+    def check_lease( self ):
+        if not self.depth:
+            raise OSError( 'broker access without lease' )
+
+
+    def write( self, data ):
+        self.check_lease()
+        self.socket.sendall( frame( DATA, bytes( data ) ) )
+        return len( data )
+
+
+    def read( self, size=1 ):
+        self.check_lease()
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while len( self.buffer ) < size:
+            if not self.fill( self.remaining( deadline ) ):
+                break
+        data = bytes( self.buffer[ :size ] )
+        del self.buffer[ :size ]
+        return data
+
+
+    def read_until( self, expected=b'\n', size=None ):
+        self.check_lease()
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        start = 0
+        while True:
+            position = self.buffer.find( expected, start )
+            if position >= 0:
+                end = position + len( expected )
+                break
+            if size is not None and len( self.buffer ) >= size:
+                end = size
+                break
+            start = max( 0, len( self.buffer ) - len( expected ) + 1 )
+            if not self.fill( self.remaining( deadline ) ):
+                end = len( self.buffer )
+                break
+        if size is not None:
+            end = min( end, size )
+        data = bytes( self.buffer[ :end ] )
+        del self.buffer[ :end ]
+        return data
+
+
+    # time left until deadline, never 0 as this would make the socket non-blocking
+    def remaining( self, deadline ):
+        if deadline is None:
+            return None
+        return max( 0.0, deadline - time.monotonic() ) or 0.001
+
+
+    @property
+    def in_waiting( self ):
+        self.check_lease()
+        while self.fill( 0.001 ):
+            pass
+        return len( self.buffer )
+
+
+    def inWaiting( self ):
+        return self.in_waiting
+
+
+    def reset_input_buffer( self ):
+        self.check_lease()
+        while self.fill( 0.001 ):
+            pass
+        self.buffer.clear()
@@ -0,0 +1,66 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+'''
+Find NanoVNA and tinySA devices on USB
+'''
+
+import os
+
+from serial.tools import list_ports
+
+
+# ChibiOS/RT Virtual COM Port
+VID = 0x0483 #1155
+PID = 0x5740 #22336
+
+# USB description (supported by FW from DiSlord or Erik > 2022) -> device name, screen width, height
+# the first matching description wins, e.g. 'tinySA4' must be checked before 'tinySA'
+DEVICES = (
+    ( 'tinySA4',    'tinySA Ultra', 480, 320 ),
+    ( 'tinySA',     'tinySA',       320, 240 ),
+    ( 'NanoVNA-H4', 'NanoVNA-H4',   480, 320 ),
+    ( 'NanoVNA-H',  'NanoVNA-H',    320, 240 ),
+    ( 'tinyPFA',    'tinyPFA',      480, 320 ),
+)
+
+
+# Get NanoVNA or tinySA device automatically
+def getdevice():
+    device_list = list_ports.comports()
+    for device in device_list:
+        if device.vid == VID and device.pid == PID:
+            return device
+    raise OSError( 'device not found' )
+
+
+# Get all NanoVNA and tinySA devices
+def getdevices():
+    return [ device for device in list_ports.comports() if device.vid == VID and device.pid == PID ]
+
+
+# Get the USB info of a given serial device, None if it is no USB device
+def finddevice( name ):
+    for device in list_ports.comports():
+        if device.device == name:
+            return device
+    return None
+
+
+# Get device name and screen size from the USB description, None if unknown
+def detect_device( device ):
+    if device and device.description:
+        for description, name, width, height in DEVICES:
+            if description in device.description:
+                return name, width, height
+    return None
+
+
+# Unique name of a device, USB serial number or port name
+def device_id( device ):
+    return device.serial_number or os.path.basename( device.device )
+
+
+# Add the device id to a file name, e.g. "scan.s1p" -> "scan_400123456789.s1p"
+def device_filename( filename, device ):
+    stem, ext = os.path.splitext( filename )
+    return f'{stem}_{device_id( device )}{ext}'
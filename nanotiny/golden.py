@@ -0,0 +1,70 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+'''
+Compare S-parameter sweeps with a golden reference, e.g. a known good device in production.
+The reference is read once and resampled onto the frequency grid of each sweep (linear interpolation
+of real and imaginary part, only inside the frequency range of the reference), the resampled values
+are kept per grid, so all sweeps with the same grid share them.
+The deviation of a parameter is the ratio sweep / reference: magnitude in dB and phase in degree.
+'''
+
+import numpy as np
+
+from .batch import GridCache
+from .touchstone import parameter_ports
+
+
+class GoldenReference:
+    '''
+    Golden reference network (f, s as skrf.Network) for the parameters, e.g. ( 'S11', 'S21' ),
+    compare( network ) returns the deviations of the network for each parameter
+    '''
+
+    def __init__( self, network, parameters ):
+        self.name = network.name
+        self.parameters = [ parameter.upper() for parameter in parameters ]
+        self.ports = [ parameter_ports( parameter ) for parameter in self.parameters ]
+        nports = network.s.shape[ 1 ]
+        for parameter, ( i, j ) in zip( self.parameters, self.ports ):
+            if i >= nports or j >= nports:
+                raise ValueError( f'{self.name}: {parameter} not in {nports}-port data' )
+        self.f = np.asarray( network.f, dtype=np.float64 )
+        self.s = np.stack( [ network.s[ :, i, j ] for i, j in self.ports ], axis=1 ) # ( points, parameters )
+        self.resampled = GridCache( self.interpolate ) # grid -> ( index, s )
+
+
+    # points of the grid inside the reference range and the reference interpolated at these points
+    def interpolate( self, frequencies ):
+        index = np.flatnonzero( ( frequencies >= self.f[ 0 ] ) & ( frequencies <= self.f[ -1 ] ) )
+        f = frequencies[ index ]
+        s = np.empty( ( len( index ), len( self.parameters ) ), dtype=complex )
+        for n in range( len( self.parameters ) ):
+            s[ :, n ] = np.interp( f, self.f, self.s[ :, n ].real ) + 1j * np.interp( f, self.f, self.s[ :, n ].imag )
+        return index, s
+
+
+    # interpolated reference for the frequency grid, sweeps with the same grid share it
+    def resample( self, frequencies ):
+        return self.resampled( frequencies )
+
+
+    # return the number of compared points and for each parameter the deviation
+    # ( max dB, RMS dB, max deg, RMS deg ) as absolute values of magnitude and phase
+    # raise ValueError if the network does not have a parameter or no point inside the reference range
+    def compare( self, network ):
+        nports = network.s.shape[ 1 ]
+        for parameter, ( i, j ) in zip( self.parameters, self.ports ):
+            if i >= nports or j >= nports:
+                raise ValueError( f'{parameter} not in {nports}-port data' )
+        index, golden = self.resample( network.f )
+        if not len( index ):
+            raise ValueError( 'no point inside the frequency range of the reference' )
+        s = np.stack( [ network.s[ index, i, j ] for i, j in self.ports ], axis=1 )
+        with np.errstate( divide='ignore', invalid='ignore' ): # one value zero -> infinite deviation
+            magnitude = np.abs( 20 * np.log10( np.abs( s ) / np.abs( golden ) ) )
+        magnitude[ ( s == 0 ) & ( golden == 0 ) ] = 0 # both zero, no deviation instead of NaN
+        phase = np.abs( np.angle( s * np.conj( golden ), deg=True ) ) # angle of s / golden, 0 for zero values
+        deviations = [ ( float( np.max( magnitude[ :, n ] ) ), float( np.sqrt( np.mean( magnitude[ :, n ] ** 2 ) ) ),
+                         float( np.max( phase[ :, n ] ) ), float( np.sqrt( np.mean( phase[ :, n ] ** 2 ) ) ) )
+                       for n in range( len( self.parameters ) ) ]
+        return len( index ), deviations
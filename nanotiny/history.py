@@ -0,0 +1,169 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+'''
+Compact on-disk store for long series of sweeps with the same frequency grid.
+The file starts with a fixed header (see HISTORY_HEADER), followed by the frequency grid
+as float64 and the preallocated records, each record holds the timestamp of the sweep
+as float64 (seconds since epoch) and the complex64 values ( points, parameters ), e.g. S11 or S11 and S21.
+The records are accessed via numpy.memmap, so a single sweep or the values of one frequency
+across all sweeps are read without loading or parsing the whole file.
+'''
+
+import os
+import struct
+import time
+
+import numpy as np
+
+
+HISTORY_HEADER = '<8sHHIQQ' # magic, version, parameters, points, capacity, count
+HISTORY_HEADER_SIZE = 64 # the struct padded for future extensions
+HISTORY_MAGIC = b'NANOHIST'
+HISTORY_VERSION = 1
+HISTORY_CAPACITY_OFFSET = 16
+HISTORY_COUNT_OFFSET = 24
+
+
+# structure of one sweep record
+def history_dtype( points, parameters ):
+    return np.dtype( [ ( 'time', '<f8' ), ( 'values', '<c8', ( points, parameters ) ) ] )
+
+
+class SweepHistory:
+    '''
+    Sweep history file, open an existing file for reading (mode 'r') or appending (mode 'r+'),
+    or create a new file with SweepHistory.create().
+    history[ n ] is the record of sweep n with the fields 'time' and 'values',
+    history.sweep( n ) and history.column( index ) return the complex values.
+    '''
+
+    def __init__( self, filename, mode='r' ):
+        self.filename = filename
+        self.mode = mode
+        self.file = open( filename, 'rb' if mode == 'r' else 'r+b' )
+        header = self.file.read( HISTORY_HEADER_SIZE )
+        if len( header ) != HISTORY_HEADER_SIZE:
+            raise OSError( f'{filename}: no sweep history file' )
+        magic, version, self.parameters, self.points, self.capacity, self.count = \
+            struct.unpack_from( HISTORY_HEADER, header )
+        if magic != HISTORY_MAGIC or version != HISTORY_VERSION:
+            raise OSError( f'{filename}: no sweep history file' )
+        self.frequencies = np.fromfile( self.file, dtype='<f8', count=self.points )
+        self.dtype = history_dtype( self.points, self.parameters )
+        self.offset = HISTORY_HEADER_SIZE + self.frequencies.nbytes
+        self.records = self.map()
+
+
+    # create a new file for sweeps with the given frequency grid, return the opened history
+    # parameters: number of complex values per point, e.g. 1: S11, 2: S11 and S21
+    # capacity: number of preallocated records, the file grows automatically
+    @classmethod
+    def create( cls, filename, frequencies, parameters=1, capacity=1024 ):
+        frequencies = np.asarray( frequencies, dtype='<f8' )
+        capacity = max( capacity, 1 )
+        with open( filename, 'wb' ) as outfile:
+            header = struct.pack( HISTORY_HEADER, HISTORY_MAGIC, HISTORY_VERSION,
+                parameters, len( frequencies ), capacity, 0 )
+            outfile.write( header.ljust( HISTORY_HEADER_SIZE, b'\0' ) )
+            outfile.write( frequencies.tobytes() )
+            outfile.truncate( outfile.tell() + capacity * history_dtype( len( frequencies ), parameters ).itemsize )
+        return cls( filename, 'r+' )
+
+
+    def close( self ):
+        if self.records is not None:
+            if self.mode != 'r':
+                self.records.flush()
+            self.records = None
+        self.file.close()
+
+
+    def __enter__( self ):
+        return self
+
+
+    def __exit__( self, *args ):
+        self.close()
+
+
+    def __len__( self ):
+        return self.count
+
+
+    # record of sweep n, negative n counts from the end
+    def __getitem__( self, n ):
+        if isinstance( n, ( int, np.integer ) ) and not -self.count <= n < self.count:
+            if not self.count:
+                raise IndexError( f'{self.filename}: no sweeps recorded' )
+            raise IndexError( f'{self.filename}: sweep {n} not recorded, {self.count} sweeps' )
+        return self.records[ :self.count ][ n ]
+
+
+    def map( self ):
+        return np.memmap( self.file, dtype=self.dtype, mode=self.mode,
+            offset=self.offset, shape=( self.capacity, ) )
+
+
+    # re-read the number of sweeps, e.g. while another process is appending
+    def refresh( self ):
+        self.file.seek( HISTORY_CAPACITY_OFFSET )
+        capacity, self.count = struct.unpack( '<QQ', self.file.read( 16 ) )
+        if capacity != self.capacity:
+            self.capacity = capacity
+            self.records = self.map()
+        return self.count
+
+
+    # append one sweep, values: complex array ( points ) or ( points, parameters )
+    # timestamp: seconds since epoch, default: now
+    def append( self, values, timestamp=None ):
+        if self.mode == 'r':
+            raise OSError( f'{self.filename}: opened read only' )
+        values = np.asarray( values ).reshape( ( self.points, self.parameters ) )
+        if self.count == self.capacity: # grow the file, double the capacity
+            self.records.flush()
+            self.capacity *= 2
+            self.file.truncate( self.offset + self.capacity * self.dtype.itemsize )
+            self.records = self.map()
+            self.file.seek( HISTORY_CAPACITY_OFFSET )
+            self.file.write( struct.pack( '<Q', self.capacity ) )
+        record = self.records[ self.count ]
+        record[ 'values' ] = values
+        record[ 'time' ] = time.time() if timestamp is None else timestamp
+        # update the count after the record is written, readers see only complete sweeps
+        self.count += 1
+        self.file.seek( HISTORY_COUNT_OFFSET )
+        self.file.write( struct.pack( '<Q', self.count ) )
+        self.file.flush()
+
+
+    # timestamps of all sweeps
+    def times( self ):
+        return self.records[ :self.count ][ 'time' ]
+
+
+    # complex values of sweep n, shape ( points, parameters )
+    def sweep( self, n ):
+        return self[ n ][ 'values' ]
+
+
+    # complex values of one frequency index across all sweeps, shape ( sweeps, parameters )
+    def column( self, index ):
+        return self.records[ :self.count ][ 'values' ][ :, index ]
+
+
+    # index of the frequency point nearest to frequency
+    def frequency_index( self, frequency ):
+        return int( np.abs( self.frequencies - frequency ).argmin() )
+
+
+# open an existing history file for appending or create it
+# raise OSError if the existing file has another frequency grid
+def open_history( filename, frequencies, parameters=1 ):
+    if not os.path.exists( filename ):
+        return SweepHistory.create( filename, frequencies, parameters )
+    history = SweepHistory( filename, 'r+' )
+    if history.parameters != parameters or not np.array_equal( history.frequencies, frequencies ):
+        history.close()
+        raise OSError( f'{filename}: different sweep parameters' )
+    return history
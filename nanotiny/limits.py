@@ -0,0 +1,131 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+'''
+Limit masks for pass/fail tests of S-parameter sweeps, e.g. in production.
+A mask is a JSON file with a name and a list of segments, each segment is a piecewise-linear
+limit line for the magnitude in dB of one S-parameter:
+
+    {
+        "name": "BP 435",
+        "segments": [
+            { "name": "RL pass", "parameter": "S11", "limit": "max", "unit": "MHz",
+              "line": [ [ 430, -15 ], [ 440, -15 ] ] },
+            { "name": "IL pass", "parameter": "S21", "limit": "min", "unit": "MHz",
+              "line": [ [ 430, -3 ], [ 435, -2 ], [ 440, -3 ] ] }
+        ]
+    }
+
+"limit": "max" (the value must not exceed the line) or "min" (the value must not fall below the line),
+"unit": unit of the line frequencies, Hz (default), kHz, MHz or GHz.
+The segments are compiled once per frequency grid (the points inside each line and the
+interpolated limits), the margin of a segment is the smallest distance to the limit line in dB,
+negative if the limit is violated.
+'''
+
+import json
+
+import numpy as np
+
+from .batch import GridCache
+from .touchstone import parameter_ports
+
+
+UNITS = { 'HZ': 1, 'KHZ': 1e3, 'MHZ': 1e6, 'GHZ': 1e9 }
+LIMITS = ( 'min', 'max' )
+
+
+class LimitSegment:
+    '''
+    One limit line: name, port indices ( i, j ) of the S-parameter Sij, limit 'min' or 'max',
+    frequencies in Hz and limits in dB of the line points
+    '''
+
+    def __init__( self, name, parameter, limit, frequencies, limits ):
+        try:
+            self.ports = parameter_ports( parameter )
+        except ValueError as error:
+            raise ValueError( f'{name}: {error}' )
+        if limit not in LIMITS:
+            raise ValueError( f'{name}: limit must be "min" or "max"' )
+        if len( frequencies ) < 1 or np.any( np.diff( frequencies ) < 0 ):
+            raise ValueError( f'{name}: line needs points with increasing frequency' )
+        self.name = name
+        self.parameter = parameter.upper()
+        self.limit = limit
+        self.frequencies = np.asarray( frequencies, dtype=np.float64 )
+        self.limits = np.asarray( limits, dtype=np.float64 )
+
+
+    # points of the grid inside the line and the limits at these points
+    def compile( self, frequencies ):
+        index = np.flatnonzero( ( frequencies >= self.frequencies[ 0 ] ) & ( frequencies <= self.frequencies[ -1 ] ) )
+        return index, np.interp( frequencies[ index ], self.frequencies, self.limits )
+
+
+class LimitMask:
+    '''
+    Named list of LimitSegments, evaluate( network ) returns the margin of each segment
+    '''
+
+    def __init__( self, name, segments ):
+        self.name = name
+        self.segments = segments
+        self.compiled = GridCache( lambda frequencies: [ segment.compile( frequencies ) for segment in self.segments ] )
+
+
+    # read a mask from a JSON file, raise ValueError if the mask is not valid
+    @classmethod
+    def load( cls, filename ):
+        with open( filename ) as infile:
+            try:
+                mask = json.load( infile )
+            except json.JSONDecodeError as error:
+                raise ValueError( f'{filename}: {error}' )
+        segments = []
+        try:
+            for n, segment in enumerate( mask[ 'segments' ] ):
+                name = segment.get( 'name', f'segment {n + 1}' )
+                unit = UNITS.get( segment.get( 'unit', 'Hz' ).upper() )
+                if unit is None:
+                    raise ValueError( f'{name}: unknown unit {segment[ "unit" ]}' )
+                line = np.asarray( segment[ 'line' ], dtype=np.float64 ).reshape( ( -1, 2 ) )
+                segments.append( LimitSegment( name, segment[ 'parameter' ], segment.get( 'limit', 'max' ),
+                    unit * line[ :, 0 ], line[ :, 1 ] ) )
+        except ( KeyError, TypeError ) as error:
+            raise ValueError( f'{filename}: missing or wrong mask entry {error}' )
+        except ValueError as error:
+            raise ValueError( f'{filename}: {error}' )
+        if not segments:
+            raise ValueError( f'{filename}: no segments' )
+        return cls( mask.get( 'name', filename ), segments )
+
+
+    # compiled segments for the frequency grid, sweeps with the same grid share them
+    def compile( self, frequencies ):
+        return self.compiled( frequencies )
+
+
+    # margin in dB and frequency of the worst point of each segment for the network (f, s as skrf.Network)
+    # the margin is negative if the limit is violated, NaN if no point of the sweep is inside the segment
+    # raise ValueError if the network does not have the parameter of a segment
+    def evaluate( self, network ):
+        ports = network.s.shape[ 1 ]
+        results = []
+        for segment, ( index, limits ) in zip( self.segments, self.compile( network.f ) ):
+            i, j = segment.ports
+            if i >= ports or j >= ports:
+                raise ValueError( f'{segment.parameter} not in {ports}-port data' )
+            if not len( index ):
+                results.append( ( np.nan, np.nan ) )
+                continue
+            with np.errstate( divide='ignore' ): # |S| = 0 -> -inf dB
+                values = 20 * np.log10( np.abs( network.s[ index, i, j ] ) )
+            margins = limits - values if segment.limit == 'max' else values - limits
+            worst = int( np.argmin( margins ) )
+            results.append( ( float( margins[ worst ] ), float( network.f[ index[ worst ] ] ) ) )
+        return results
+
+
+# a segment passes if it has points and no point violates the limit
+def passed( margins ):
+    return all( margin >= 0 for margin, _ in margins ) # NaN (not covered) fails
@@ -0,0 +1,283 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+'''
+Screen mirror for the remote display of NanoVNA and tinySA ("refresh on").
+The device sends the changed screen regions as "bulk" (RGB565 pixel) or "fill" (one color):
+"bulk\r\n" uint16 x, y, w, h; w * h big endian uint16 pixel
+"fill\r\n" uint16 x, y, w, h; big endian uint16 color
+The RemoteStream parser splits the received chunks into regions,
+the Framebuffer keeps the RGB565 screen, the converted 32 bit pixel and the zoomed image
+and converts and scales only the regions changed since the last render().
+A session is recorded as the raw stream chunks with their time (see StreamRecorder),
+the recording starts with the complete screen as one "bulk" region.
+'''
+
+import struct
+import time
+
+import numpy as np
+
+from .rgb565 import BGRA, rgb565_to_rgba, rgb565_lut, rgba_channels
+
+
+MAX_DIRTY = 64 # more changed regions are merged into their bounding box
+MAX_LINE = 256 # longer text without line end is dropped
+CRLF = b'\r\n'
+GEOMETRY = '<HHHH' # x, y, w, h
+GEOMETRY_SIZE = struct.calcsize( GEOMETRY )
+BULK = 'bulk'
+FILL = 'fill'
+
+RECORD_HEADER = '<8sHH32s' # magic, width, height, device name
+RECORD_MAGIC = b'NANOREMO'
+RECORD = '<dI' # seconds since start of recording, size of the following data
+RECORD_SIZE = struct.calcsize( RECORD )
+
+
+# stream data of a bulk region with RGB565 pixel, any array with w * h elements
+def bulk_data( x, y, w, h, rgb565 ):
+    return BULK.encode() + CRLF + struct.pack( GEOMETRY, x, y, w, h ) + np.asarray( rgb565, dtype='>u2' ).tobytes()
+
+
+class RemoteStream:
+    '''
+    Parser for the remote display stream of a width * height screen.
+    feed() takes the received chunks of any size and returns the complete regions as
+    ( BULK, x, y, w, h, pixels ) with pixels as numpy '>u2' view on the receive buffer or
+    ( FILL, x, y, w, h, color ). The views are valid until the next call of feed(),
+    incomplete regions are kept until the rest is received. Text (echo, prompt) is skipped.
+    '''
+
+    def __init__( self, width, height, size=0x10000 ):
+        self.width = width
+        self.height = height
+        self.buffer = bytearray( size )
+        self.start = 0 # start of the unparsed data
+        self.end = 0 # end of the received data
+        self.errors = 0 # regions outside the screen
+
+
+    # append data to the buffer, move the unparsed rest to the front or grow the buffer if needed
+    def append( self, data ):
+        rest = self.end - self.start
+        if self.start: # keep the size, the views of the previous regions may still be referenced
+            self.buffer[ :rest ] = self.buffer[ self.start:self.end ]
+            self.start, self.end = 0, rest
+        if rest + len( data ) > len( self.buffer ):
+            buffer = bytearray( max( 2 * len( self.buffer ), rest + len( data ) ) )
+            buffer[ :rest ] = self.buffer[ :rest ]
+            self.buffer = buffer
+        self.buffer[ rest:rest + len( data ) ] = data
+        self.end = rest + len( data )
+
+
+    def feed( self, data ):
+        self.append( data )
+        regions = []
+        buffer = self.buffer
+        pos = self.start
+        while True:
+            line_end = buffer.find( CRLF, pos, self.end )
+            if line_end < 0:
+                if self.end - pos > MAX_LINE: # no region header, drop all but a possible start of it
+                    pos = self.end - len( 'bulk\r' )
+                break
+            what = buffer[ max( pos, line_end - 4 ):line_end ]
+            if what not in ( b'bulk', b'fill' ): # text line
+                pos = line_end + len( CRLF )
+                continue
+            header = line_end + len( CRLF )
+            data_start = header + GEOMETRY_SIZE
+            if data_start > self.end: # wait for the geometry
+                break
+            x, y, w, h = struct.unpack_from( GEOMETRY, buffer, header )
+            if x + w > self.width or y + h > self.height: # garbage, resync at the next line
+                self.errors += 1
+                pos = header
+                continue
+            size = 2 * w * h if what == b'bulk' else 2
+            if data_start + size > self.end: # wait for the pixel
+                break
+            if what == b'bulk':
+                pixels = np.frombuffer( buffer, dtype='>u2', count=w * h, offset=data_start )
+                regions.append( ( BULK, x, y, w, h, pixels ) )
+            else:
+                color, = struct.unpack_from( '>H', buffer, data_start )
+                regions.append( ( FILL, x, y, w, h, color ) )
+            pos = data_start + size
+        self.start = pos
+        return regions
+
+
+class StreamRecorder:
+    '''
+    Record the remote display stream of a width * height screen to filename,
+    the first record is the complete screen rgb565, followed by the chunks given to write()
+    '''
+
+    def __init__( self, filename, width, height, name, rgb565 ):
+        self.file = open( filename, 'wb' )
+        self.file.write( struct.pack( RECORD_HEADER, RECORD_MAGIC, width, height, name.encode()[ :32 ] ) )
+        self.start = time.monotonic()
+        self.write( bulk_data( 0, 0, width, height, rgb565 ) )
+
+
+    def write( self, data ):
+        if data:
+            self.file.write( struct.pack( RECORD, time.monotonic() - self.start, len( data ) ) )
+            self.file.write( data )
+
+
+    def close( self ):
+        self.file.close()
+
+
+    def __enter__( self ):
+        return self
+
+
+    def __exit__( self, *args ):
+        self.close()
+
+
+class StreamRecording:
+    '''
+    Recording of a remote display stream, iterate over the records ( seconds, data )
+    '''
+
+    def __init__( self, filename ):
+        self.filename = filename
+        with open( filename, 'rb' ) as infile:
+            header = infile.read( struct.calcsize( RECORD_HEADER ) )
+            if len( header ) != struct.calcsize( RECORD_HEADER ):
+                raise OSError( f'{filename}: no remote display recording' )
+            magic, self.width, self.height, name = struct.unpack( RECORD_HEADER, header )
+        if magic != RECORD_MAGIC:
+            raise OSError( f'{filename}: no remote display recording' )
+        self.name = name.rstrip( b'\0' ).decode( errors='replace' )
+
+
+    def __iter__( self ):
+        with open( self.filename, 'rb' ) as infile:
+            infile.seek( struct.calcsize( RECORD_HEADER ) )
+            while True:
+                record = infile.read( RECORD_SIZE )
+                if len( record ) != RECORD_SIZE: # end of file, also if truncated by a crash
+                    return
+                seconds, size = struct.unpack( RECORD, record )
+                data = infile.read( size )
+                if len( data ) != size:
+                    return
+                yield seconds, data
+
+
+class Latency:
+    '''
+    Statistics of a latency without keeping the single values
+    '''
+
+    def __init__( self, name ):
+        self.name = name
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+    def add( self, seconds ):
+        self.count += 1
+        self.total += seconds
+        self.max = max( self.max, seconds )
+
+
+    def __str__( self ):
+        if not self.count:
+            return f'{self.name}: -'
+        return f'{self.name}: {1e3 * self.total / self.count:.1f} ms mean, {1e3 * self.max:.1f} ms max, {self.count} samples'
+
+
+class Framebuffer:
+    '''
+    Screen of width * height RGB565 pixel with the 32 bit image zoomed by an integer factor.
+    order: byte order of the image, BGRA for OpenCV, RGBA for PIL
+    '''
+
+    def __init__( self, width, height, zoom=1, order=BGRA, invert=False ):
+        self.width = width
+        self.height = height
+        self.order = order
+        self.invert = invert
+        self.rgb565 = np.zeros( ( height, width ), dtype=np.uint16 )
+        self.pixels = np.zeros( ( height, width ), dtype=np.uint32 )
+        self.set_zoom( zoom )
+
+
+    # change the zoom factor, the next render() draws the complete screen
+    def set_zoom( self, zoom ):
+        self.zoom = zoom
+        self.zoomed = np.zeros( ( zoom * self.height, zoom * self.width ), dtype=np.uint32 )
+        self.dirty = [ ( 0, 0, self.width, self.height ) ]
+
+
+    def mark( self, x, y, w, h ):
+        self.dirty.append( ( x, y, w, h ) )
+        if len( self.dirty ) > MAX_DIRTY: # merge into the bounding box
+            x0 = min( d[ 0 ] for d in self.dirty )
+            y0 = min( d[ 1 ] for d in self.dirty )
+            x1 = max( d[ 0 ] + d[ 2 ] for d in self.dirty )
+            y1 = max( d[ 1 ] + d[ 3 ] for d in self.dirty )
+            self.dirty = [ ( x0, y0, x1 - x0, y1 - y0 ) ]
+
+
+    # region with RGB565 pixel, any array with w * h elements
+    def bulk( self, x, y, w, h, pixels ):
+        self.rgb565[ y:y+h, x:x+w ] = np.reshape( pixels, ( h, w ) )
+        self.mark( x, y, w, h )
+
+
+    # region filled with one RGB565 color
+    def fill( self, x, y, w, h, color ):
+        self.rgb565[ y:y+h, x:x+w ] = color
+        self.mark( x, y, w, h )
+
+
+    # apply the regions from RemoteStream.feed()
+    def apply( self, regions ):
+        for what, x, y, w, h, data in regions:
+            if what == BULK:
+                self.bulk( x, y, w, h, data )
+            else:
+                self.fill( x, y, w, h, data )
+
+
+    # complete screen, e.g. from capture, only the changed rows are marked
+    # return the changed region ( x, y, w, h ) or None
+    def update( self, rgb565 ):
+        rgb565 = np.reshape( rgb565, ( self.height, self.width ) )
+        rows = np.flatnonzero( ( self.rgb565 != rgb565 ).any( axis=1 ) )
+        if not len( rows ):
+            return None
+        top, bottom = int( rows[ 0 ] ), int( rows[ -1 ] ) + 1
+        self.bulk( 0, top, self.width, bottom - top, rgb565[ top:bottom ] )
+        return 0, top, self.width, bottom - top
+
+
+    # convert and zoom the changed regions, return the zoomed image as uint8 array ( height, width, 4 )
+    # and the list of changed regions ( x, y, w, h ) in screen coordinates
+    def render( self ):
+        lut = rgb565_lut( self.order, self.invert )
+        zoom = self.zoom
+        dirty, self.dirty = self.dirty, []
+        for x, y, w, h in dirty:
+            region = self.pixels[ y:y+h, x:x+w ]
+            np.take( lut, self.rgb565[ y:y+h, x:x+w ], out=region )
+            if zoom == 1:
+                continue
+            # view the zoomed region as ( h, zoom, w, zoom ) and broadcast each pixel into its zoom * zoom block
+            target = self.zoomed[ zoom*y:zoom*(y+h), zoom*x:zoom*(x+w) ]
+            target.reshape( ( h, zoom, w, zoom ) )[ ... ] = region[ :, None, :, None ]
+        return rgba_channels( self.pixels if zoom == 1 else self.zoomed ), dirty
+
+
+    # convert the complete screen without zoom, e.g. for screenshots
+    def image( self ):
+        return rgba_channels( rgb565_to_rgba( self.rgb565, self.order, self.invert ) )
@@ -0,0 +1,46 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+'''
+Convert the RGB565 pixel of NanoVNA and tinySA screens into 32 bit pixel via lookup tables.
+Rrrr.rGgg.gggB.bbbb -> Aaaa.aaaa + Rrrr.r000 + Gggg.gg00 + Bbbb.b000 in the byte order
+RGBA (e.g. for PIL) or BGRA (e.g. for OpenCV), optionally inverted for printing with white background.
+'''
+
+import functools
+
+import numpy as np
+
+
+RGBA = 'RGBA' # byte order in memory R, G, B, A
+BGRA = 'BGRA' # byte order in memory B, G, R, A
+
+
+# 65536 entry table RGB565 -> uint32 pixel, created once per byte order and invert
+@functools.lru_cache( maxsize=None )
+def rgb565_lut( order=RGBA, invert=False ):
+    rgb565 = np.arange( 0x10000, dtype=np.uint32 )
+    red = ( rgb565 & 0xF800 ) >> 8
+    green = ( rgb565 & 0x07E0 ) >> 3
+    blue = ( rgb565 & 0x001F ) << 3
+    if order == RGBA:
+        lut = red | ( green << 8 ) | ( blue << 16 )
+    elif order == BGRA:
+        lut = blue | ( green << 8 ) | ( red << 16 )
+    else:
+        raise ValueError( f'unknown byte order {order}' )
+    if invert:
+        lut ^= 0x00FFFFFF
+    lut |= 0xFF000000 # opaque
+    lut.flags.writeable = False
+    return lut
+
+
+# convert an array of RGB565 pixel (e.g. '>u2' from numpy.frombuffer) into uint32 pixel of the same shape
+# out: optional uint32 array of the same shape that is reused for the result
+def rgb565_to_rgba( rgb565, order=RGBA, invert=False, out=None ):
+    return np.take( rgb565_lut( order, invert ), rgb565, out=out )
+
+
+# uint32 pixel ( height, width ) as uint8 array ( height, width, 4 ) without copy, e.g. for OpenCV
+def rgba_channels( rgba ):
+    return rgba.view( np.uint8 ).reshape( rgba.shape + ( 4, ) )
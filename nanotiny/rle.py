@@ -0,0 +1,143 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+'''
+Decoder for the compressed screen capture ("capture rle") of NanoVNA and tinySA.
+The stream starts with a 10 byte header (see RLE_HEADER), followed by the palette
+of RGB565 colors and one RLE block per screen row, each block preceded by its uint16 size.
+'''
+
+import struct
+
+import numpy
+
+
+RLE_HEADER = '<HHHBBH' # magic, width, height, bpp, compression, psize
+RLE_HEADER_SIZE = struct.calcsize( RLE_HEADER )
+RLE_MAGIC = 0x4d42
+
+
+# parse the header, return ( width, height, psize ) or None if it is no valid RLE header
+def parse_rle_header( header ):
+    if len( header ) != RLE_HEADER_SIZE:
+        return None
+    magic, width, height, bpp, compression, psize = struct.unpack( RLE_HEADER, header )
+    if magic != RLE_MAGIC or bpp != 8 or compression != 1:
+        return None
+    return width, height, psize
+
+
+# expand the RLE runs and literals of one block into an array of palette indices
+def rle_block_indices( block ):
+    bsize = len( block )
+    run_pos, run_len, lit_start, lit_end = [], [], [], []
+    sptr = 0
+    while sptr < bsize: # walk the tokens only, not every single pixel
+        count = block[ sptr ]
+        if count > 127: # int8 count < 0: repeat next byte 1 - count times
+            run_pos.append( sptr + 1 )
+            run_len.append( 257 - count )
+            sptr += 2
+        else: # count >= 0: count + 1 literal bytes follow
+            lit_start.append( sptr + 1 )
+            sptr += count + 2
+            lit_end.append( sptr )
+    if sptr != bsize:
+        raise ValueError( 'RLE block truncated' )
+    # repetition count for each byte of the block, 0 for the count bytes
+    delta = numpy.zeros( bsize + 1, dtype=numpy.intp )
+    delta[ lit_start ] = 1
+    delta[ lit_end ] -= 1
+    repeat = numpy.cumsum( delta[ :-1 ] )
+    repeat[ run_pos ] = run_len
+    return numpy.repeat( numpy.frombuffer( block, dtype=numpy.uint8 ), repeat )
+
+
+# decode the RLE stream (following the 10 byte header) into a RGB565 pixel array
+# read( size ) returns the next size bytes of the stream, each block is read at once
+def decode_rle( read, width, height, psize ):
+    palette = numpy.frombuffer( read( psize ), dtype='>u2' ) # RGB565 big endian
+    bitmap = numpy.zeros( width * height, dtype='>u2' ) # black if the data are short, as the reference
+    dptr = 0
+    for row in range( height ):
+        bsize, = struct.unpack( '<H', read( 2 ) )
+        block = read( bsize )
+        if len( block ) != bsize:
+            raise ValueError( 'RLE stream truncated' )
+        indices = rle_block_indices( block )
+        if dptr + indices.size > bitmap.size:
+            raise ValueError( 'RLE data exceed the screen size' )
+        bitmap[ dptr : dptr + indices.size ] = palette[ indices ] # palette lookup into the image
+        dptr += indices.size
+    return bitmap
+
+
+# the previous per pixel decoder, used as reference for --check-rle
+def decode_rle_reference( read, width, height, psize ):
+    bytestream = read( psize ) # read palette (psize = byte size)
+    palette=struct.unpack_from( '<{:d}H'.format(psize//2), bytestream, 0 ) # uint16!
+    sptr=psize
+    bitmap=bytearray(width*height*2)
+    dptr=0
+    row=0
+    while(row<height):
+        #process RLE block
+        bytestream += read( 2 ) # uint16
+        bsize=struct.unpack_from('<H',bytestream,sptr)[0]
+        sptr=sptr+2
+        nptr=sptr+bsize
+        while(sptr<nptr):
+            bytestream += read( 1 ) # uint8
+            count=struct.unpack_from('<b',bytestream,sptr)[0]
+            sptr+=1
+            if(count<0):
+                bytestream += read( 1 ) # uint8
+                color=palette[bytestream[sptr]]
+                sptr+=1
+                while(count<=0):
+                    count=count+1
+                    struct.pack_into('<H',bitmap,dptr,color)
+                    dptr+=2
+            else:
+                bytestream += read( count + 1 ) # uint8
+                while(count>=0):
+                    count=count-1
+                    struct.pack_into('<H',bitmap,dptr,palette[bytestream[sptr]])
+                    dptr+=2
+                    sptr+=1
+        row+=1
+    return bytes( bitmap )
+
+
+# compress a RGB565 screen, numpy array ( height, width ), into a "capture rle" stream
+# as sent by the FW, e.g. for the simulator; the screen must not use more than 256 colors
+def encode_rle( rgb565 ):
+    height, width = rgb565.shape
+    palette, indices = numpy.unique( rgb565, return_inverse=True )
+    if len( palette ) > 256:
+        raise ValueError( 'RLE supports max. 256 colors' )
+    indices = indices.reshape( ( height, width ) ).astype( numpy.uint8 )
+    stream = bytearray( struct.pack( RLE_HEADER, RLE_MAGIC, width, height, 8, 1, 2 * len( palette ) ) )
+    stream += palette.astype( '>u2' ).tobytes()
+    for row in indices:
+        block = bytearray()
+        literal = bytearray()
+        # split the row into runs of equal pixels
+        starts = numpy.flatnonzero( numpy.concatenate( ( [ True ], row[ 1: ] != row[ :-1 ] ) ) )
+        lengths = numpy.diff( numpy.append( starts, width ) )
+        for index, length in zip( row[ starts ].tolist(), lengths.tolist() ):
+            while length > 1: # runs: count = 1 - length, length = 2..129
+                if literal:
+                    block += struct.pack( '<b', len( literal ) - 1 ) + literal
+                    literal = bytearray()
+                run = min( length, 129 )
+                block += struct.pack( '<bB', 1 - run, index )
+                length -= run
+            if length == 1: # literals: count = length - 1, length = 1..128
+                literal.append( index )
+                if len( literal ) == 128:
+                    block += struct.pack( '<b', 127 ) + literal
+                    literal = bytearray()
+        if literal:
+            block += struct.pack( '<b', len( literal ) - 1 ) + literal
+        stream += struct.pack( '<H', len( block ) ) + block
+    return bytes( stream )
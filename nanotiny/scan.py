@@ -0,0 +1,49 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+'''
+Parse the response of the NanoVNA "scan" command into numpy structured arrays
+with the fields "freq", "S11r", "S11i", "S21r", "S21i" as enabled by outmask.
+'''
+
+import numpy as np
+from numpy.lib import recfunctions
+
+
+# outmask bits of the scan command
+SCAN_FREQ = 1
+SCAN_S11 = 2
+SCAN_S21 = 4
+SCAN_BINARY = 128
+
+
+# structure of one scan record, only the fields enabled by outmask are sent
+# binary: uint32_t freq; float s11_re; float s11_im; float s21_re; float s21_im;
+def scan_dtype( outmask, binary=True ):
+    freq_type, value_type = ( '<u4', '<f4' ) if binary else ( '<f8', '<f8' )
+    fields = []
+    if outmask & SCAN_FREQ:
+        fields.append( ( 'freq', freq_type ) )
+    if outmask & SCAN_S11:
+        fields += [ ( 'S11r', value_type ), ( 'S11i', value_type ) ]
+    if outmask & SCAN_S21:
+        fields += [ ( 'S21r', value_type ), ( 'S21i', value_type ) ]
+    return np.dtype( fields )
+
+
+# binary scan result (after the 4 byte header), zero-copy view on the received data
+def parse_scan_binary( data, outmask ):
+    return np.frombuffer( data, dtype=scan_dtype( outmask ) )
+
+
+# ASCII scan result as list of lines, None if the lines do not match outmask and points
+def parse_scan_text( lines, outmask, points=None ):
+    dtype = scan_dtype( outmask, binary=False )
+    try:
+        values = np.array( [ line.split() for line in lines ], dtype=np.float64 )
+    except ValueError: # error message or incomplete line
+        return None
+    if values.ndim != 2 or values.shape[ 1 ] != len( dtype.names ):
+        return None
+    if points is not None and len( values ) != points:
+        return None
+    return recfunctions.unstructured_to_structured( values, dtype=dtype )
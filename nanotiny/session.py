@@ -0,0 +1,341 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+'''
+Persistent shell session with a NanoVNA or tinySA
+'''
+
+import collections
+import contextlib
+from datetime import datetime
+import functools
+import struct
+import sys
+
+import numpy as np
+import serial
+
+from .broker import BrokerPort
+from .device import getdevice, finddevice, detect_device
+from .rle import RLE_HEADER_SIZE, parse_rle_header, decode_rle
+from .scan import SCAN_FREQ, SCAN_S11, SCAN_BINARY, scan_dtype, parse_scan_binary, parse_scan_text
+
+
+CR = b'\r'
+CRLF = b'\r\n'
+PROMPT = b'ch> '
+
+
+# response without the trailing CRLF and prompt
+def strip_prompt( response ):
+    if response.endswith( PROMPT ):
+        response = response[ :-len( PROMPT ) ]
+    if response.endswith( CRLF ):
+        response = response[ :-len( CRLF ) ]
+    return response
+
+
+# run the method as one transaction, i.e. with exclusive access to the device
+def transaction( method ):
+    @functools.wraps( method )
+    def wrapper( self, *args, **kwargs ):
+        with self.lease():
+            return method( self, *args, **kwargs )
+    return wrapper
+
+
+class Session:
+    '''
+    Connection to the shell of a NanoVNA or tinySA.
+    The serial port is opened once and synced to the prompt "ch> ",
+    afterwards any number of commands can be executed.
+    device: serial device (e.g. /dev/ttyACM0), autodetect on USB if None
+    broker: socket of a running nanotiny broker ('' = default socket), used instead of the device,
+    each method call is one transaction, use "with session.lease():" for direct access of session.serial
+    '''
+
+    def __init__( self, device=None, baudrate=9600, timeout=1, broker=None ):
+        self.timeout = timeout
+        self.command = None # last command sent
+        self.capture_stream = None # raw data received by the last capture
+        self.scan_stream = None # raw data received by the last scan (binary records or text) or scanraw
+        if broker is not None: # the broker owns the device and keeps it synced
+            self.serial = BrokerPort( broker or None, timeout=timeout )
+            self.lease = self.serial.lease
+            self.info = None
+            self.device = self.serial.info[ 'device' ]
+            self.name, self.width, self.height = ( self.serial.info[ key ] for key in ( 'name', 'width', 'height' ) )
+            return
+        if device is None:
+            self.info = getdevice()
+            device = self.info.device
+        else:
+            self.info = finddevice( device ) # USB info if available
+        self.device = device
+        # device name and screen size from USB description, defaults for older FW
+        self.name, self.width, self.height = detect_device( self.info ) or ( 'NanoVNA-H', 320, 240 )
+        self.serial = serial.Serial( device, baudrate=baudrate, timeout=timeout )
+        self.lease = contextlib.nullcontext # exclusive access anyway
+        self.resync()
+
+
+    def close( self ):
+        self.serial.close()
+
+
+    def __enter__( self ):
+        return self
+
+
+    def __exit__( self, *args ):
+        self.close()
+
+
+    # drop pending data and wait for a fresh prompt
+    @transaction
+    def resync( self ):
+        self.serial.reset_input_buffer()
+        self.serial.write( CR )
+        self.serial.read_until( PROMPT )
+
+
+    # send command and options terminated by CR, wait for the echo
+    def send( self, cmd ):
+        if isinstance( cmd, str ):
+            cmd = cmd.encode()
+        self.command = cmd.decode()
+        self.serial.write( cmd + CR )
+        self.serial.read_until( cmd + CRLF )
+
+
+    # execute a command, return the response as bytes without trailing CRLF and prompt
+    @transaction
+    def execute_raw( self, cmd ):
+        if isinstance( cmd, str ):
+            cmd = cmd.encode()
+        self.serial.write( cmd + CR )
+        return self.receive( cmd )[ 1 ]
+
+
+    # execute a command, return the response as list of lines
+    def execute( self, cmd ):
+        response = self.execute_raw( cmd )
+        if not response:
+            return []
+        return response.decode( errors='replace' ).split( CRLF.decode() )
+
+
+    # execute many commands, up to window commands are typed ahead while the responses are read,
+    # yield ( cmd, response ) in order, the responses are separated by the echo of the command and the prompt
+    # not suitable for commands with binary responses that may contain the prompt
+    # the lease (broker lock) is held until the generator is exhausted or closed, a caller that stops early
+    # should close() it (e.g. "with contextlib.closing( session.execute_pipelined( cmds ) ) as responses:"),
+    # the responses of the commands already typed ahead are dropped then
+    def execute_pipelined( self, cmds, window=8 ):
+        pending = collections.deque()
+        with self.lease():
+            try:
+                for cmd in cmds:
+                    if isinstance( cmd, str ):
+                        cmd = cmd.encode()
+                    self.serial.write( cmd + CR ) # type ahead
+                    pending.append( cmd )
+                    if len( pending ) >= window:
+                        yield self.receive( pending.popleft() )
+                while pending:
+                    yield self.receive( pending.popleft() )
+            finally:
+                if pending: # stopped early, do not leave responses for the next lease
+                    self.resync()
+
+
+    # receive the echo and the response of a command already sent, return ( cmd, response )
+    def receive( self, cmd ):
+        self.command = cmd.decode()
+        self.serial.read_until( cmd + CRLF )
+        return self.command, strip_prompt( self.serial.read_until( PROMPT ) )
+
+
+    # receive the response of the last command (already received bytes first) up to the prompt,
+    # read what is waiting at once instead of byte by byte like read_until(), e.g. the lines of a scan
+    # the response must not be followed by more output, e.g. of commands typed ahead
+    def receive_bulk( self, received=b'' ):
+        response = bytearray( received )
+        while not response.endswith( PROMPT ):
+            data = self.serial.read( max( 1, self.serial.in_waiting ) )
+            if not data: # timeout
+                break
+            response += data
+        return strip_prompt( bytes( response ) )
+
+
+    def pause( self ):
+        self.execute( 'pause' )
+
+
+    def resume( self ):
+        self.execute( 'resume' )
+
+
+    # set the sweep if start is given, return the actual ( start, stop, points )
+    @transaction
+    def sweep( self, start=None, stop=None, points=None ):
+        if start is not None:
+            args = ' '.join( str( int( arg ) ) for arg in ( start, stop, points ) if arg is not None )
+            self.execute( f'sweep {args}' )
+        start, stop, points = self.execute( 'sweep' )[ 0 ].split()
+        return int( start ), int( stop ), int( points )
+
+
+    # do one scan, return a numpy structured array with fields according outmask
+    # ( 'freq', 'S11r', 'S11i', 'S21r', 'S21i' ), see nanotiny.scan
+    # binary: use binary transfer if the FW supports it, else fall back to ASCII
+    @transaction
+    def scan( self, start, stop, points, outmask=SCAN_FREQ | SCAN_S11, binary=False ):
+        outmask &= ~SCAN_BINARY
+        if binary:
+            result = self.scan_binary( start, stop, points, outmask )
+            if result is not None:
+                return result
+        cmd = f'scan {int( start )} {int( stop )} {int( points )} {outmask}'
+        self.send( cmd )
+        response = self.receive_bulk()
+        self.scan_stream = response
+        lines = response.decode( errors='replace' ).split( CRLF.decode() ) if response else []
+        result = parse_scan_text( lines, outmask, int( points ) )
+        if result is None:
+            raise OSError( f'scan error - "{cmd}"' )
+        return result
+
+
+    # scan with outmask bit 128, None if the FW does not support the binary format
+    @transaction
+    def scan_binary( self, start, stop, points, outmask ):
+        outmask |= SCAN_BINARY
+        points = int( points )
+        self.send( f'scan {int( start )} {int( stop )} {points} {outmask}' )
+        header = self.serial.read( 4 ) # uint16_t mask; uint16_t points;
+        if len( header ) == 4 and struct.unpack( '<HH', header ) == ( outmask, points ):
+            size = points * scan_dtype( outmask ).itemsize
+            data = self.serial.read( size ) # the packed records
+            echo = self.serial.read_until( PROMPT ) # binary data are followed by the prompt only
+            if len( data ) == size and echo == PROMPT:
+                self.scan_stream = data
+                return parse_scan_binary( data, outmask )
+            self.resync()
+            return None
+        # FW ignored the binary bit and sent text, or complained
+        self.scan_stream = self.receive_bulk( header )
+        lines = self.scan_stream.decode( errors='replace' ).split( CRLF.decode() )
+        result = parse_scan_text( lines, outmask & ~SCAN_BINARY, points )
+        if result is None:
+            self.resync()
+        return result
+
+
+    # capture the screen, return the RGB565 pixel as numpy array ( height, width )
+    # rle: use compressed transfer if available
+    # pause: freeze the screen during capture, "resume" is typed ahead
+    # the raw received stream is kept in self.capture_stream
+    @transaction
+    def capture( self, rle=False, pause=True ):
+        size = self.width * self.height
+        if pause:
+            self.pause()
+            completion = PROMPT + b'resume' + CRLF + PROMPT
+        else:
+            completion = PROMPT
+        cmd = b'capture rle' if rle else b'capture'
+        self.command = cmd.decode()
+        self.serial.write( cmd + CR + ( b'resume' + CR if pause else b'' ) ) # request screen capture
+        self.serial.read_until( cmd + CRLF ) # wait for start of capture
+        stream = bytearray( self.serial.read( RLE_HEADER_SIZE ) ) # RLE header or possible error message
+        self.capture_stream = stream
+        try:
+            if b'capture?' in stream: # error message, "capture" cmd not known
+                raise OSError( 'capture error - does the device support the "capture" cmd?' )
+            header = parse_rle_header( stream ) if rle else None
+            if header: # compressed format
+                width, height, psize = header
+                if width != self.width or height != self.height:
+                    raise OSError( f'capture error - wrong requested screen size {self.width} * {self.height}?' )
+
+                def read_rle( size ): # keep the received stream for statistics and recording
+                    result = self.serial.read( size )
+                    if len( result ) != size:
+                        raise OSError( 'capture error - read error' )
+                    stream.extend( result )
+                    return result
+
+                try:
+                    bitmap = decode_rle( read_rle, width, height, psize )
+                except ValueError as error:
+                    raise OSError( f'capture error - {error}' )
+            else: # RGB565 format
+                stream += self.serial.read( 2 * size - len( stream ) )
+                if len( stream ) != 2 * size:
+                    raise OSError( f'capture error - wrong requested screen size {self.width} * {self.height}?' )
+                bitmap = np.frombuffer( bytes( stream ), dtype='>u2' )
+        finally:
+            self.serial.read_until( completion ) # wait for completion
+        return bitmap.reshape( ( self.height, self.width ) )
+
+
+    # tinySA: get a raw scan, return power in dBm as numpy array
+    # rbw: resolution bandwidth / Hz, 0: calculate RBW from scan steps
+    @transaction
+    def scanraw( self, f_low, f_high, points, rbw=0, verbose=None ):
+        if 0 == rbw: # use tinySA values
+            rbw_k = (f_high - f_low) * 7e-6 # RBW / kHz
+        else:
+            rbw_k = rbw / 1e3
+
+        if rbw_k < 3:
+            rbw_k = 3
+        elif rbw_k > 600:
+            rbw_k = 600
+
+        self.execute( f'rbw {int(rbw_k)}' )
+
+        # set timeout accordingly - can be very long - use a heuristic approach
+        timeout = ((f_high - f_low) / 20e3) / (rbw_k ** 2) + points / 500 + 1
+
+        if verbose:
+            sys.stderr.write( f'frequency step: {int( (f_high - f_low) / ( points-1 ) / 1e3 )} kHz\n' )
+            sys.stderr.write( f'RBW: {int(rbw_k)} kHz\n' )
+            sys.stderr.write( f'serial timeout: {timeout} s\n' )
+
+        self.send( f'scanraw {int(f_low)} {int(f_high)} {int(points)}' )
+        self.serial.timeout = timeout * 2
+        try:
+            self.serial.read_until( b'{' ) # start of data
+            raw_data = self.serial.read( 3 * points ) # 'x' + uint16 for each point
+            self.serial.read_until( b'}' + PROMPT )
+        finally:
+            self.serial.timeout = self.timeout
+        self.execute( 'rbw auto' ) # switch to auto RBW for faster tinySA screen update
+        if len( raw_data ) != 3 * points:
+            raise OSError( 'scanraw error - incomplete data' )
+        self.scan_stream = raw_data
+
+        raw_data = np.frombuffer( raw_data, dtype=[ ( 'x', 'u1' ), ( 'value', '<u2' ) ] )[ 'value' ]
+        # tinySA:  SCALE = 128
+        # tinySA4: SCALE = 174
+        SCALE = 128
+        return raw_data / 32 - SCALE # scale 0..4095 -> -128..-0.03 dBm
+
+
+    # read the RTC, return a datetime object
+    @transaction
+    def time( self ):
+        lines = self.execute( 'time' ) # date and time, usage
+        try:
+            return datetime.strptime( lines[ 0 ].strip().replace( '/', '-' ), '%Y-%m-%d %H:%M:%S' )
+        except ( IndexError, ValueError ):
+            raise OSError( 'timesync error - does the device support the "time" cmd?' )
+
+
+    # set the RTC to datetime now
+    @transaction
+    def set_time( self, now ):
+        if self.execute( now.strftime( 'time b 0x%y%m%d 0x%H%M%S' ) ): # any response is an error
+            raise OSError( 'timesync error - does the device support the "time b ..." cmd?' )
@@ -0,0 +1,340 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+'''
+Simulator for the shell of NanoVNA and tinySA on a pseudo terminal.
+The tools connect to the simulator like to a real device, e.g. "nanovna_snp.py -d /dev/pts/3".
+Supported commands: sweep, scan, scan_bin, scanraw, capture [rle], refresh on|off, time,
+pause, resume, rbw, touch, release, vbat, version, info, help.
+The throughput (bytes/s) of the responses and a latency for each command can be set
+to separate transfer-bound and CPU-bound costs of the tools.
+'''
+
+from datetime import datetime, timedelta
+import os
+import pty
+import select
+import struct
+import threading
+import time
+import tty
+
+import numpy as np
+
+from .rle import encode_rle
+from .scan import SCAN_FREQ, SCAN_S11, SCAN_S21, SCAN_BINARY
+
+
+CR = b'\r'
+CRLF = b'\r\n'
+PROMPT = b'ch> '
+
+# device name -> screen width, height, max sweep points
+SIMULATED_DEVICES = {
+    'NanoVNA-H':    ( 320, 240, 101 ),
+    'NanoVNA-H4':   ( 480, 320, 401 ),
+    'tinySA':       ( 320, 240, 290 ),
+    'tinySA Ultra': ( 480, 320, 450 ),
+}
+
+USB_THROUGHPUT = 1000000 # bytes/s, typical for USB CDC full speed
+
+# some RGB565 colors
+BLACK = 0x0000
+GRAY = 0x8410
+YELLOW = 0xFFE0
+CYAN = 0x07FF
+WHITE = 0xFFFF
+
+
+class Simulator:
+    '''
+    Simulated NanoVNA or tinySA, the device is available at self.port after start()
+    device: one of SIMULATED_DEVICES
+    throughput: bytes/s sent to the tool, e.g. 11520 for 115200 baud, None = unlimited
+    latency: delay in s before each command response
+    refresh: interval in s of the screen updates after "refresh on"
+    '''
+
+    def __init__( self, device='NanoVNA-H', throughput=None, latency=0, refresh=0.1, verbose=False ):
+        self.name = device
+        self.width, self.height, self.max_points = SIMULATED_DEVICES[ device ]
+        self.throughput = throughput
+        self.latency = latency
+        self.refresh_interval = refresh
+        self.verbose = verbose
+        self.sweep = [ 50000, 900000000, min( 101, self.max_points ) ]
+        self.time_offset = timedelta( 0 )
+        self.refresh = False
+        self.phase = 0 # moves the trace on each screen update
+        self.screen = np.zeros( ( self.height, self.width ), dtype=np.uint16 )
+        self.draw_screen()
+        self.master, self.slave = pty.openpty()
+        tty.setraw( self.master )
+        tty.setraw( self.slave )
+        self.port = os.ttyname( self.slave )
+        self.next_write = 0 # time when the next byte can be sent
+        self.running = False
+        self.thread = None
+
+
+    def start( self ):
+        self.running = True
+        self.thread = threading.Thread( target=self.run, daemon=True )
+        self.thread.start()
+        return self
+
+
+    def stop( self ):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+        os.close( self.master )
+        os.close( self.slave ) # kept open until now to avoid EIO on the master between two connections
+
+
+    def __enter__( self ):
+        return self.start()
+
+
+    def __exit__( self, *args ):
+        self.stop()
+
+
+    # send data with the configured throughput
+    def write( self, data ):
+        if not self.throughput:
+            os.write( self.master, data )
+            return
+        chunk = max( 64, int( self.throughput / 100 ) ) # ~10 ms per chunk
+        for pos in range( 0, len( data ), chunk ):
+            now = time.perf_counter()
+            if self.next_write > now:
+                time.sleep( self.next_write - now )
+            part = data[ pos : pos + chunk ]
+            os.write( self.master, part )
+            self.next_write = max( now, self.next_write ) + len( part ) / self.throughput
+
+
+    # command loop, runs until stop()
+    def run( self ):
+        line = b''
+        last_refresh = time.perf_counter()
+        while self.running:
+            timeout = self.refresh_interval if self.refresh else 0.1
+            readable, _, _ = select.select( [ self.master ], [], [], timeout )
+            if readable:
+                try:
+                    data = os.read( self.master, 1024 )
+                except OSError:
+                    break
+                for byte in data:
+                    if byte == CR[ 0 ]: # execute the line
+                        self.execute( line )
+                        line = b''
+                    elif byte != CRLF[ 1 ]:
+                        line += bytes( ( byte, ) )
+            if self.refresh and time.perf_counter() - last_refresh >= self.refresh_interval:
+                last_refresh = time.perf_counter()
+                self.update_screen()
+
+
+    # echo the command line, send the response and the prompt
+    def execute( self, line ):
+        if self.verbose:
+            print( f'{self.name}: {line.decode( errors="replace" )}' )
+        if self.latency:
+            time.sleep( self.latency )
+        args = line.decode( errors='replace' ).split()
+        response = b''
+        if args:
+            handler = getattr( self, 'cmd_' + args[ 0 ], None )
+            if handler:
+                response = handler( args[ 1: ] )
+            else:
+                response = args[ 0 ].encode() + b'?' + CRLF
+        self.write( line + CRLF + response + PROMPT )
+
+
+    # format lines of text as response
+    @staticmethod
+    def text( *lines ):
+        return b''.join( line.encode() + CRLF for line in lines )
+
+
+    def cmd_pause( self, args ):
+        return b''
+
+
+    def cmd_resume( self, args ):
+        return b''
+
+
+    def cmd_touch( self, args ):
+        return b''
+
+
+    def cmd_release( self, args ):
+        return b''
+
+
+    def cmd_rbw( self, args ):
+        return b''
+
+
+    def cmd_vbat( self, args ):
+        return self.text( '4100 mV' )
+
+
+    def cmd_version( self, args ):
+        return self.text( f'{self.name} simulator' )
+
+
+    def cmd_info( self, args ):
+        return self.text( f'{self.name} simulator', 'nanotiny-tools' )
+
+
+    def cmd_help( self, args ):
+        commands = sorted( name[ 4: ] for name in dir( self ) if name.startswith( 'cmd_' ) )
+        return self.text( 'Commands: ' + ' '.join( commands ) )
+
+
+    def cmd_sweep( self, args ):
+        if not args:
+            return self.text( '{} {} {}'.format( *self.sweep ) )
+        try:
+            for index, arg in enumerate( args[ :3 ] ):
+                self.sweep[ index ] = int( float( arg ) )
+        except ValueError:
+            return self.text( 'usage: sweep {start(Hz)} [stop(Hz)] [points]' )
+        return b''
+
+
+    def frequencies( self, start, stop, points ):
+        return start + ( stop - start ) * np.arange( points, dtype=np.int64 ) // max( points - 1, 1 )
+
+
+    # S11 of a series resonator and S21 of a band pass, centered in the sweep
+    def s_parameter( self, freq ):
+        f0 = ( freq[ 0 ] + freq[ -1 ] ) / 2 or 1e6
+        detune = freq / f0 - f0 / np.maximum( freq, 1 )
+        z = 50 * ( 0.5 + 20j * detune )
+        s11 = ( z - 50 ) / ( z + 50 )
+        s21 = 1 / ( 1 + 10j * detune ) ** 3
+        return s11, s21
+
+
+    def cmd_scan( self, args, binary=False ):
+        try:
+            start, stop = int( float( args[ 0 ] ) ), int( float( args[ 1 ] ) )
+            points = int( args[ 2 ] ) if len( args ) > 2 else self.sweep[ 2 ]
+            outmask = int( args[ 3 ], 0 ) if len( args ) > 3 else 0
+        except ( IndexError, ValueError ):
+            return self.text( 'usage: scan {start(Hz)} {stop(Hz)} [points] [outmask]' )
+        if points < 1 or points > self.max_points:
+            return self.text( f'sweep points exceeds range 1..{self.max_points}' )
+        if binary:
+            outmask |= SCAN_BINARY
+        freq = self.frequencies( start, stop, points )
+        s11, s21 = self.s_parameter( freq )
+        columns = []
+        if outmask & SCAN_FREQ:
+            columns.append( ( 'freq', '<u4', freq ) )
+        if outmask & SCAN_S11:
+            columns += [ ( 'S11r', '<f4', s11.real ), ( 'S11i', '<f4', s11.imag ) ]
+        if outmask & SCAN_S21:
+            columns += [ ( 'S21r', '<f4', s21.real ), ( 'S21i', '<f4', s21.imag ) ]
+        if not columns:
+            return b''
+        if outmask & SCAN_BINARY:
+            records = np.empty( points, dtype=[ ( name, dtype ) for name, dtype, _ in columns ] )
+            for name, _, values in columns:
+                records[ name ] = values
+            return struct.pack( '<HH', outmask & 0xFFFF, points ) + records.tobytes()
+        formats = [ '%d' if name == 'freq' else '%f' for name, _, _ in columns ]
+        lines = zip( *( [ fmt % value for value in values.tolist() ] for fmt, ( _, _, values ) in zip( formats, columns ) ) )
+        return self.text( *( ' '.join( line ) for line in lines ) )
+
+
+    def cmd_scan_bin( self, args ):
+        return self.cmd_scan( args, binary=True )
+
+
+    # tinySA raw scan: '{' ( 'x' uint16 ) * points '}'
+    def cmd_scanraw( self, args ):
+        try:
+            start, stop, points = int( float( args[ 0 ] ) ), int( float( args[ 1 ] ) ), int( args[ 2 ] )
+        except ( IndexError, ValueError ):
+            return self.text( 'usage: scanraw {start(Hz)} {stop(Hz)} [points]' )
+        freq = self.frequencies( start, stop, points )
+        noise = np.random.default_rng( 0 ).normal( 0, 2, points )
+        dBm = -100 + noise + 80 * np.exp( -( ( freq - ( start + stop ) / 2 ) / ( ( stop - start ) / 50 + 1 ) ) ** 2 )
+        raw = np.empty( points, dtype=[ ( 'x', 'u1' ), ( 'value', '<u2' ) ] )
+        raw[ 'x' ] = ord( 'x' )
+        raw[ 'value' ] = np.clip( ( dBm + 128 ) * 32, 0, 4095 )
+        return b'{' + raw.tobytes() + b'}'
+
+
+    def cmd_capture( self, args ):
+        if args and args[ 0 ] == 'rle':
+            return encode_rle( self.screen )
+        return self.screen.astype( '>u2' ).tobytes()
+
+
+    def cmd_refresh( self, args ):
+        if args and args[ 0 ] in ( 'on', 'off' ):
+            self.refresh = args[ 0 ] == 'on'
+            return b''
+        return self.text( 'usage: refresh on|off' )
+
+
+    def cmd_time( self, args ):
+        if not args:
+            now = datetime.now() + self.time_offset
+            return self.text( now.strftime( '%Y/%m/%d %H:%M:%S' ),
+                'usage: time {[y|m|d|h|min|sec] 0-99} or {b 0xYYMMDD 0xHHMMSS}' )
+        if args[ 0 ] == 'b' and len( args ) == 3:
+            try:
+                device_time = datetime.strptime( args[ 1 ][ 2: ] + args[ 2 ][ 2: ], '%y%m%d%H%M%S' )
+            except ValueError:
+                return self.text( 'time format error' )
+            self.time_offset = device_time - datetime.now()
+            return b''
+        return self.text( 'usage: time {[y|m|d|h|min|sec] 0-99} or {b 0xYYMMDD 0xHHMMSS}' )
+
+
+    # static grid and frame
+    def draw_screen( self ):
+        self.screen[ : ] = BLACK
+        self.screen[ ::self.height // 8, : ] = GRAY
+        self.screen[ :, ::self.width // 10 ] = GRAY
+        self.screen[ -1, : ] = GRAY
+        self.screen[ :, -1 ] = GRAY
+        self.screen[ :12, :self.width // 3 ] = WHITE # marker area
+        self.draw_trace()
+
+
+    # the trace area, changes with self.phase
+    def draw_trace( self ):
+        x = np.arange( 1, self.width - 1 )
+        y = ( self.height / 2 * ( 1 - 0.6 * np.sin( 2 * np.pi * x / self.width * 2 + self.phase ) ) ).astype( int )
+        y = np.clip( y, 13, self.height - 2 )
+        self.screen[ y, x ] = YELLOW
+        self.screen[ np.clip( self.height - y, 13, self.height - 2 ), x ] = CYAN
+
+
+    # remote display: send changed regions as "fill" and "bulk"
+    def update_screen( self ):
+        top = 13 # below the marker area
+        old = self.screen[ top:self.height - 1, 1:self.width - 1 ].copy()
+        self.phase += 0.2
+        self.draw_screen()
+        new = self.screen[ top:self.height - 1, 1:self.width - 1 ]
+        rows = np.flatnonzero( ( old != new ).any( axis=1 ) )
+        if not len( rows ):
+            return
+        y, h = top + rows[ 0 ], rows[ -1 ] - rows[ 0 ] + 1
+        x, w = 1, self.width - 2
+        # clear the area, then send the new content
+        self.write( b'fill' + CRLF + struct.pack( '<HHHH', x, y, w, h ) + struct.pack( '>H', BLACK ) )
+        region = self.screen[ y:y + h, x:x + w ]
+        self.write( b'bulk' + CRLF + struct.pack( '<HHHH', x, y, w, h ) + region.astype( '>u2' ).tobytes() )
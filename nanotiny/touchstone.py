@@ -0,0 +1,189 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+'''
+Format NanoVNA scan results as "touchstone" data lines (rev 1.1)
+s1p: 1-port S-parameter, s2p: 2-port S-parameter, z1p: 1-port normalized Z-parameter
+format_block() formats a whole scan result with one string operation.
+read_touchstone() reads touchstone 1.x files (S or Z parameter as RI, MA or DB) without scikit-rf,
+load_network() uses scikit-rf (if installed) for the other files.
+'''
+
+import os
+import re
+
+import numpy as np
+
+
+Z0 = 50 # nominal impedance
+
+S1P = 's1p'
+S2P = 's2p'
+Z1P = 'z1p'
+
+# one data line: freq and the values of parameter_columns()
+ROW_FORMATS = {
+    S1P: '%.0f %12.9f %12.9f\n',
+    S2P: '%.0f %12.9f %12.9f %12.9f %12.9f  0  0  0  0\n',
+    Z1P: '%.0f %15.9f %15.9f\n',
+}
+
+
+# columns of a scan result as float64 arrays: freq and the values of the data line
+def parameter_columns( fmt, scan_result ):
+    freq = scan_result[ 'freq' ].astype( np.float64 )
+    S11r = scan_result[ 'S11r' ].astype( np.float64 )
+    S11i = scan_result[ 'S11i' ].astype( np.float64 )
+    if fmt == Z1P:
+        # calculate normalized impedance as Rn + jXn = R/Z0 + jX/Z0 according to this doc
+        # https://pa3a.nl/wp-content/uploads/2022/07/Math-for-nanoVNA-S2Z-and-Z2S-Jul-2021.pdf
+        Sr2 = S11r * S11r
+        Si2 = S11i * S11i
+        with np.errstate( divide='ignore', invalid='ignore' ): # S11 = 1 -> inf
+            Denom = ( 1 - S11r ) * ( 1 - S11r ) + Si2
+            Rn = ( 1 - Sr2 - Si2 ) / Denom
+            Xn = ( 2 * S11i ) / Denom
+        return freq, Rn, Xn
+    elif fmt == S2P:
+        if 'S21r' in scan_result.dtype.names:
+            return freq, S11r, S11i, scan_result[ 'S21r' ].astype( np.float64 ), scan_result[ 'S21i' ].astype( np.float64 )
+        zero = np.zeros_like( freq )
+        return freq, S11r, S11i, zero, zero
+    else: # s1p
+        return freq, S11r, S11i
+
+
+# format the data lines of a scan result as one string, each line terminated by '\n'
+# all values are formatted by one '%' operation with the row format repeated for each record
+def format_block( fmt, scan_result ):
+    values = np.column_stack( parameter_columns( fmt, scan_result ) ).ravel().tolist()
+    return ( ROW_FORMATS[ fmt ] * len( scan_result ) ) % tuple( values )
+
+
+# option line: frequency unit Hz, parameter S or Z, format real-imag, reference impedance
+def option_line( fmt ):
+    parameter = 'Z' if fmt == Z1P else 'S'
+    return f'# HZ {parameter} RI R {Z0}'
+
+
+FREQUENCY_UNITS = { 'HZ': 1, 'KHZ': 1e3, 'MHZ': 1e6, 'GHZ': 1e9 }
+DATA_FORMATS = ( 'RI', 'MA', 'DB' )
+PARAMETER_TYPES = ( 'S', 'Z' )
+
+
+class Touchstone:
+    '''
+    Network parameter of a touchstone file, the attributes are named like the ones of skrf.Network:
+    f: frequencies in Hz, s: complex S-parameter ( points, ports, ports ), z0: reference impedance
+    '''
+
+    def __init__( self, name, f, s, z0=Z0 ):
+        self.name = name
+        self.f = f
+        self.s = s
+        self.z0 = z0
+
+
+    def __repr__( self ):
+        ports = self.s.shape[ 1 ]
+        return f'{ports}-Port Touchstone: {self.name!r}, {len( self.f )} points'
+
+
+# parse the option line "# <frequency unit> <parameter> <format> R <n>", defaults: GHZ S MA R 50
+# return ( frequency factor, parameter, format, reference impedance )
+def parse_option_line( line ):
+    unit, parameter, data_format, z0 = 1e9, 'S', 'MA', float( Z0 )
+    tokens = line[ 1: ].upper().split()
+    while tokens:
+        token = tokens.pop( 0 )
+        if token in FREQUENCY_UNITS:
+            unit = FREQUENCY_UNITS[ token ]
+        elif token in PARAMETER_TYPES:
+            parameter = token
+        elif token in DATA_FORMATS:
+            data_format = token
+        elif token == 'R' and tokens:
+            z0 = float( tokens.pop( 0 ) )
+        else: # Y, H, G parameter or unknown
+            raise ValueError( f'unsupported option {token}' )
+    return unit, parameter, data_format, z0
+
+
+# parse the text of a touchstone 1.x file with ports ports, name: file name for the messages
+# raise ValueError if the file cannot be parsed, e.g. touchstone 2.0 keywords
+def parse_touchstone( text, ports, name='' ):
+    options = None
+    data = []
+    for line in text.splitlines():
+        line = line.split( '!', 1 )[ 0 ].strip() # remove comments
+        if not line:
+            continue
+        if line[ 0 ] == '#':
+            if options is None: # only the 1st option line is used
+                try:
+                    options = parse_option_line( line )
+                except ValueError as error:
+                    raise ValueError( f'{name}: {error}' )
+        elif line[ 0 ] == '[':
+            raise ValueError( f'{name}: touchstone 2.0 keyword {line.split()[ 0 ]}' )
+        else:
+            data.append( line )
+    unit, parameter, data_format, z0 = options or parse_option_line( '#' )
+    try:
+        values = np.array( ' '.join( data ).split(), dtype=np.float64 ) # all numbers at once
+    except ValueError as error:
+        raise ValueError( f'{name}: {error}' )
+    columns = 1 + 2 * ports * ports
+    if values.size % columns:
+        raise ValueError( f'{name}: {values.size} values do not match {ports} ports' )
+    values = values.reshape( ( -1, columns ) )
+    f = values[ :, 0 ] * unit
+    a, b = values[ :, 1::2 ], values[ :, 2::2 ]
+    if data_format == 'RI':
+        p = a + 1j * b
+    elif data_format == 'MA':
+        p = a * np.exp( 1j * np.radians( b ) )
+    else: # DB
+        p = 10 ** ( a / 20 ) * np.exp( 1j * np.radians( b ) )
+    p = p.reshape( ( -1, ports, ports ) )
+    if ports == 2: # 2-port order is N11 N21 N12 N22
+        p = p.transpose( ( 0, 2, 1 ) )
+    if parameter == 'Z' and ports == 1: # normalized Z -> S
+        with np.errstate( divide='ignore', invalid='ignore' ):
+            p = ( p - 1 ) / ( p + 1 )
+    elif parameter == 'Z': # S = ( Zn - 1 ) * ( Zn + 1 )^-1
+        identity = np.identity( ports )
+        p = np.linalg.solve( ( p + identity ).transpose( ( 0, 2, 1 ) ), ( p - identity ).transpose( ( 0, 2, 1 ) ) ).transpose( ( 0, 2, 1 ) )
+    return Touchstone( os.path.splitext( os.path.basename( name ) )[ 0 ], f, p, z0 )
+
+
+# read a touchstone 1.x file, the number of ports is taken from the extension, e.g. ".s2p"
+def read_touchstone( filename ):
+    match = re.fullmatch( r'\.[sz](\d+)p', os.path.splitext( filename )[ 1 ].lower() )
+    if not match:
+        raise ValueError( f'{filename}: unknown number of ports' )
+    with open( filename, encoding='utf-8', errors='replace' ) as infile:
+        text = infile.read()
+    return parse_touchstone( text, int( match.group( 1 ) ), filename )
+
+
+# read the touchstone file with the fast numpy reader,
+# files it cannot parse (e.g. touchstone 2.0) are read by scikit-rf if installed
+def load_network( filename ):
+    try:
+        return read_touchstone( filename )
+    except ValueError as error:
+        try:
+            from skrf import Network # import only if needed, takes some time
+        except ImportError:
+            raise error
+        try:
+            return Network( filename )
+        except Exception: # scikit-rf cannot read it either, report the own error
+            raise error
+
+
+# port indices ( i, j ) of the S-parameter 'Sij', e.g. 'S21' -> ( 1, 0 ), raise ValueError if not valid
+def parameter_ports( parameter ):
+    if not ( len( parameter ) == 3 and parameter[ 0 ].upper() == 'S' and parameter[ 1: ].isdigit() ):
+        raise ValueError( f'unknown parameter {parameter}' )
+    return int( parameter[ 1 ] ) - 1, int( parameter[ 2 ] ) - 1
@@ -0,0 +1,201 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+'''
+Serve the mirrored screen via HTTP to many viewers, e.g. browsers on other desks:
+/            HTML page with the live screen, a click is sent as touch
+/stream      MJPEG stream (multipart/x-mixed-replace) of the changed screens
+/frame.jpg   the current screen as JPEG
+/frame.png   the current screen as PNG
+/touch       POST x=X&y=Y (screen coordinates) touches the screen
+Each changed screen is encoded once by ScreenFrames.publish() and shared by all viewers,
+the PNG is encoded on the first request of a screen.
+'''
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import threading
+import urllib.parse
+
+from PIL import Image
+
+
+JPEG_QUALITY = 85
+BOUNDARY = 'frame'
+
+PAGE = '''<!DOCTYPE html>
+<html>
+<head><meta charset="utf-8"><title>{name}</title></head>
+<body style="margin:0;background:#000">
+<img id="screen" src="/stream" style="cursor:crosshair" alt="{name}">
+<script>
+const screen = document.getElementById( 'screen' );
+screen.addEventListener( 'click', function( event ) {{
+    const x = Math.floor( event.offsetX * {width} / screen.clientWidth );
+    const y = Math.floor( event.offsetY * {height} / screen.clientHeight );
+    fetch( '/touch', {{ method: 'POST', body: new URLSearchParams( {{ x: x, y: y }} ) }} );
+}} );
+</script>
+</body>
+</html>
+'''
+
+
+class ScreenFrames:
+    '''
+    The latest screen, published by the display loop and waited for by the viewers.
+    version counts the published screens, the viewers wait for a newer version.
+    '''
+
+    def __init__( self ):
+        self.condition = threading.Condition()
+        self.version = 0
+        self.rgba = None
+        self.jpeg = None
+        self.closed = False
+        self.png_lock = threading.Lock()
+        self.png_version = 0
+        self.png = None
+
+
+    # publish a new screen, uint8 array ( height, width, 4 ) in RGBA order, not changed afterwards
+    def publish( self, rgba ):
+        buffer = io.BytesIO()
+        Image.fromarray( rgba, 'RGBA' ).convert( 'RGB' ).save( buffer, 'JPEG', quality=JPEG_QUALITY )
+        with self.condition:
+            self.version += 1
+            self.rgba = rgba
+            self.jpeg = buffer.getvalue()
+            self.condition.notify_all()
+
+
+    # wait until a version newer than version is published or timeout
+    # return ( version, jpeg ), version is None after close()
+    def wait( self, version, timeout=None ):
+        with self.condition:
+            self.condition.wait_for( lambda: self.closed or self.version > version, timeout )
+            if self.closed:
+                return None, None
+            return self.version, self.jpeg
+
+
+    # the current screen as PNG, encoded once per version
+    def current_png( self ):
+        with self.png_lock:
+            with self.condition:
+                version, rgba = self.version, self.rgba
+            if rgba is None:
+                return None
+            if version != self.png_version:
+                buffer = io.BytesIO()
+                Image.fromarray( rgba, 'RGBA' ).save( buffer, 'PNG' )
+                self.png_version, self.png = version, buffer.getvalue()
+            return self.png
+
+
+    # wake up and stop all viewers
+    def close( self ):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class ViewerHandler( BaseHTTPRequestHandler ):
+    '''
+    Request handler of ViewerServer
+    '''
+
+    def log_message( self, format, *args ): # quiet, the server runs beside the display loop
+        if self.server.verbose:
+            super().log_message( format, *args )
+
+
+    def send_data( self, content_type, data ):
+        self.send_response( 200 )
+        self.send_header( 'Content-Type', content_type )
+        self.send_header( 'Content-Length', str( len( data ) ) )
+        self.send_header( 'Cache-Control', 'no-cache' )
+        self.end_headers()
+        self.wfile.write( data )
+
+
+    def do_GET( self ):
+        frames = self.server.frames
+        path = urllib.parse.urlsplit( self.path ).path
+        if path == '/':
+            page = PAGE.format( name=self.server.name, width=self.server.width, height=self.server.height )
+            self.send_data( 'text/html; charset=utf-8', page.encode() )
+        elif path == '/stream':
+            self.stream()
+        elif path == '/frame.jpg':
+            version, jpeg = frames.wait( 0, 1 )
+            if jpeg is None:
+                self.send_error( 503, 'no screen yet' )
+            else:
+                self.send_data( 'image/jpeg', jpeg )
+        elif path == '/frame.png':
+            png = frames.current_png()
+            if png is None:
+                self.send_error( 503, 'no screen yet' )
+            else:
+                self.send_data( 'image/png', png )
+        else:
+            self.send_error( 404 )
+
+
+    # send each new screen as one part of the MJPEG stream until the viewer disconnects
+    def stream( self ):
+        frames = self.server.frames
+        self.send_response( 200 )
+        self.send_header( 'Content-Type', f'multipart/x-mixed-replace; boundary={BOUNDARY}' )
+        self.send_header( 'Cache-Control', 'no-cache' )
+        self.end_headers()
+        version = 0
+        try:
+            while True:
+                version, jpeg = frames.wait( version )
+                if version is None: # server stopped
+                    break
+                self.wfile.write( f'--{BOUNDARY}\r\nContent-Type: image/jpeg\r\nContent-Length: {len( jpeg )}\r\n\r\n'.encode() )
+                self.wfile.write( jpeg )
+                self.wfile.write( b'\r\n' )
+                self.wfile.flush()
+        except ( BrokenPipeError, ConnectionResetError ):
+            pass # viewer closed
+
+
+    def do_POST( self ):
+        if urllib.parse.urlsplit( self.path ).path != '/touch':
+            self.send_error( 404 )
+            return
+        size = int( self.headers.get( 'Content-Length', 0 ) )
+        query = urllib.parse.parse_qs( self.rfile.read( size ).decode( errors='replace' ) )
+        try:
+            x, y = int( query[ 'x' ][ 0 ] ), int( query[ 'y' ][ 0 ] )
+        except ( KeyError, ValueError ):
+            self.send_error( 400, 'x and y expected' )
+            return
+        if not ( 0 <= x < self.server.width and 0 <= y < self.server.height ):
+            self.send_error( 400, 'outside the screen' )
+            return
+        if self.server.touch:
+            self.server.touch( x, y )
+        self.send_response( 204 )
+        self.end_headers()
+
+
+class ViewerServer( ThreadingHTTPServer ):
+    '''
+    HTTP server for the screen frames of a width * height device screen at address ( host, port ),
+    touch( x, y ) is called for a touch in screen coordinates, None ignores the touches
+    '''
+
+    daemon_threads = True
+
+    def __init__( self, address, frames, name, width, height, touch=None, verbose=False ):
+        self.frames = frames
+        self.name = name
+        self.width = width
+        self.height = height
+        self.touch = touch
+        self.verbose = verbose
+        super().__init__( address, ViewerHandler )
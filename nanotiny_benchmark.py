@@ -0,0 +1,238 @@
+#!/usr/bin/python
+
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+'''
+Benchmark the stages of the tools against the simulator or a real device:
+port open, command round-trip, payload transfer, decode, format or image conversion and file write.
+The results are written as JSON to track regressions between releases.
+'''
+
+import argparse
+from datetime import datetime
+import io
+import json
+import os
+import platform
+import statistics
+import struct
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+from nanotiny import Session
+from nanotiny.rgb565 import RGBA, rgb565_to_rgba
+from nanotiny.rle import RLE_HEADER_SIZE, parse_rle_header, decode_rle
+from nanotiny.scan import SCAN_BINARY, scan_dtype, parse_scan_binary, parse_scan_text
+from nanotiny.simulator import Simulator, SIMULATED_DEVICES, USB_THROUGHPUT
+from nanotiny.touchstone import S2P, format_block, option_line
+
+
+TOOLS = ( 'snp', 'capture', 'scanraw', 'time' )
+
+
+# measure the duration of a function call, return ( seconds, result )
+def timed( function, *args, **kwargs ):
+    t_start = time.perf_counter()
+    result = function( *args, **kwargs )
+    return time.perf_counter() - t_start, result
+
+
+# session open (port open + resync) and command round-trip with an empty command
+def bench_session( device, baudrate=9600 ):
+    t_open, session = timed( Session, device, baudrate=baudrate, timeout=10 )
+    t_roundtrip, _ = timed( session.execute, '' )
+    return session, { 'port_open': t_open, 'roundtrip': t_roundtrip }
+
+
+# nanovna_snp.py: scan, parse, format and write touchstone
+def bench_snp( session, points, binary, tmpdir ):
+    start, stop, _ = session.sweep()
+    outmask = 7 # freq, S11, S21
+    stages = {}
+    if binary:
+        t_scan, scan = timed( session.scan_binary, start, stop, points, outmask )
+        # the FW may ignore the binary bit and send text, then the stream does not have the record size
+        if scan is None or len( session.scan_stream ) != points * scan_dtype( outmask | SCAN_BINARY ).itemsize:
+            raise OSError( 'no binary scan support' )
+    else:
+        t_scan, scan = timed( session.scan, start, stop, points, outmask )
+    payload = bytes( session.scan_stream )
+    stages[ 'bytes' ] = len( payload )
+    # decode again from memory to separate transfer and decode
+    if binary:
+        stages[ 'decode' ], _ = timed( parse_scan_binary, payload, outmask )
+    else:
+        stages[ 'decode' ], _ = timed( parse_scan_text, payload.decode().split( '\r\n' ), outmask, points )
+    stages[ 'transfer' ] = t_scan - stages[ 'decode' ]
+    stages[ 'format' ], data = timed( format_block, S2P, scan )
+
+    def write():
+        with open( os.path.join( tmpdir, 'benchmark.s2p' ), 'w' ) as outfile:
+            outfile.write( option_line( S2P ) + '\n' + data )
+
+    stages[ 'write' ], _ = timed( write )
+    return stages
+
+
+# nanotiny_capture.py: capture, decode, convert to RGBA image and save as PNG
+def bench_capture( session, rle, tmpdir ):
+    stages = {}
+    t_capture, rgb565 = timed( session.capture, rle=rle )
+    stream = bytes( session.capture_stream )
+    stages[ 'bytes' ] = len( stream )
+    header = parse_rle_header( stream[ :RLE_HEADER_SIZE ] ) if rle else None
+    if header: # decode again from memory to separate transfer and decode
+        width, height, psize = header
+        stages[ 'decode' ], _ = timed( decode_rle, io.BytesIO( stream[ RLE_HEADER_SIZE: ] ).read, width, height, psize )
+    else:
+        stages[ 'decode' ], _ = timed( np.frombuffer, stream, dtype='>u2' )
+    stages[ 'transfer' ] = t_capture - stages[ 'decode' ]
+
+    def convert(): # same conversion as nanotiny_capture.py
+        rgba8888 = rgb565_to_rgba( rgb565, RGBA )
+        return Image.frombuffer( 'RGBA', ( session.width, session.height ), rgba8888, 'raw', 'RGBA', 0, 1 )
+
+    stages[ 'convert' ], image = timed( convert )
+    stages[ 'write' ], _ = timed( image.save, os.path.join( tmpdir, 'benchmark.png' ) )
+    return stages
+
+
+# tinysa_scanraw.py: raw scan (incl. RBW setting), unpack and scale to dBm
+def bench_scanraw( session, points ):
+    stages = {}
+    start, stop = 0, 350000000
+    t_scanraw, _ = timed( session.scanraw, start, stop, points )
+    payload = bytes( session.scan_stream )
+    stages[ 'bytes' ] = len( payload )
+
+    def decode_struct(): # previous decoder of tinysa_scanraw.py
+        return np.array( struct.unpack( '<' + 'xH' * points, payload ), dtype=np.uint16 ) / 32 - 128
+
+    def decode_numpy(): # decoder of nanotiny.Session.scanraw()
+        return np.frombuffer( payload, dtype=[ ( 'x', 'u1' ), ( 'value', '<u2' ) ] )[ 'value' ] / 32 - 128
+
+    stages[ 'decode_struct' ], _ = timed( decode_struct )
+    stages[ 'decode' ], _ = timed( decode_numpy )
+    stages[ 'transfer' ] = t_scanraw - stages[ 'decode' ]
+    return stages
+
+
+# nanovna_time.py: read the RTC
+def bench_time( session ):
+    t_time, _ = timed( session.time )
+    return { 'transfer': t_time }
+
+
+# run all benchmarks for one device, each one repeat times, return list of results
+def run_device( device, screen, options, tmpdir ):
+    results = []
+
+    def run( tool, benchmark, **parameter ):
+        samples = []
+        result = { 'tool': tool, 'device': screen[ 0 ], 'width': screen[ 1 ], 'height': screen[ 2 ] }
+        result.update( parameter )
+        result.pop( 'tmpdir', None )
+        try:
+            for _ in range( options.repeat ):
+                session, stages = bench_session( device, options.baudrate or 9600 )
+                session.name, session.width, session.height = screen
+                with session:
+                    stages.update( benchmark( session, **parameter ) )
+                samples.append( stages )
+        except OSError as error:
+            result[ 'error' ] = str( error )
+            if options.verbose:
+                sys.stderr.write( json.dumps( result ) + '\n' )
+            results.append( result )
+            return
+        # median of each stage
+        for stage in samples[ 0 ]:
+            result[ stage ] = statistics.median( sample[ stage ] for sample in samples )
+        result[ 'total' ] = sum( value for stage, value in result.items()
+            if stage in ( 'port_open', 'roundtrip', 'transfer', 'decode', 'format', 'convert', 'write' ) )
+        if options.verbose:
+            sys.stderr.write( json.dumps( result ) + '\n' )
+        results.append( result )
+
+    if 'snp' in options.tools:
+        for points in options.points:
+            for binary in ( False, True ):
+                run( 'nanovna_snp', bench_snp, points=points, binary=binary, tmpdir=tmpdir )
+    if 'capture' in options.tools:
+        for rle in ( False, True ):
+            run( 'nanotiny_capture', bench_capture, rle=rle, tmpdir=tmpdir )
+    if 'scanraw' in options.tools:
+        for points in options.points:
+            run( 'tinysa_scanraw', bench_scanraw, points=points )
+    if 'time' in options.tools:
+        run( 'nanovna_time', bench_time )
+    return results
+
+
+# construct the argument parser and parse the arguments
+ap = argparse.ArgumentParser( description='Benchmark the transfer, parse and encode stages of the tools' )
+ap.add_argument( '-d', '--device', dest = 'device',
+    help = 'benchmark the real device DEVICE instead of the simulator' )
+ap.add_argument( '-s', '--screen', nargs = 3, metavar = ( 'NAME', 'WIDTH', 'HEIGHT' ),
+    help = 'screen of the real device, default = NanoVNA-H 320 240' )
+ap.add_argument( '--simulate', nargs = '+', choices = SIMULATED_DEVICES.keys(), default = [ 'NanoVNA-H', 'NanoVNA-H4' ],
+    help = 'simulated devices, default = NanoVNA-H NanoVNA-H4' )
+speed = ap.add_mutually_exclusive_group()
+speed.add_argument( '-b', '--baudrate', type = int,
+    help = 'simulate a serial connection with BAUDRATE, resp. open the real device with BAUDRATE' )
+speed.add_argument( '-u', '--usb', action = 'store_true',
+    help = f'simulate USB CDC with {USB_THROUGHPUT} bytes/s' )
+ap.add_argument( '-l', '--latency', type = float, default = 0,
+    help = 'simulated command latency in s, default = 0' )
+ap.add_argument( '-p', '--points', type = int, nargs = '+', default = [ 101 ],
+    help = 'scan points, default = 101' )
+ap.add_argument( '-t', '--tools', nargs = '+', choices = TOOLS, default = list( TOOLS ),
+    help = 'benchmark only these tools' )
+ap.add_argument( '-n', '--repeat', type = int, default = 5,
+    help = 'repeat each measurement and report the median, default = 5' )
+ap.add_argument( '-o', '--out',
+    help = 'write the JSON results into file OUT, default = stdout' )
+ap.add_argument( '-v', '--verbose', action = 'store_true',
+    help = 'show each result on stderr' )
+
+options = ap.parse_args()
+
+report = {
+    'date': datetime.now().isoformat( timespec='seconds' ),
+    'python': platform.python_version(),
+    'numpy': np.__version__,
+    'repeat': options.repeat,
+    'results': [],
+}
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    if options.device:
+        screen = options.screen or ( 'NanoVNA-H', 320, 240 )
+        screen = ( screen[ 0 ], int( screen[ 1 ] ), int( screen[ 2 ] ) )
+        report[ 'target' ] = options.device
+        report[ 'results' ] = run_device( options.device, screen, options, tmpdir )
+    else:
+        if options.baudrate:
+            throughput = options.baudrate / 10
+        elif options.usb:
+            throughput = USB_THROUGHPUT
+        else:
+            throughput = None
+        report[ 'target' ] = 'simulator'
+        report[ 'throughput' ] = throughput
+        report[ 'latency' ] = options.latency
+        for name in options.simulate:
+            with Simulator( name, throughput, options.latency ) as simulator:
+                screen = ( name, simulator.width, simulator.height )
+                report[ 'results' ] += run_device( simulator.port, screen, options, tmpdir )
+
+output = json.dumps( report, indent=2 )
+if options.out:
+    with open( options.out, 'w' ) as outfile:
+        outfile.write( output + '\n' )
+else:
+    print( output )
@@ -0,0 +1,41 @@
+#!/usr/bin/python
+
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+'''
+Device broker for NanoVNA or tinySA: open the serial port once, keep it synced to the prompt
+and share it via a Unix socket between the tools started with option "--broker",
+e.g. nanotiny_remote.py for monitoring while nanovna_snp.py takes sweeps.
+'''
+
+import argparse
+import sys
+
+from nanotiny.broker import Broker, default_socket
+
+
+# construct the argument parser and parse the arguments
+ap = argparse.ArgumentParser( description='Share a NanoVNA or tinySA between many tools' )
+ap.add_argument( '-d', '--device', dest = 'device',
+    help = 'connect to device' )
+ap.add_argument( '-b', '--baudrate', type = int, default = 9600,
+    help = 'serial baud rate, default = 9600 (ignored by USB CDC)' )
+ap.add_argument( '-s', '--socket',
+    help = f'listen on the Unix socket SOCKET, default = {default_socket()}' )
+ap.add_argument( '-v', '--verbose', action = 'store_true',
+    help = 'show connecting and disconnecting clients' )
+
+options = ap.parse_args()
+
+try:
+    broker = Broker( options.device, options.socket, options.baudrate, options.verbose )
+except OSError as error:
+    print( error )
+    sys.exit()
+
+print( f'{broker.serial.port} at {broker.path}' )
+sys.stdout.flush()
+try:
+    broker.serve_forever() # stop with ^C
+except KeyboardInterrupt:
+    pass
@@ -8,39 +8,51 @@ connect via USB serial, issue the command 'capture'
 and fetch 320x240 or 480x320 rgb565 pixel.
 These pixels are converted to rgb8888 values
 that are stored as an image (e.g. png)
+Burst mode: capture many screens with one connection, e.g. as time-lapse
 '''
 
 import argparse
+import collections
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime
-import serial
-from serial.tools import list_ports
-import struct
+import hashlib
+import io
+import os
 import sys
-import numpy
+import threading
+import time
 from PIL import Image
 
-
-# ChibiOS/RT Virtual COM Port
-VID = 0x0483 #1155
-PID = 0x5740 #22336
-
-# Get nanovna device automatically
-def getdevice() -> str:
-    device_list = list_ports.comports()
-    for device in device_list:
-        if device.vid == VID and device.pid == PID:
-            return device
-    print( 'no device found on USB' )
-    sys.exit()
-
-
-def get_rle_bytes( size ):
-    result = nano_tiny.read( size )
-    if len( result ) != size:
-        print( 'read error' )
-        echo = nano_tiny.read_until(prompt + b'resume' + crlf + prompt) # wait for completion
-        sys.exit()
-    return result
+from nanotiny import Session, getdevice, getdevices, finddevice, detect_device, device_id, device_filename
+from nanotiny.broker import add_broker_arguments, broker_socket
+from nanotiny.rgb565 import RGBA, rgb565_to_rgba
+from nanotiny.rle import RLE_HEADER_SIZE, parse_rle_header, decode_rle, decode_rle_reference
+
+
+# decode recorded RLE streams with both decoders and compare the results
+def check_rle( filenames ):
+    ok = True
+    for filename in filenames:
+        with open( filename, 'rb' ) as rle_file:
+            stream = rle_file.read()
+        header = parse_rle_header( stream[ :RLE_HEADER_SIZE ] )
+        if not header:
+            print( f'{filename}: no RLE stream' )
+            ok = False
+            continue
+        hd_width, hd_height, psize = header
+        t_start = time.perf_counter()
+        fast = decode_rle( io.BytesIO( stream[ RLE_HEADER_SIZE: ] ).read, hd_width, hd_height, psize )
+        t_fast = time.perf_counter() - t_start
+        t_start = time.perf_counter()
+        reference = decode_rle_reference( io.BytesIO( stream[ RLE_HEADER_SIZE: ] ).read, hd_width, hd_height, psize )
+        t_reference = time.perf_counter() - t_start
+        identical = fast.tobytes() == reference
+        ok = ok and identical
+        print( f'{filename}: {hd_width} * {hd_height}, {len( stream )} bytes, '
+            f'decode {1e3 * t_fast:.1f} ms (reference {1e3 * t_reference:.1f} ms), '
+            f'{"identical" if identical else "MISMATCH"}' )
+    return ok
 
 
 # construct the argument parser and parse the arguments
@@ -53,6 +65,9 @@ ap.add_argument( '-b', '--baudrate', dest = 'baudrate',
     help = 'set serial baudrate' )
 ap.add_argument( '-d', '--device', dest = 'device',
     help = 'connect to serial device' )
+add_broker_arguments( ap )
+ap.add_argument( '-a', '--all', action = 'store_true',
+    help = 'capture all devices on USB concurrently, the USB serial number is added to the file names' )
 typ = ap.add_mutually_exclusive_group()
 typ.add_argument( '-n', '--nanovna', action = 'store_true',
     help = 'use with NanoVNA-H (default)' )
@@ -74,237 +89,275 @@ ap.add_argument( "-s", "--scale",
     help="scale image", type=int, choices=range(1, 11), default=1 )
 ap.add_argument( '-v', '--verbose', action = 'store_true',
     help='verbose the communication progress' )
+ap.add_argument( '--record', metavar = 'FILE',
+    help='save the received raw capture stream into FILE' )
+ap.add_argument( '--check-rle', metavar = 'FILE', nargs = '+',
+    help='decode recorded RLE streams with the fast and the reference decoder, compare and exit' )
+ap.add_argument( '-c', '--count', type = int, default = 1,
+    help = 'burst mode: capture COUNT screens (0 = until ^C), save only changed screens as OUT_0001.png, ...' )
+ap.add_argument( '--interval', type = float, default = 0,
+    help = 'burst mode: time between the captures in seconds, default = 0 (back-to-back)' )
+ap.add_argument( '--apng', action = 'store_true',
+    help = 'burst mode: save all changed screens as one animated PNG, not with -c 0' )
 
 options = ap.parse_args()
-outfile = options.out
-if options.device:
-    device = None
-    nano_tiny_device = options.device
-else:
-    device = getdevice()
-    nano_tiny_device = device.device
-
-# The size of the screen (default are 2.8" devices)
-width = 320
-height = 240
-
-#scale = float( options.scale ) # default = 1
-
-detect_device = ''
-
-# set by option
-if options.tinysa:
-    detect_device = ' (selected by option)'
-    devicename = 'tinySA'
-elif options.ultra:
-    detect_device = ' (selected by option)'
-    devicename = 'tinySA Ultra'
-    width = 480
-    height = 320
-elif options.nanovna:
-    detect_device = ' (selected by option)'
-    devicename = 'NanoVNA-H'
-elif options.h4:
-    detect_device = ' (selected by option)'
-    devicename = 'NanoVNA-H4'
-    width = 480
-    height = 320
-elif options.tinypfa:
-    detect_device = ' (selected by option)'
-    devicename = 'tinyPFA'
-    width = 480
-    height = 320
-
-# get it from USB descriptor (supported by FW from DiSlord or Erik > 2022)
-elif device and 'tinySA4' in device.description:
-    detect_device = ' detected'
-    devicename = 'tinySA Ultra'
-    width = 480
-    height = 320
-elif device and 'tinySA' in device.description:
-    detect_device = ' detected'
-    devicename = 'tinySA'
-elif device and 'NanoVNA-H4' in device.description:
-    detect_device = ' detected'
-    devicename = 'NanoVNA-H4'
-    width = 480
-    height = 320
-elif device and 'NanoVNA-H' in device.description:
-    detect_device = ' detected'
-    devicename = 'NanoVNA-H'
-elif device and 'tinyPFA' in device.description:
-    detect_device = ' detected'
-    devicename = 'tinyPFA'
-    width = 480
-    height = 320
-
-# fall back to default name
-else:
-    detect_device = ' (default device)'
-    devicename = 'NanoVNA-H'
-
-if options.verbose:
-    print( f'{devicename}{detect_device} at {nano_tiny_device}')
-    print( f'screen size: {width} * {height}')
+broker = broker_socket( options )
+if options.all and broker is not None:
+    ap.error( 'argument --broker/--broker-socket: not allowed with argument -a/--all' )
+if options.count < 0 or options.interval < 0:
+    ap.error( 'argument --count, --interval: must not be negative' )
+burst = options.count != 1
+if burst and options.record:
+    ap.error( 'argument --record: not allowed in burst mode' )
+if options.apng and not options.count: # all screens are kept in memory until the end
+    ap.error( 'argument --apng: not allowed with --count 0' )
+
+if options.check_rle:
+    sys.exit( 0 if check_rle( options.check_rle ) else 1 )
+
+# name and screen size of the device, selected by option, detected or default
+def select_device( device ):
+    # The size of the screen (default are 2.8" devices)
+    width = 320
+    height = 240
+
+    # set by option
+    if options.tinysa:
+        detect_device_text = ' (selected by option)'
+        devicename = 'tinySA'
+    elif options.ultra:
+        detect_device_text = ' (selected by option)'
+        devicename = 'tinySA Ultra'
+        width = 480
+        height = 320
+    elif options.nanovna:
+        detect_device_text = ' (selected by option)'
+        devicename = 'NanoVNA-H'
+    elif options.h4:
+        detect_device_text = ' (selected by option)'
+        devicename = 'NanoVNA-H4'
+        width = 480
+        height = 320
+    elif options.tinypfa:
+        detect_device_text = ' (selected by option)'
+        devicename = 'tinyPFA'
+        width = 480
+        height = 320
+
+    # get it from USB descriptor (supported by FW from DiSlord or Erik > 2022)
+    elif detect_device( device ):
+        detect_device_text = ' detected'
+        devicename, width, height = detect_device( device )
+
+    # fall back to default name
+    else:
+        detect_device_text = ' (default device)'
+        devicename = 'NanoVNA-H'
 
-# NanoVNA sends captured image as 16 bit RGB565 pixel
-size = width * height
+    return devicename, width, height, detect_device_text
 
-crlf = b'\r\n'
-prompt = b'ch> '
 
-# do the communication
-if(options.baudrate!=None):
-  baudrate=int(options.baudrate)
-  stimeout=int(size*2*2/baudrate*10)
-else:
-  baudrate=9600
-  stimeout=5
+# open the connection to the device and set the screen size, use as context manager
+def open_session( nano_tiny_device, device ):
+    devicename, width, height, detect_device_text = select_device( device )
 
-with serial.Serial( nano_tiny_device, baudrate=baudrate, timeout=1 ) as nano_tiny: # open serial connection
-    if options.verbose:
-        print( 'pause screen update' )
-    nano_tiny.write( b'\rpause\r' )  # stop screen update
-    echo = nano_tiny.read_until( b'pause' + crlf + prompt ) # wait for completion
+    # NanoVNA sends captured image as 16 bit RGB565 pixel
+    size = width * height
 
-    if options.verbose:
-        print( 'start capturing' )
-    if options.rle:
-        capture_cmd = b'capture rle'
+    # do the communication
+    if(options.baudrate!=None):
+      baudrate=int(options.baudrate)
+      stimeout=int(size*2*2/baudrate*10)
     else:
-        capture_cmd = b'capture'
-    nano_tiny.write( capture_cmd + b'\rresume\r' )  # request screen capture, type ahead "resume"
-    echo = nano_tiny.read_until( capture_cmd + crlf ) # wait for start of capture
-
-    bytestream = nano_tiny.read( 10 ) # size of RLE header or possible error message
+      baudrate=9600
+      stimeout=5
+
+    nano_tiny = Session( nano_tiny_device, baudrate=baudrate, timeout=stimeout, broker=broker ) # open serial connection
+    if broker is not None and detect_device_text == ' (default device)': # the broker knows the device
+        detect_device_text = ' (from broker)'
+        devicename, width, height = nano_tiny.name, nano_tiny.width, nano_tiny.height
+        nano_tiny_device = nano_tiny.device
+    nano_tiny.name, nano_tiny.width, nano_tiny.height = devicename, width, height
     if options.verbose:
-        print( f'  {bytestream}' )
-    if b'capture?' in bytestream: # error message, "capture" cmd not known
-        bytestream += nano_tiny.read_until( crlf + prompt ) # wait for completion
-        print( f'capture error ({bytestream}) - does the device support the "capture" cmd?' )
-        sys.exit()
-
-    if options.rle: # is the RLE format supported?
-        if options.verbose:
-            print( 'check RLE header:' )
-        magic, hd_width, hd_height, bpp, compression, psize = struct.unpack('<HHHBBH', bytestream)
-        options.rle = options.rle and magic == 0x4d42 and bpp == 8 and compression == 1
-
-    if options.verbose:
-        if options.rle:
-            print( f'  magic: {hex(magic)}, width: {hd_width}, height: {hd_height}, bpp: {bpp}, compression: {compression}, psize: {psize}' )
-
-    if options.rle:
-
-        if hd_width != width or hd_height != height:
-            print( f'capture error - wrong requested screen size {width} * {height}?' )
-            echo = nano_tiny.read_until(prompt + b'resume' + crlf + prompt) # wait for completion
-            sys.exit()
-
-        if options.verbose:
-            print( 'use compressed RLE format' )
-
-        stimeout = stimeout / height
-        if stimeout < 1:
-            stimeout = 1
-        nano_tiny.timeout=stimeout
+        print( f'{devicename}{detect_device_text} at {nano_tiny_device}')
+        print( f'screen size: {width} * {height}')
+        print('download timeout {0:0.1f} s'.format(stimeout))
+    return nano_tiny
+
+
+# convert the RGB565 pixel ( height, width ) into an image, optionally inverted and scaled
+def make_image( rgb565 ):
+    height, width = rgb565.shape
+    # convert RGB565 pixel to 32bit RGBA8888 pixel via lookup table
+    # Rrrr.rGgg.gggB.bbbb -> 1111.1111.Bbbb.b000.Gggg.gg00.Rrrr.r000 (R in the lowest byte)
+    # apply invert option for better printing with white background
+    rgba8888 = rgb565_to_rgba( rgb565, RGBA, options.invert )
+
+    # make an image from pixel array, see: https://pillow.readthedocs.io/en/stable/reference/Image.html#PIL.Image.frombuffer
+    image =  Image.frombuffer('RGBA', ( width, height ), rgba8888, 'raw', 'RGBA', 0, 1)
+
+    if options.scale != 1:
+        image=image.resize( ( options.scale * width, options.scale * height ), resample=0 )
+    return image
+
+
+# save the image, return the filename used
+def save_image( image, filename ):
+    try:
+        image.save( filename ) # .. and save it to file (format according extension)
+    except ValueError: # unknown (or missing) exension
+        filename += '.png'
+        image.save( filename ) # force PNG format
+    return filename
+
+
+# capture the screen of one device and save it as image file
+def capture_screen( nano_tiny_device, device, filename=None, record=None ):
+    with open_session( nano_tiny_device, device ) as nano_tiny:
+        devicename, width, height = nano_tiny.name, nano_tiny.width, nano_tiny.height
         if options.verbose:
-            print('download timeout {0:0.1f} s'.format(stimeout))
-
-        sptr=0xa
-        size=hd_width*hd_height
-        bytestream += get_rle_bytes( psize ) # read palette (psize = byte size)
-        palette=struct.unpack_from( '<{:d}H'.format(psize//2), bytestream, sptr ) # uint16!
-        sptr=sptr+psize
-        bitmap=bytearray(size*2)
-        dptr=0
-        row=0
-        while(row<hd_height):
-            #process RLE block
-            bytestream += get_rle_bytes( 2 ) # uint16
-            bsize=struct.unpack_from('<H',bytestream,sptr)[0]
-            sptr=sptr+2
-            nptr=sptr+bsize
-            while(sptr<nptr):
-                bytestream += get_rle_bytes( 1 ) # uint8
-                count=struct.unpack_from('<b',bytestream,sptr)[0]
-                sptr+=1
-                if(count<0):
-                    bytestream += get_rle_bytes( 1 ) # uint8
-                    color=palette[bytestream[sptr]]
-                    sptr+=1
-                    while(count<=0):
-                        count=count+1
-                        struct.pack_into('<H',bitmap,dptr,color)
-                        dptr+=2
-                else:
-                    bytestream += get_rle_bytes( count + 1 ) # uint8
-                    while(count>=0):
-                        count=count-1
-                        struct.pack_into('<H',bitmap,dptr,palette[bytestream[sptr]])
-                        dptr+=2
-                        sptr+=1
-            row+=1
-        echo = nano_tiny.read_until(prompt + b'resume' + crlf + prompt) # wait for completion
+            print( 'pause screen update, start capturing' )
+        rgb565 = nano_tiny.capture( rle=options.rle ) # "pause", "capture [rle]", "resume"
+        bytestream = nano_tiny.capture_stream
         if options.verbose:
+            if parse_rle_header( bytestream[ :RLE_HEADER_SIZE ] ):
+                print( 'used compressed RLE format' )
+            else:
+                print( 'used standard RGB565 format' )
             bsize = len( bytestream )
             isize = 2 * width * height
             print( f'received {bsize} bytes ({int(100 * bsize / isize)} % of {isize} bytes image size)')
-            print( f'  {bytestream[:10]} ... {bytestream[-10:]}' )
+            print( f'  {bytes( bytestream[:10] )} ... {bytes( bytestream[-10:] )}' )
             print( 'resume screen update' )
-            print( f'ready: {echo}' )
-        bytestream=bitmap
+        if record:
+            with open( record, 'wb' ) as record_file:
+                record_file.write( bytestream )
 
-    else: # RGB565 format
-        if options.verbose:
-            print( 'use standard RGB565 format' )
-        nano_tiny.timeout=stimeout
-        if options.verbose:
-            print('download timeout {0:0.1f} s'.format(stimeout))
-        bytestream += nano_tiny.read( 2 * size - 10 )
-        if options.verbose:
-            print( f'received {len(bytestream)} image bytes:' )
-            print( f'  {bytestream[:10]} ... {bytestream[-10:]}' )
-        if len( bytestream ) != 2 * size:
-            if options.verbose:
-                print( len( bytestream ), 2 * size )
-            print( f'capture error - wrong requested screen size {width} * {height}?' )
-            sys.exit()
-        echo = nano_tiny.read_until( crlf + prompt ) # wait for completion
-        if options.verbose:
-            print( 'resume screen update' )
-            print( f'ready: {echo}' )
-
-if options.verbose:
-    print( 'create image' )
-# convert bytestream to 1D word array
-rgb565 = struct.unpack( f'>{size}H', bytestream )
-# convert to 32bit numpy array Rrrr.rGgg.gggB.bbbb -> 0000.0000.0000.0000.Rrrr.rGgg.gggB.bbbb
-rgb565_32 = numpy.array( rgb565, dtype=numpy.uint32 )
-
-# convert zero padded 16bit RGB565 pixel to 32bit RGBA8888 pixel
-# 0000.0000.0000.0000.Rrrr.rGgg.gggB.bbbb -> 1111.1111.Rrrr.r000.Gggg.gg00.Bbbb.b000
-# apply invert option for better printing with white background
-if options.invert:
-    rgba8888 = 0xFF000000 + (((rgb565_32 & 0xF800) >> 8) + ((rgb565_32 & 0x07E0) << 5) + ((rgb565_32 & 0x001F) << 19)) ^ 0x00FFFFFF
-else:
-    rgba8888 = 0xFF000000 + (((rgb565_32 & 0xF800) >> 8) + ((rgb565_32 & 0x07E0) << 5) + ((rgb565_32 & 0x001F) << 19))
+    if options.verbose:
+        print( 'create image' )
+    image = make_image( rgb565 )
 
-# make an image from pixel array, see: https://pillow.readthedocs.io/en/stable/reference/Image.html#PIL.Image.frombuffer
-image =  Image.frombuffer('RGBA', ( width, height ), rgba8888, 'raw', 'RGBA', 0, 1)
+    filename = filename or datetime.now().strftime( f'{devicename}_%Y%m%d_%H%M%S.png' )
 
-if options.scale != 1:
-    image=image.resize( ( options.scale * width, options.scale * height ), resample=0 )
+    if options.verbose:
+            print( f'filename: {filename}' )
 
-filename = options.out or datetime.now().strftime( f'{devicename}_%Y%m%d_%H%M%S.png' )
+    filename = save_image( image, filename )
 
-if options.verbose:
-        print( f'filename: {filename}' )
+    if options.verbose:
+        print( 'done' )
+    return filename
+
+
+# capture count screens (0: until ^C) every interval seconds with one connection, RLE if available
+# identical consecutive screens are skipped, the images are converted and saved by a worker thread,
+# so the capture rate is limited by the connection only
+# save the screens as numbered files FILENAME_0001.png, ... or as one animated PNG
+# stop the burst early when the event stop is set, e.g. on ^C while capturing all devices
+def capture_burst( nano_tiny_device, device, filename=None, stop=None ):
+    captured = saved = 0
+    pending = collections.deque() # images in work, limited to keep the memory bounded
+    frames = [] # ( image, capture time ) for the animated PNG
+    previous = None # hash of the last saved screen
+    t_start = time.monotonic()
+    with open_session( nano_tiny_device, device ) as nano_tiny, ThreadPoolExecutor( max_workers=1 ) as encoder:
+        devicename = nano_tiny.name
+        filename = filename or datetime.now().strftime( f'{devicename}_%Y%m%d_%H%M%S.png' )
+        stem, ext = os.path.splitext( filename )
+        t_next = time.monotonic()
+        try:
+            while not ( stop and stop.is_set() ) and ( not options.count or captured < options.count ):
+                rgb565 = nano_tiny.capture( rle=True, pause=False ) # the screen keeps running
+                t_capture = time.monotonic()
+                captured += 1
+                digest = hashlib.blake2b( rgb565, digest_size=16 ).digest()
+                if digest != previous:
+                    previous = digest
+                    saved += 1
+                    if options.apng:
+                        pending.append( encoder.submit( make_image, rgb565 ) )
+                        frames.append( ( pending[ -1 ], t_capture ) )
+                    else:
+                        pending.append( encoder.submit( save_frame, rgb565, f'{stem}_{saved:04d}{ext or ".png"}' ) )
+                    if options.verbose:
+                        print( f'screen {captured}: saved' )
+                elif options.verbose:
+                    print( f'screen {captured}: unchanged' )
+                while len( pending ) > 8 or pending and pending[ 0 ].done():
+                    pending.popleft().result()
+                t_next += options.interval
+                time.sleep( max( 0, t_next - time.monotonic() ) ) # keep the rate, do not catch up
+                t_next = max( t_next, time.monotonic() )
+        except KeyboardInterrupt: # stop gracefully, drop a partially received screen
+            nano_tiny.resync()
+        for work in pending:
+            work.result()
+    t_total = time.monotonic() - t_start
+    if options.apng and frames:
+        images = [ work.result() for work, _ in frames ]
+        times = [ t for _, t in frames ]
+        # show each screen until the next one was captured, the last one for the interval
+        durations = [ int( 1000 * ( t1 - t0 ) ) for t0, t1 in zip( times, times[ 1: ] ) ]
+        durations.append( int( 1000 * max( options.interval, 0.1 ) ) )
+        if ext.lower() != '.png': # animated PNG only
+            filename += '.png'
+        images[ 0 ].save( filename, save_all=True, append_images=images[ 1: ], duration=durations, loop=0 )
+    elif not options.apng:
+        filename = f'{stem}_*{ext or ".png"}'
+    return f'{filename}: {captured} screens in {t_total:.1f} s, {saved} saved, {captured - saved} unchanged'
+
+
+# convert and save one screen of the burst
+def save_frame( rgb565, filename ):
+    return save_image( make_image( rgb565 ), filename )
+
+
+if options.all: # capture all devices concurrently, one file per device
+    devices = getdevices()
+    if not devices:
+        print( 'no device found on USB' )
+        sys.exit()
+    timestamp = datetime.now().strftime( '%Y%m%d_%H%M%S' )
+    stop = threading.Event()
+    with ThreadPoolExecutor( max_workers=len( devices ) ) as executor:
+        captures = []
+        for device in devices:
+            devicename = select_device( device )[ 0 ]
+            filename = device_filename( options.out or f'{devicename}_{timestamp}.png', device )
+            record = options.record and device_filename( options.record, device )
+            if burst:
+                captures.append( executor.submit( capture_burst, device.device, device, filename, stop ) )
+            else:
+                captures.append( executor.submit( capture_screen, device.device, device, filename, record ) )
+        try:
+            wait( captures )
+        except KeyboardInterrupt: # stop the bursts, report the screens captured so far
+            stop.set()
+        for device, capture in zip( devices, captures ):
+            try:
+                print( f'{device.device} ({device_id( device )}): {capture.result()}' )
+            except OSError as error:
+                print( f'{device.device} ({device_id( device )}): {error}' )
+    sys.exit()
 
-try:
-    image.save( filename ) # .. and save it to file (format according extension)
-except ValueError: # unknown (or missing) exension
-    image.save( filename + '.png' ) # force PNG format
+if broker is not None: # the broker owns the device
+    device = nano_tiny_device = None
+elif options.device:
+    device = finddevice( options.device )
+    nano_tiny_device = options.device
+else:
+    try:
+        device = getdevice()
+    except OSError:
+        print( 'no device found on USB' )
+        sys.exit()
+    nano_tiny_device = device.device
 
-if options.verbose:
-    print( 'done' )
+try:
+    if burst:
+        print( capture_burst( nano_tiny_device, device, options.out ) )
+    else:
+        capture_screen( nano_tiny_device, device, options.out, options.record )
+except OSError as error:
+    print( error )
+    sys.exit()
@@ -13,21 +13,10 @@ vbat_offset transform threshold help info version color
 '''
 
 import argparse
-import serial
-from serial.tools import list_ports
 import sys
 
-# ChibiOS/RT Virtual COM Port
-VID = 0x0483 #1155
-PID = 0x5740 #22336
-
-# Get nanovna device automatically
-def getdevice() -> str:
-    device_list = list_ports.comports()
-    for device in device_list:
-        if device.vid == VID and device.pid == PID:
-            return device.device
-    raise OSError("device not found")
+from nanotiny import Session, getdevice
+from nanotiny.broker import add_broker_arguments, broker_socket
 
 
 # construct the argument parser and parse the arguments
@@ -36,40 +25,53 @@ ap.add_argument( '-d', '--device', dest = 'device',
     help = 'connect to device' )
 ap.add_argument( '-D', '--detect', dest = 'detect', default = False, action= 'store_true',
     help = 'detect the NanoVNA device' )
+add_broker_arguments( ap )
 ap.add_argument( '-o', '--out', nargs = '?', type=argparse.FileType( 'wb' ),
     help = 'write output to FILE, default = sys.stdout', metavar = 'FILE', default = sys.stdout )
+ap.add_argument( '-b', '--batch', type=argparse.FileType( 'r' ), metavar = 'FILE',
+    help = 'execute the commands from FILE (one per line, "-" = stdin) and print each response after its command' )
+ap.add_argument( '-w', '--window', type = int, default = 8,
+    help = 'batch mode: number of commands typed ahead, default = 8' )
 ap.add_argument( 'command', metavar = 'CMD', nargs = '*', action = 'append',
-    help = 'command and arguments' )
+    help = 'command and arguments, separate more commands with ";"' )
 
 options = ap.parse_args()
+broker = broker_socket( options )
 
-nanodevice = options.device or getdevice()
 outfile = options.out
 
 if options.detect:
-    print( nanodevice )
+    print( options.device or getdevice().device )
     sys.exit()
 
-cmdline = ''
-
-for cmd in options.command[ 0 ]:
-    cmdline = cmdline + cmd + ' '
+cmdline = ' '.join( options.command[ 0 ] )
 
-cmdline = cmdline[ : -1 ].encode() # convert string to bytearray
+# commands separated by ';' and from the batch file, skip empty lines and comments
+cmds = [ cmd.strip() for cmd in cmdline.split( ';' ) if cmd.strip() ]
+if options.batch:
+    cmds += [ line.strip() for line in options.batch if line.strip() and not line.lstrip().startswith( '#' ) ]
 
-cr = b'\r'
 lf = b'\n'
-crlf = cr + lf
-prompt = b'ch> '
 
-with serial.Serial( nanodevice, timeout=1 ) as NanoVNA: # open serial connection
-    NanoVNA.write( cmdline + cr )                     # send command and options terminated by CR
-    echo = NanoVNA.read_until( cmdline + crlf )       # wait for command echo terminated by CR LF
-    echo = NanoVNA.read_until( crlf + prompt )        # get command response until prompt
+if len( cmds ) <= 1 and not options.batch: # single command, print the response only
+    with Session( options.device, broker=broker ) as NanoVNA:            # open serial connection
+        # send the command without ';' and surrounding spaces, get response without '\r\nch> '
+        response = NanoVNA.execute_raw( cmds[ 0 ] if cmds else '' )
 
-response = echo[ :-len( crlf + prompt ) ]             # remove '\r\nch> '
+    if outfile == sys.stdout:
+        print( response.decode() )                        # write string to stdout
+    else:
+        outfile.write( response + lf )                    # write bytes to outfile
+    sys.exit()
 
-if outfile == sys.stdout:
-    print( response.decode() )                        # write string to stdout
-else:
-    outfile.write( response + lf )                    # write bytes to outfile
+# batch mode, type ahead the commands and print each response tagged with the command
+with Session( options.device, broker=broker ) as NanoVNA:
+    for cmd, response in NanoVNA.execute_pipelined( cmds, options.window ):
+        if outfile == sys.stdout:
+            print( f'ch> {cmd}' )
+            if response:
+                print( response.decode() )
+        else:
+            outfile.write( b'ch> ' + cmd.encode() + lf )
+            if response:
+                outfile.write( response + lf )
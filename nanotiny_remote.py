@@ -7,32 +7,21 @@ Tool to remote control NanoVNA-H or tinySA
 Display the screen with zoom 1x, 2x, 3x, 4x
 Translate mouse click to touch events
 Save a screenshot with timestamp name
+Record the session and replay it without device, e.g. to create a video
+Serve the screen via HTTP without window, e.g. to watch it from other desks
 '''
 
 import argparse
+import contextlib
 from datetime import datetime
-import serial
-from serial.tools import list_ports
-import struct
 import sys
+import threading
 import time
 
-import numpy as np
-from PIL import Image
-import cv2
-
-# ChibiOS/RT Virtual COM Port
-VID = 0x0483 #1155
-PID = 0x5740 #22336
-
-
-# Get NanoVNA-H or tinySA device automatically
-def getdevice() -> str:
-    device_list = list_ports.comports()
-    for device in device_list:
-        if device.vid == VID and device.pid == PID:
-            return device
-    raise OSError("device not found")
+from nanotiny import Session, getdevice, finddevice, detect_device
+from nanotiny.broker import add_broker_arguments, broker_socket
+from nanotiny.remote import Framebuffer, Latency, RemoteStream, StreamRecorder, StreamRecording, bulk_data
+from nanotiny.rgb565 import BGRA, RGBA
 
 
 # construct the argument parser and parse the arguments
@@ -48,15 +37,49 @@ typ.add_argument( '-t', '--tinysa', action = 'store_true',
     help = 'use with tinySA' )
 typ.add_argument( '--ultra', action = 'store_true',
     help = 'use with tinySA Ultra' )
+add_broker_arguments( ap, 'use the device shared by nanotiny_broker.py, poll the screen' )
 ap.add_argument( "-i", "--invert", action = 'store_true',
     help="invert the colors, e.g. for printing of screen shots" )
+ap.add_argument( '-f', '--fps', type = float, default = 25,
+    help = 'max. display update rate (frames per second), default = 25' )
+ap.add_argument( '--stats', action = 'store_true',
+    help = 'show the display and touch latency when finished' )
 ap.add_argument( '-z', '--zoom', dest = 'zoom',
     type = int, action = 'store', choices = (2,3,4), default = 1,
     help = 'zoom the screen image' )
+ap.add_argument( '--record', metavar = 'FILE',
+    help = 'record the screen updates with their time to FILE' )
+ap.add_argument( '--replay', metavar = 'FILE',
+    help = 'replay the recorded FILE instead of connecting to a device' )
+ap.add_argument( '--speed', type = float, default = 1,
+    help = 'replay speed factor, 0 = as fast as possible, default = 1' )
+ap.add_argument( '--video', metavar = 'FILE',
+    help = 'convert the replayed FILE to a video (.mp4 or .avi) with FPS frames per second, no display' )
+ap.add_argument( '--http', metavar = '[HOST:]PORT',
+    help = 'serve the screen as MJPEG stream and PNG at http://HOST:PORT/ instead of a window, default HOST = localhost' )
 
 options = ap.parse_args()
-if options.device:
-    device = None
+broker = broker_socket( options )
+if options.http is None or options.video: # OpenCV is needed only for the window and the video
+    import cv2
+else:
+    from nanotiny.viewer import ScreenFrames, ViewerServer
+replay = options.replay is not None
+if options.video and not replay:
+    ap.error( '--video needs --replay' )
+if options.record and replay:
+    ap.error( '--record and --replay are mutually exclusive' )
+if replay:
+    try:
+        recording = StreamRecording( options.replay )
+    except OSError as error:
+        print( error )
+        sys.exit()
+    device = nano_tiny_device = None
+elif broker is not None: # the broker owns the device
+    device = nano_tiny_device = None
+elif options.device:
+    device = finddevice( options.device )
     nano_tiny_device = options.device
 else:
     device = getdevice()
@@ -68,8 +91,10 @@ zoom = options.zoom
 width = 320
 height = 240
 
-# set by option
-if options.tinysa:
+# set by the recording or by option
+if replay:
+    devicename, width, height = recording.name, recording.width, recording.height
+elif options.tinysa:
     devicename = 'tinySA'
 elif options.ultra:
     devicename = 'tinySA Ultra'
@@ -80,75 +105,164 @@ elif options.h4:
     width = 480
     height = 320
 # get it from USB descriptor (supported by newer FW from DiSlord or Erik)
-elif device and 'tinySA4' in device.description:
-    devicename = 'tinySA Ultra'
-    width = 480
-    height = 320
-elif device and 'tinySA' in device.description:
-    devicename = 'tinySA'
-elif device and 'NanoVNA-H4' in device.description:
-    devicename = 'NanoVNA-H4'
-    width = 480
-    height = 320
+elif detect_device( device ):
+    devicename, width, height = detect_device( device )
 # fall back to default name
 else:
     devicename = 'NanoVNA-H'
 
-crlf = b'\r\n'
-prompt = b'ch> '
+# convert the recording into a video, one frame per 1/fps s of recording time
+def write_video( filename ):
+    framebuffer = Framebuffer( width, height, zoom, BGRA, options.invert ) # OpenCV order, also with --http
+    stream = RemoteStream( width, height )
+    fourcc = 'MJPG' if filename.lower().endswith( '.avi' ) else 'mp4v'
+    video = cv2.VideoWriter( filename, cv2.VideoWriter_fourcc( *fourcc ), options.fps, ( zoom * width, zoom * height ) )
+    if not video.isOpened():
+        print( f'cannot write video {filename}' )
+        sys.exit()
+    frames = 0
+    for seconds, data in recording:
+        while frames and frames / options.fps < seconds: # show the screen until this update
+            video.write( cv2.cvtColor( framebuffer.render()[ 0 ], cv2.COLOR_BGRA2BGR ) )
+            frames += 1
+        framebuffer.apply( stream.feed( data ) )
+        if not frames: # 1st frame with the complete screen
+            video.write( cv2.cvtColor( framebuffer.render()[ 0 ], cv2.COLOR_BGRA2BGR ) )
+            frames += 1
+    video.release()
+    print( f'{frames} frames, {frames / options.fps:.1f} s' )
+
+
+if options.video:
+    write_video( options.video )
+    sys.exit()
+
+# the refresh stream is used when the device is connected directly
+refresh = broker is None and not replay
 
 # do the communication
-with serial.Serial( nano_tiny_device, timeout=0.5) as nano_tiny: # open serial connection
-
-    def do_region( what ):
-        where = nano_tiny.read( 8 )
-        x, y, w, h = struct.unpack( '<HHHH', where )
-        if x >= width or y >= height or x+w > width or y+h > height: # dimension too big
-            print( 'dimension error:', x, y, x+w, y+h )
-            return
-        if what == b'bulk':
-            #print( f'bulk, x: {x}, y: {y}, w: {w}, h: {h}' )
-            size = w * h
-            bytestream = nano_tiny.read( 2 * size ) # read a bytestream
-            if len( bytestream ) < 2 * size:
-                #print( bytestream )
+# open serial connection, sync to prompt
+with contextlib.nullcontext() if replay else Session( nano_tiny_device, timeout=0.5, broker=broker ) as session:
+    nano_tiny = None if replay else session.serial
+    if broker is not None and not ( options.tinysa or options.ultra or options.h4 ): # the broker knows the device
+        devicename, width, height = session.name, session.width, session.height
+    if not replay:
+        session.name, session.width, session.height = devicename, width, height
+
+    lock = threading.Lock() # protects the framebuffer and the statistics
+    device_lock = threading.Lock() # serializes the broker transactions of both threads
+    stop = threading.Event()
+    display_latency = Latency( 'display latency' ) # region received -> shown
+    touch_latency = Latency( 'touch latency' ) # touch sent -> 1st region received
+    changed = None # time of the 1st region received since the last image
+    touched = None # time of the last touch without screen change yet
+    recorder = None
+
+
+    # take the time of a screen change, call with lock held
+    def region_received():
+        global changed, touched
+        now = time.monotonic()
+        if changed is None:
+            changed = now
+        if touched is not None:
+            touch_latency.add( now - touched )
+            touched = None
+
+
+    # reader thread for replay, feed the recorded stream with the recorded timing divided by speed
+    def replay_reader():
+        start = time.monotonic()
+        for seconds, data in recording:
+            if options.speed:
+                delay = start + seconds / options.speed - time.monotonic()
+                if delay > 0 and stop.wait( delay ):
+                    return
+            elif stop.is_set():
                 return
-            words = struct.unpack( f">{size}H", bytestream ) # convert to array of words
-            rectangle = np.reshape( words, ( h, w ) ) # make a rectangle
-        elif what == b'fill':
-            color = nano_tiny.read( 2 )
-            color, = struct.unpack( '>H', color )
-            # print( f'fill {hex(color)}, x: {x}, y: {y}, w: {w}, h: {h}' )
-            rectangle = np.full( ( h, w ), color, dtype=np.uint16 )
-        else:
-            return
-        RGB565[ y:y+h, x:x+w ] = rectangle # broadcast into the image at position (y,x)
-        return
+            regions = stream.feed( data )
+            if regions:
+                with lock:
+                    framebuffer.apply( regions )
+                    region_received()
+        print( f'replay finished after {time.monotonic() - start:.2f} s' )
+
+
+    # reader thread, decode the refresh stream resp. poll the screen via the broker
+    def reader():
+        while not stop.is_set():
+            if broker is not None: # poll the screen, the device is free for other tools in between
+                time.sleep( 1 / options.fps )
+                try:
+                    with device_lock:
+                        rgb565 = session.capture( rle=True, pause=False )
+                except OSError as error:
+                    print( error )
+                    continue
+                with lock:
+                    region = framebuffer.update( rgb565 )
+                    if region: # the screen changed since the last poll
+                        region_received()
+                if recorder and region:
+                    x, y, w, h = region
+                    recorder.write( bulk_data( x, y, w, h, rgb565[ y:y+h, x:x+w ] ) )
+                continue
+            # read what is available (at least one byte or timeout) and split it into regions
+            data = nano_tiny.read( max( 1, nano_tiny.in_waiting ) )
+            if recorder:
+                recorder.write( data )
+            regions = stream.feed( data )
+            if regions:
+                with lock:
+                    framebuffer.apply( regions )
+                    region_received()
 
 
     def make_image():
-        # convert RGB565 array to RGBA8888 array
-        # Rrrr.rGgg.gggB.bbbb -> Aaaa.aaaa.Rrrr.rrrr.Gggg.gggg.Bbbb.bbbb
-        # apply invert option for better printing with white background
-        if options.invert:
-            rgba8888 = 0xFF000000 | (((RGB565 & 0xF800) << 8) | ((RGB565 & 0x07E0) << 5) | ((RGB565 & 0x001F) << 3)) ^ 0x00FFFFFF
+        # convert and zoom only the regions changed since the last image
+        # RGB565 -> BGRA8888 via lookup table, inverted for better printing with white background
+        global changed
+        with lock:
+            image, regions = framebuffer.render()
+            if changed is not None:
+                display_latency.add( time.monotonic() - changed )
+                changed = None
+            return image.copy() if regions else None
+
+
+    # send a command without waiting for the response, the response is part of the refresh stream
+    # with the broker wait for the response to leave the device at the prompt for the next client
+    def device_command( cmd ):
+        if broker is not None:
+            with device_lock:
+                session.execute( cmd )
         else:
-            rgba8888 = 0xFF000000 | ((RGB565 & 0xF800) << 8) | ((RGB565 & 0x07E0) << 5) | ((RGB565 & 0x001F) << 3)
-        pil_image = Image.fromarray( rgba8888, 'RGBA' ) # create a PIL image
-        image = np.array( pil_image ) # convert from PIL array to np array
-        if zoom != 1:
-            image = cv2.resize( image, (zoom * width, zoom * height), interpolation = cv2.INTER_AREA ) # resize
-        return image
+            nano_tiny.write( cmd.encode() + b'\r' )
 
 
     # mouse callback function
     def mouse_event( event, x, y, flags, param ):
+        global touched
         # print( event, x, y, flags, param )
+        if replay: # no device to control
+            return
         if event == cv2.EVENT_LBUTTONDOWN:
-            nano_tiny.write( f'touch {x // zoom} {y // zoom}\r'.encode() )
-        elif event == cv2.EVENT_LBUTTONUP: #
-            time.sleep( 0.1 )
-            nano_tiny.write( b'release\r')
+            with lock:
+                touched = time.monotonic()
+            device_command( f'touch {x // zoom} {y // zoom}' )
+        elif event == cv2.EVENT_LBUTTONUP: # release after 0.1 s without blocking the display
+            threading.Timer( 0.1, device_command, ( 'release', ) ).start()
+
+
+    # touch from a HTTP viewer in screen coordinates, release after 0.1 s
+    def http_touch( x, y ):
+        global touched
+        if replay: # no device to control
+            return
+        with lock:
+            touched = time.monotonic()
+        device_command( f'touch {x} {y}' )
+        threading.Timer( 0.1, device_command, ( 'release', ) ).start()
 
 
     # save the current image as png with timestamp
@@ -158,90 +272,114 @@ with serial.Serial( nano_tiny_device, timeout=0.5) as nano_tiny: # open serial c
 
 
 
-    while nano_tiny.inWaiting(): # clear serial buffer
-        nano_tiny.read( nano_tiny.inWaiting() )
-        time.sleep( 0.1)
-
-    cmd = b'capture'
-    nano_tiny.write( cmd + b'\r' )
-    nano_tiny.read_until( cmd + b'\r\n' )
-    size = width * height
-    bytestream = nano_tiny.read( 2 * size ) # read a bytestream
-    if len( bytestream ) != 2 * size:
-        if bytestream == cmd + b'?\r\nch> ': # error message
-            print( 'capture error - does the device support the "capture" cmd?' )
-        else:
-            print( 'capture error - wrong screen size?' )
-        sys.exit()
-
-
-
-    words = struct.unpack( f'>{size}H', bytestream ) # convert to array of words
-    rectangle = np.reshape( words, ( height, width ) ) # make a rectangle
+    # persistent RGB565 screen, converted and zoomed image
+    framebuffer = Framebuffer( width, height, zoom, RGBA if options.http else BGRA, options.invert )
+    stream = RemoteStream( width, height ) # parser for the refresh stream
 
-    # Prepare black 2D RGB565 data array
-    # IMPORTANT: define as uint32 to allow conversion to RGBA8888
-    RGB565 = np.zeros( ( height, width ), dtype=np.uint32 )
-    RGB565[ 0:height, 0:width ] = rectangle # broadcast the captured screen
-
-    nano_tiny.write( b'refresh on\r' )  # request screen remote
-    nano_tiny.read_until( b'refresh on\r\n' )
-    time.sleep( 0.2 )
-
-    cv2.namedWindow( devicename )
-    cv2.setMouseCallback( devicename, mouse_event )
-    click_pos = None
-
-    NO = 0
-    YES = 1
-    FORCE = 10
+    if not replay: # the recording starts with the complete screen
+        try:
+            rgb565 = session.capture( pause=False ) # get the complete screen
+        except OSError as error:
+            print( error )
+            sys.exit()
+        framebuffer.update( rgb565 ) # the captured screen
 
-    refresh_image = FORCE
-    while refresh_image:  # run forever, stop with ^C on commad line or ESC on image
+    if options.record:
         try:
-            next_action = nano_tiny.read_until( b'\r\n')
-            if b'bulk' in next_action:
-                do_region( b'bulk' )
-                refresh_image +=1 # image has changed
-            elif b'fill' in next_action:
-                do_region( b'fill' )
-                refresh_image +=1 # image has changed
-            elif b'ch> ' in next_action: # scanning, currently no more regions, image ready
-                #print( next_action )
-                refresh_image = FORCE
-            else: # no serial data, idle, force refresh after some time
-                #print( next_action )
-                time.sleep( 0.1 )
-                refresh_image += 5
-
-            if refresh_image >= FORCE:
-                #print( 'refresh_image', refresh_image )
-                image = make_image() # convert internal data structure into image
-                cv2.imshow( devicename, image ) # show it
-                key = cv2.waitKey(1)
-                if key < 0: # no key pressed
-                    refresh_image = YES
-                elif key == 27: # ESC pressed
-                    refresh_image = NO
-                elif key == ord( 's' ):
+            recorder = StreamRecorder( options.record, width, height, devicename, rgb565 )
+        except OSError as error:
+            print( error )
+            sys.exit()
+
+    if options.http: # open the port before the device starts to send
+        host, _, port = options.http.rpartition( ':' )
+        host = host or 'localhost'
+        frames = ScreenFrames()
+        try:
+            server = ViewerServer( ( host, int( port ) ), frames, devicename, width, height, http_touch )
+        except ( OSError, ValueError ) as error:
+            print( f'cannot serve at {options.http} - {error}' )
+            sys.exit()
+
+    if refresh:
+        nano_tiny.write( b'refresh on\r' )  # request screen remote
+        nano_tiny.read_until( b'refresh on\r\n' )
+        time.sleep( 0.2 )
+
+    reader_thread = threading.Thread( target=replay_reader if replay else reader, daemon=True )
+    reader_thread.start()
+
+    # display loop, show the changed image at most fps times per second
+    frame_time = 1 / options.fps
+    next_frame = time.monotonic()
+    image = None
+    if options.http is None:
+        cv2.namedWindow( devicename )
+        cv2.setMouseCallback( devicename, mouse_event )
+        while True:  # run forever, stop with ^C on commad line or ESC on image
+            try:
+                new_image = make_image() # convert internal data structure into image
+                if new_image is not None:
+                    image = new_image
+                    cv2.imshow( devicename, image ) # show it
+                next_frame = max( next_frame + frame_time, time.monotonic() )
+                # wait for the next frame, handle mouse and keyboard in the meantime
+                key = cv2.waitKey( max( 1, int( 1000 * ( next_frame - time.monotonic() ) ) ) )
+                if key == 27: # ESC pressed
+                    break
+                elif key == ord( 's' ) and image is not None:
                     screenshot( image )
                 elif key == ord( '+' ) and zoom < 4:
                     zoom += 1
+                    with lock:
+                        framebuffer.set_zoom( zoom )
                 elif key == ord( '-' ) and zoom > 1:
                     zoom -= 1
-                else: # ignore all other keys
-                    refresh_image = YES
-
-        except KeyboardInterrupt:         # ^C pressed, stop measurement
-            refresh_image = NO            # exit
+                    with lock:
+                        framebuffer.set_zoom( zoom )
+                # ignore all other keys
+
+            except KeyboardInterrupt:         # ^C pressed, stop measurement
+                break                         # exit
+
+    else: # headless, encode each changed image once for all viewers
+        server_thread = threading.Thread( target=server.serve_forever, daemon=True )
+        server_thread.start()
+        print( f'serving {devicename} at http://{host}:{port}/, stop with ^C' )
+        sys.stdout.flush()
+        try:
+            while True:
+                new_image = make_image()
+                if new_image is not None:
+                    frames.publish( new_image )
+                next_frame = max( next_frame + frame_time, time.monotonic() )
+                time.sleep( max( 0, next_frame - time.monotonic() ) )
+        except KeyboardInterrupt: # ^C pressed
+            pass
+        frames.close()
+        server.shutdown()
+        server.server_close()
 
     print( 'cleaning up ...' )
 
-    nano_tiny.write( b'refresh off\r' )  # stop screen remote
+    stop.set()
+    reader_thread.join()
+    if recorder:
+        recorder.close()
+
+    if options.stats:
+        print( display_latency )
+        print( touch_latency )
+        if stream.errors:
+            print( f'{stream.errors} regions outside the screen dropped' )
 
-    cv2.destroyAllWindows()
+    if refresh:
+        nano_tiny.write( b'refresh off\r' )  # stop screen remote
 
-    while nano_tiny.inWaiting(): # clear serial buffer
-        nano_tiny.read( nano_tiny.inWaiting() )
-        time.sleep( 0.02 )
+    if options.http is None:
+        cv2.destroyAllWindows()
 
+    if refresh:
+        while nano_tiny.inWaiting(): # clear serial buffer
+            nano_tiny.read( nano_tiny.inWaiting() )
+            time.sleep( 0.02 )
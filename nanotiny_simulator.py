@@ -0,0 +1,52 @@
+#!/usr/bin/python
+
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+'''
+Simulate a NanoVNA or tinySA on a pseudo terminal to use the tools without hardware,
+e.g. for performance measurements. The response throughput and a command latency
+can be set to emulate USB CDC or a slow serial connection.
+'''
+
+import argparse
+import sys
+import time
+
+from nanotiny.simulator import Simulator, SIMULATED_DEVICES, USB_THROUGHPUT
+
+
+# construct the argument parser and parse the arguments
+ap = argparse.ArgumentParser( description='Simulate a NanoVNA or tinySA on a pseudo terminal' )
+ap.add_argument( '-t', '--type', choices = SIMULATED_DEVICES.keys(), default = 'NanoVNA-H',
+    help = 'simulated device, default = NanoVNA-H' )
+speed = ap.add_mutually_exclusive_group()
+speed.add_argument( '-b', '--baudrate', type = int,
+    help = 'emulate a serial connection with BAUDRATE (10 bit per byte)' )
+speed.add_argument( '-u', '--usb', action = 'store_true',
+    help = f'emulate USB CDC with {USB_THROUGHPUT} bytes/s' )
+speed.add_argument( '-T', '--throughput', type = float,
+    help = 'limit the response throughput to THROUGHPUT bytes/s, default = unlimited' )
+ap.add_argument( '-l', '--latency', type = float, default = 0,
+    help = 'delay in s before each command response, default = 0' )
+ap.add_argument( '-r', '--refresh', type = float, default = 0.1,
+    help = 'interval in s of the screen updates after "refresh on", default = 0.1' )
+ap.add_argument( '-v', '--verbose', action = 'store_true',
+    help = 'show the received commands' )
+
+options = ap.parse_args()
+
+if options.baudrate:
+    throughput = options.baudrate / 10 # start bit, 8 data bits, stop bit
+elif options.usb:
+    throughput = USB_THROUGHPUT
+else:
+    throughput = options.throughput
+
+with Simulator( options.type, throughput, options.latency, options.refresh, options.verbose ) as simulator:
+    print( f'{simulator.name} simulator at {simulator.port}' )
+    sys.stdout.flush()
+    try:
+        while True: # run forever, stop with ^C
+            time.sleep( 1 )
+    except KeyboardInterrupt:
+        pass
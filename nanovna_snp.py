@@ -10,23 +10,19 @@ Do it as an exercise - step by step - without using tools like scikit-rf.
 '''
 
 import argparse
-import serial
-from serial.tools import list_ports
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+import numpy as np
+import os
 import sys
+import threading
+import time
 from datetime import datetime
 
+from nanotiny import Session, getdevices, device_id, device_filename
+from nanotiny.broker import add_broker_arguments, broker_socket
+from nanotiny.history import open_history
+from nanotiny.touchstone import S1P, S2P, Z1P, format_block, option_line
 
-# ChibiOS/RT Virtual COM Port
-VID = 0x0483 #1155
-PID = 0x5740 #22336
-
-# Get nanovna device automatically
-def getdevice() -> str:
-    device_list = list_ports.comports()
-    for device in device_list:
-        if device.vid == VID and device.pid == PID:
-            return device.device
-    raise OSError("device not found")
 
 # default output
 outfile = sys.stdout
@@ -35,8 +31,11 @@ outfile = sys.stdout
 ap = argparse.ArgumentParser( description='Save S parameter from NanoVNA-H in "touchstone" format')
 ap.add_argument( '-d', '--device', dest = 'device',
     help = 'connect to device' )
-ap.add_argument( '-o', '--out', nargs = '?', type=argparse.FileType( 'wb' ),
-    help = f'write output to FILE, default = {outfile.name}', metavar = 'FILE', default = outfile )
+ap.add_argument( '-o', '--out', nargs = '?',
+    help = f'write output to FILE, default = {outfile.name}', metavar = 'FILE' )
+add_broker_arguments( ap )
+ap.add_argument( '-a', '--all', action = 'store_true',
+    help = 'scan all devices on USB concurrently, the USB serial number is added to the file names' )
 ap.add_argument( '-c', '--comment', dest = 'comment', default = False, action= 'store_true',
     help = 'add comments to output file (may break some simple tools, e.g. octave\'s load("-ascii" ...))' )
 ap.add_argument( '-t', '--timeout', dest = 'timeout', type = int, default = 3,
@@ -48,127 +47,304 @@ fmt.add_argument( '-2', '--s2p', action = 'store_true',
     help = 'store S-parameter for 2-port device' )
 fmt.add_argument( '-z', '--z1p', action = 'store_true',
     help = 'store Z-parameter for 1-port device' )
+ap.add_argument( '-b', '--binary', action = 'store_true',
+    help = 'use binary scan transfer if supported by the firmware' )
+ap.add_argument( '--start', type = float,
+    help = 'start frequency, default = sweep start of the device' )
+ap.add_argument( '--stop', type = float,
+    help = 'stop frequency, default = sweep stop of the device' )
+ap.add_argument( '-p', '--points', type = int,
+    help = 'number of points, default = sweep points of the device, more points are scanned in segments' )
+ap.add_argument( '-s', '--segments', type = int,
+    help = 'split the scan into SEGMENTS consecutive scans, default = points / sweep points of the device' )
+ap.add_argument( '--store', metavar = 'HISTORY',
+    help = 'append the sweeps to the sweep history file HISTORY, touchstone output only with option -o' )
+ap.add_argument( '--continuous', action = 'store_true',
+    help = 'scan again and again with the same sweep and write each sweep into a new file, '
+        'FILE is extended by the time of the sweep or used as strftime() template if it contains "%%"' )
+ap.add_argument( '--interval', type = float, default = 0,
+    help = 'continuous mode: start a new sweep every INTERVAL s, default = 0 (as fast as possible)' )
+ap.add_argument( '--count', type = int, default = 0,
+    help = 'continuous mode: stop after COUNT sweeps, default = 0 (until ^C)' )
+ap.add_argument( '--duration', type = float, default = 0,
+    help = 'continuous mode: stop after DURATION s, default = 0 (until ^C)' )
 
 options = ap.parse_args()
-nanodevice = options.device or getdevice()
-outfile = options.out
+broker = broker_socket( options )
+if options.all and broker is not None:
+    ap.error( 'argument --broker/--broker-socket: not allowed with argument -a/--all' )
+if options.segments is not None and options.segments < 1:
+    ap.error( 'argument -s/--segments: must be at least 1' )
 s1p = options.s1p
 s2p = options.s2p
 z1p = options.z1p
 
 
-cr = '\r'
 lf = '\n'
-crlf = cr + lf
-prompt = 'ch> '
-
-Z0 = 50 # nominal impedance
-
 
-with serial.Serial( nanodevice, timeout=options.timeout ) as NanoVNA: # open serial connection
-
-    def execute( cmd ):
-        NanoVNA.write( (cmd + cr).encode() )                  # send command and options terminated by CR
-        echo = NanoVNA.read_until( (cmd + crlf).encode() )    # wait for command echo terminated by CR LF
-        echo = NanoVNA.read_until( prompt.encode() )          # get command response until prompt
-        return echo[ :-len( crlf + prompt ) ].decode().split( crlf ) # remove trailing '\r\nch> ', split in lines
+if z1p:
+    fmt = Z1P
+elif s2p:
+    fmt = S2P
+else:
+    fmt = S1P
 
-    execute( 'pause' ) # stop display
 
+# get the sweep of the device, modified by the options
+# return ( f_start, f_stop, points, segments, outmask )
+# raise ValueError if the points cannot be split into the segments, e.g. in the thread of one of all devices
+def sweep_parameters( NanoVNA ):
     # get start and stop frequency as well as number of points
-    f_start, f_stop, n_points = execute( 'sweep' )[0].split()
+    f_start, f_stop, n_points = NanoVNA.sweep()
+
+    if options.start is not None:
+        f_start = int( options.start )
+    if options.stop is not None:
+        f_stop = int( options.stop )
+    points = options.points or n_points
+    min_segments = -( -points // n_points ) # ceil( points / n_points ), no segment with more than n_points
+    segments = options.segments or min_segments
+    if not min_segments <= segments <= points: # else too many points per scan or empty segments
+        raise ValueError( f'argument -s/--segments: {points} points need {min_segments} to {points} segments '
+            f'with {n_points} sweep points of the device' )
 
     if s2p: # fetch S11 and S21
         outmask = 7 # freq, S11.re, S11.im, S21.re, S21.im
     else: # fetch only S11
         outmask = 3 # freq, S11.re, S11.im
 
-    cmd = f'scan {f_start} {f_stop} {n_points} {outmask}' # prepare command
-
-    comment = datetime.now().strftime( f'! NanoVNA %Y%m%d_%H%M%S\n! {cmd}' )
-    if z1p:
-        comment += '\n! 1-port normalized Z-parameter (R/Z0 + jX/Z0)'
-    elif s2p:
-        comment += '\n! 2-port S-parameter (S11.re S11.im S21.re S21.im 0 0 0 0)'
+    return f_start, f_stop, points, segments, outmask
+
+
+# scan with the given sweep parameters
+# return the scan command, the scan results of all segments and the formatted data lines as one string
+def scan_segments( NanoVNA, formatter, f_start, f_stop, points, segments, outmask ):
+    # split the frequencies into segments, scan them one after the other and
+    # format segment k in a worker thread while segment k+1 is scanned
+    frequencies = np.linspace( f_start, f_stop, points ).round().astype( np.int64 )
+    scans, formatted = [], []
+    for segment in np.array_split( frequencies, segments ):
+        # scan and receive S-parameter as numpy structured array
+        scan_result = NanoVNA.scan( segment[ 0 ], segment[ -1 ], len( segment ), outmask, binary=options.binary )
+        scans.append( scan_result )
+        formatted.append( formatter.submit( format_block, fmt, scan_result ) )
+    data = ''.join( segment.result() for segment in formatted )
+
+    if segments == 1:
+        cmd = NanoVNA.command # the scan command that delivered the data
     else:
-        comment += '\n! 1-port S-parameter (S11.re S11.im)'
+        cmd = f'scan {f_start} {f_stop} {points} {outmask} in {segments} segments'
 
-    scan_result = execute( cmd ) # scan and receive S-parameter
+    return cmd, scans, data
 
-    execute( 'resume' ) # resume display
 
+# frequencies and complex S-parameter ( points, parameters ) of the scan results of one sweep
+def sweep_values( scans ):
+    scan = np.concatenate( scans )
+    values = [ scan[ 'S11r' ] + 1j * scan[ 'S11i' ] ]
+    if s2p:
+        values.append( scan[ 'S21r' ] + 1j * scan[ 'S21i' ] )
+    return scan[ 'freq' ], np.stack( values, axis=-1 )
 
-def format_parameter_line( line ):
-    if z1p:
-        # calculate normalized impedance as Rn + jXn = R/Z0 + jX/Z0 according to this doc
-        # https://pa3a.nl/wp-content/uploads/2022/07/Math-for-nanoVNA-S2Z-and-Z2S-Jul-2021.pdf
-        freq, S11r, S11i = line.split()
-        freq = float( freq )
-        S11r = float( S11r )
-        S11i = float( S11i )
-        Sr2 = S11r * S11r
-        Si2 = S11i * S11i
-        Denom = ( 1 - S11r ) * ( 1 - S11r ) + Si2
-        Rn = ( 1 - Sr2 - Si2 ) / Denom
-        Xn = ( 2 * S11i ) / Denom
-        return f'{freq:.0f} {Rn:15.9f} {Xn:15.9f}'
-    elif s2p:
-        # format a line with freq, S11, S21, S12, S22 (Sxx as re/im pair)
-        freq, S11r, S11i, S21r, S21i = line.split()
-        freq = float( freq )
-        S11r = float( S11r )
-        S11i = float( S11i )
-        S21r = float( S21r )
-        S21i = float( S21i )
-        line = f'{freq:.0f} {S11r:12.9f} {S11i:12.9f}'
-        line += f' {S21r:12.9f} {S21i:12.9f}'
-        line += '  0  0  0  0' # S12 and S22 are 0+j0
-        return line
-    else: # s1p
-        # format a line with freq, S11.re, S11.im
-        freq, S11r, S11i = line.split()
-        freq = float( freq )
-        S11r = float( S11r )
-        S11i = float( S11i )
-        return f'{freq:.0f} {S11r:12.9f} {S11i:12.9f}'
-
-
-def output_string( line ):
-    if outfile == sys.stdout:
-        print( line )
-    else:
-        outfile.write( ( line + lf ).encode() )
 
+# append the scan results of one sweep to the sweep history file store
+def store_sweep( store, scans, timestamp ):
+    frequencies, values = sweep_values( scans )
+    with open_history( store, frequencies, values.shape[ 1 ] ) as history:
+        history.append( values, timestamp.timestamp() )
 
-# Touchstone data files may include comments. Comments are preceded by an exclamation mark (!).
-# Comments may appear on a separate line, or after the last data value on a line. Comments are
-# terminated by a line termination sequence or character (i.e., multi-line comments are not allowed).
-# The syntax rules for comments are identical for Version 1.0 and Version 2.0 files.
 
-if options.comment:
-    output_string( comment )
+# scan one device, return the scan command, the formatted data lines and the time of the scan
+# store: append the sweep also to this sweep history file
+def measure( device, store=None ):
+    with Session( device, timeout=options.timeout, broker=broker ) as NanoVNA: # open serial connection
 
-# Rules for Version 1.0 Files:
-# For Version 1.0 files, the option line shall precede any data lines
-# and shall be the first non-comment, nonblank line in the file.
+        parameters = sweep_parameters( NanoVNA ) # before pause, an invalid sweep raises ValueError
 
-# write data as touchstone file (Rev. 1.1)
-# Frequency unit: Hz
-# Parameter: S = scattering or Z = impedance
-# Format: RI = real-imag
-# Reference impedance: 50 Ohm
+        NanoVNA.pause() # stop display
 
-frequency_unit = 'HZ'
+        with ThreadPoolExecutor( max_workers=1 ) as formatter:
+            cmd, scans, data = scan_segments( NanoVNA, formatter, *parameters )
+        timestamp = datetime.now() # time of the completed scan
 
-format = 'RI'
+        NanoVNA.resume() # resume display
 
-if z1p:
-    parameter = 'Z'
-else:
-    parameter = 'S'
+    if store:
+        store_sweep( store, scans, timestamp )
+    return cmd, data, timestamp
 
-# option header
-output_string( f'# {frequency_unit} {parameter} {format} R {Z0}' )
 
-for line in scan_result:
-    output_string( format_parameter_line( line ) )
+# write the scan result as touchstone file
+# the header and the data lines are written at once, outfile: binary file or sys.stdout
+def write_touchstone( outfile, cmd, data, timestamp=None ):
+    comment = ( timestamp or datetime.now() ).strftime( f'! NanoVNA %Y%m%d_%H%M%S\n! {cmd}' )
+    if z1p:
+        comment += '\n! 1-port normalized Z-parameter (R/Z0 + jX/Z0)'
+    elif s2p:
+        comment += '\n! 2-port S-parameter (S11.re S11.im S21.re S21.im 0 0 0 0)'
+    else:
+        comment += '\n! 1-port S-parameter (S11.re S11.im)'
+
+    # Touchstone data files may include comments. Comments are preceded by an exclamation mark (!).
+    # Comments may appear on a separate line, or after the last data value on a line. Comments are
+    # terminated by a line termination sequence or character (i.e., multi-line comments are not allowed).
+    # The syntax rules for comments are identical for Version 1.0 and Version 2.0 files.
+
+    header = comment + lf if options.comment else ''
+
+    # Rules for Version 1.0 Files:
+    # For Version 1.0 files, the option line shall precede any data lines
+    # and shall be the first non-comment, nonblank line in the file.
+
+    # write data as touchstone file (Rev. 1.1)
+    # Frequency unit: Hz
+    # Parameter: S = scattering or Z = impedance
+    # Format: RI = real-imag
+    # Reference impedance: 50 Ohm
+
+    # option header
+    header += option_line( fmt ) + lf
+
+    if outfile == sys.stdout:
+        outfile.write( header + data )
+    else:
+        outfile.write( ( header + data ).encode() )
+
+
+# scan one device and write the touchstone file
+def measure_to_file( device, filename, store=None ):
+    cmd, data, timestamp = measure( device, store )
+    if filename:
+        with open( filename, 'wb' ) as outfile:
+            write_touchstone( outfile, cmd, data, timestamp )
+    return filename or store
+
+
+# scan one device again and again with the same sweep parameters until count sweeps are done,
+# the time limit is reached or stop is set, write each sweep into a new file
+# the file name template is expanded with the time of the sweep by strftime()
+# store: append the sweeps to this sweep history file, write touchstone files only if template is set
+def measure_continuous( device, template, store=None, stop=None ):
+    done = 0
+    with Session( device, timeout=options.timeout, broker=broker ) as NanoVNA: # open serial connection, once
+
+        parameters = sweep_parameters( NanoVNA ) # query the sweep only once, before pause
+        NanoVNA.pause() # stop display
+        history = None
+
+        # format sweep k and write it in worker threads while sweep k+1 is scanned,
+        # only one sweep is written at a time, so the memory does not grow
+        with ThreadPoolExecutor( max_workers=1 ) as formatter, ThreadPoolExecutor( max_workers=1 ) as writer:
+            written = None
+            t_next = time.monotonic()
+            t_end = t_next + options.duration if options.duration else None
+            try:
+                while not ( stop and stop.is_set() ) and ( not options.count or done < options.count ):
+                    cmd, scans, data = scan_segments( NanoVNA, formatter, *parameters )
+                    timestamp = datetime.now() # time of the completed scan
+                    if written:
+                        print( written.result() )
+                    if store:
+                        if history is None: # the frequency grid is known after the 1st sweep
+                            frequencies, values = sweep_values( scans )
+                            history = open_history( store, frequencies, values.shape[ 1 ] )
+                        written = writer.submit( append_sweep, history, scans, timestamp,
+                            template and timestamp.strftime( template ), cmd, data )
+                    else:
+                        written = writer.submit( sweep_to_file, timestamp.strftime( template ), cmd, data, timestamp )
+                    done += 1
+                    t_next += options.interval
+                    if t_end and t_next >= t_end:
+                        break
+                    time.sleep( max( 0, t_next - time.monotonic() ) ) # keep the rate, do not catch up
+                    t_next = max( t_next, time.monotonic() )
+            except KeyboardInterrupt: # stop gracefully, drop a partially received sweep
+                NanoVNA.resync()
+            finally:
+                if written:
+                    print( written.result() )
+                if history:
+                    history.close()
+                NanoVNA.resume() # resume display
+    return done
+
+
+# write one sweep as touchstone file
+def sweep_to_file( filename, cmd, data, timestamp ):
+    with open( filename, 'wb' ) as outfile:
+        write_touchstone( outfile, cmd, data, timestamp )
+    return filename
+
+
+# append one sweep to the opened sweep history and write it as touchstone file if filename is set
+def append_sweep( history, scans, timestamp, filename, cmd, data ):
+    _, values = sweep_values( scans )
+    history.append( values, timestamp.timestamp() )
+    if filename:
+        sweep_to_file( filename, cmd, data, timestamp )
+    return f'{history.filename}: sweep {len( history ) - 1}'
+
+
+# file name template for the continuous mode, the time of each sweep is added
+def continuous_template():
+    if options.out and '%' in options.out: # user provided strftime() template
+        return options.out
+    stem, ext = os.path.splitext( options.out or 'NanoVNA' )
+    return f'{stem}_%Y%m%d_%H%M%S_%f{ext or ( ".s2p" if s2p else ".s1p" )}'
+
+
+if options.continuous:
+    # with a sweep history touchstone files are written only on request
+    template = None if options.store and not options.out else continuous_template()
+    if options.all: # all devices concurrently, one file series per device
+        devices = getdevices()
+        if not devices:
+            raise OSError( 'device not found' )
+        stop = threading.Event()
+        with ThreadPoolExecutor( max_workers=len( devices ) ) as executor:
+            scans = [ executor.submit( measure_continuous, device.device,
+                template and device_filename( template, device ),
+                options.store and device_filename( options.store, device ), stop )
+                for device in devices ]
+            try:
+                wait( scans, return_when=FIRST_EXCEPTION ) # one device failed, stop the others as well
+            except KeyboardInterrupt:
+                pass
+            stop.set()
+            for device, scan in zip( devices, scans ):
+                try:
+                    scan.result()
+                except ( OSError, ValueError ) as error:
+                    print( f'{device.device} ({device_id( device )}): {error}' )
+    else:
+        try:
+            measure_continuous( options.device, template, options.store )
+        except ValueError as error:
+            ap.error( str( error ) )
+elif options.all: # scan all devices concurrently, one file per device
+    devices = getdevices()
+    if not devices:
+        raise OSError( 'device not found' )
+    if options.store and not options.out:
+        filename = None
+    else:
+        filename = options.out or datetime.now().strftime( f'NanoVNA_%Y%m%d_%H%M%S.{"s2p" if s2p else "s1p"}' )
+    with ThreadPoolExecutor( max_workers=len( devices ) ) as executor:
+        scans = [ executor.submit( measure_to_file, device.device, filename and device_filename( filename, device ),
+            options.store and device_filename( options.store, device ) )
+            for device in devices ]
+        for device, scan in zip( devices, scans ):
+            try:
+                print( f'{device.device} ({device_id( device )}): {scan.result()}' )
+            except ( OSError, ValueError ) as error:
+                print( f'{device.device} ({device_id( device )}): {error}' )
+else:
+    try:
+        cmd, data, timestamp = measure( options.device, options.store )
+    except ValueError as error:
+        ap.error( str( error ) )
+    if options.out:
+        with open( options.out, 'wb' ) as outfile:
+            write_touchstone( outfile, cmd, data, timestamp )
+    elif not options.store:
+        write_touchstone( sys.stdout, cmd, data, timestamp )
@@ -8,46 +8,25 @@ Command line tool to read the RTC of NanoVNA-H or NanoVNA-H4 and sync it with th
 
 import argparse
 from datetime import datetime
-import serial
-from serial.tools import list_ports
 import sys
 import platform
 from pathlib import Path
 
-
-# ChibiOS/RT Virtual COM Port
-VID = 0x0483 #1155
-PID = 0x5740 #22336
-
-# Get nanovna device automatically
-def getdevice() -> str:
-    device_list = list_ports.comports()
-    for device in device_list:
-        if device.vid == VID and device.pid == PID:
-            return device
-    raise OSError( 'device not found' )
+from nanotiny import Session
+from nanotiny.broker import add_broker_arguments, broker_socket
 
 
 # construct the argument parser and parse the arguments
 ap = argparse.ArgumentParser( description='Show and sync the RTC time of NanoVNA-H or NanoVNA-H4' )
 ap.add_argument( '-d', '--device', dest = 'device',
     help = 'connect to device' )
+add_broker_arguments( ap )
 ap.add_argument( '-s', '--sync', action = 'store_true',
     help = 'sync the NanoVNA time to the system time' )
 ap.add_argument( '-p', '--ppm', action = 'store_true',
     help = 'calculate RTC ppm deviation since last sync' )
 options = ap.parse_args()
-
-if options.device:
-    device = None
-    nano_tiny_device = options.device
-else:
-    device = getdevice()
-    nano_tiny_device = device.device
-
-cr = b'\r'
-crlf = b'\r\n'
-prompt = b'ch> '
+broker = broker_socket( options )
 
 
 def get_config_name( progname, filename ):
@@ -82,36 +61,26 @@ def get_system_time():
 
 
 def show_device_time( nano_tiny ):
-    time_cmd = 'time'.encode()
-    nano_tiny.write( time_cmd + cr )  # get date and time
-    echo = nano_tiny.read_until( time_cmd + crlf ) # wait for start of cmd
-    nano_time = nano_tiny.read_until( crlf ) # get 1st part of answer
-    echo = nano_tiny.read_until( crlf ) # skip 2nd part (usage)
-    echo = nano_tiny.read_until( prompt ) # wait for cmd completion
-    if echo != prompt: # error
-        print( 'timesync error - does the device support the "time" cmd?' )
+    try:
+        nano_time = nano_tiny.time() # get date and time
+    except OSError as error:
+        print( error )
         sys.exit()
-    nano_time = nano_time.decode().strip().replace( "/", "-") # convert to string
-    print( f'Device time: {nano_time}' )
-    return datetime.strptime( nano_time , '%Y-%m-%d %H:%M:%S' ) # datetime object
+    print( f'Device time: {nano_time.strftime( "%Y-%m-%d %H:%M:%S" )}' )
+    return nano_time # datetime object
 
 
 def sync_device_time( nano_tiny, now ):
-    time_b_cmd = now.strftime( 'time b 0x%y%m%d 0x%H%M%S' ).encode()
-    nano_tiny.write( time_b_cmd + cr )  # set date and time
-    echo = nano_tiny.read_until( time_b_cmd + crlf ) # wait for start of cmd
-    echo = nano_tiny.read_until( prompt ) # wait for cmd completion
-
-    if echo != prompt: # error
-        print( 'timesync error - does the device support the "time b ..." cmd?' )
+    try:
+        nano_tiny.set_time( now ) # set date and time
+    except OSError as error:
+        print( error )
         sys.exit()
     return True
 
 
 # do the communication
-with serial.Serial( nano_tiny_device, timeout=1 ) as nano_tiny: # open serial connection
-    nano_tiny.write( cr )
-    echo = nano_tiny.read_until( prompt ) # remove spurious bytes
+with Session( options.device, broker=broker ) as nano_tiny: # open serial connection, remove spurious bytes
     if options.sync or options.ppm:
         lsync_name = get_config_name( 'nanovna_time', 'lastsync' )
     now = get_system_time()
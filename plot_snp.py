@@ -3,55 +3,66 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 import argparse
+from datetime import datetime
+import os
 import sys
 
+import numpy as np
+
 import skrf as rf
 
 import matplotlib.pyplot as plt
 from matplotlib.gridspec import GridSpec
 
+from nanotiny.batch import find_files, map_files
+from nanotiny.history import SweepHistory
+from nanotiny.touchstone import load_network
 
 
-def plot_s1p( nw ):
-    fig = plt.figure( figsize=( 5, 5 ), constrained_layout=True )
-
-    # ____0__________1____
-    # 0        |  S21dB  |
-    # | smith  |_________|
-    # 1        |  S21ph  |
-    # |________|_________|
-    #
-    #grid = GridSpec( 2, 2, figure=fig )
-    #smith = fig.add_subplot( grid[ :, 0 ] ) # row 0-1, col 0
-    #S21dB = fig.add_subplot( grid[ 0, 1 ] ) # row 0, col 1
-    #S21ph = fig.add_subplot( grid[ 1, 1 ] ) # row 1, col 1
+figures = {} # batch mode: the figure of each layout, created once per (worker) process and reused for all files
+batch_options = None # batch mode: ( outdir, format, dpi ) of this (worker) process
 
-    nw.plot_s_smith(m=0,n=0,
-                    r=1,
-                    chart_type='z',
-                    #ax=smith,
-                    show_legend=True,
-                    draw_labels=True,
-                    # draw_vswr=True,
-    )
 
-    plt.show()
 
+# figure with the axes ( smith, S21dB, S21ph ) for a network with nports, S21 axes are None for 1 port
+# smith: draw the smith chart background once, e.g. for a figure that is reused for many networks
+def create_figure( nports, smith=False ):
+    if nports == 1:
+        fig = plt.figure( figsize=( 5, 5 ), constrained_layout=True )
 
+        # ____0__________1____
+        # 0        |  S21dB  |
+        # | smith  |_________|
+        # 1        |  S21ph  |
+        # |________|_________|
+        #
+        #grid = GridSpec( 2, 2, figure=fig )
+        #smith = fig.add_subplot( grid[ :, 0 ] ) # row 0-1, col 0
+        #S21dB = fig.add_subplot( grid[ 0, 1 ] ) # row 0, col 1
+        #S21ph = fig.add_subplot( grid[ 1, 1 ] ) # row 1, col 1
+        axes = ( fig.add_subplot(), None, None )
+    else:
+        fig = plt.figure( figsize=( 10,5 ), constrained_layout=True )
+
+        # ____0__________1____
+        # 0        |  S21dB  |
+        # | smith  |_________|
+        # 1        |  S21ph  |
+        # |________|_________|
+        #
+        grid = GridSpec( 2, 2, figure=fig )
+        axes = ( fig.add_subplot( grid[ :, 0 ] ), # row 0-1, col 0
+                 fig.add_subplot( grid[ 0, 1 ] ), # row 0, col 1
+                 fig.add_subplot( grid[ 1, 1 ] ) ) # row 1, col 1
+    if smith: # plot_s_smith() draws the background only into an empty chart
+        rf.plotting.smith( ax=axes[ 0 ], smithR=1, chart_type='z', draw_labels=True )
+    return fig, axes
 
-def plot_s2p( nw ):
-    fig = plt.figure( figsize=( 10,5 ), constrained_layout=True )
-
-    # ____0__________1____
-    # 0        |  S21dB  |
-    # | smith  |_________|
-    # 1        |  S21ph  |
-    # |________|_________|
-    #
-    grid = GridSpec( 2, 2, figure=fig )
-    smith = fig.add_subplot( grid[ :, 0 ] ) # row 0-1, col 0
-    S21dB = fig.add_subplot( grid[ 0, 1 ] ) # row 0, col 1
-    S21ph = fig.add_subplot( grid[ 1, 1 ] ) # row 1, col 1
+
+
+# plot S11 into the smith chart and S21 (if the network has 2 ports) as dB and phase
+def plot_network( nw, axes ):
+    smith, S21dB, S21ph = axes
 
     nw.plot_s_smith(m=0,n=0,
                     r=1,
@@ -62,6 +73,9 @@ def plot_s2p( nw ):
                     # draw_vswr=True,
     )
 
+    if S21dB is None:
+        return
+
     nw.plot_s_db(m=1,n=0,
                  ax=S21dB,
                  title='S21 Magnitude'
@@ -72,24 +86,181 @@ def plot_s2p( nw ):
                  title='S21 Phase'
     )
 
+
+
+def plot_s1p( nw ):
+    fig, axes = create_figure( 1 )
+    plot_network( nw, axes )
+    plt.show()
+
+
+
+def plot_s2p( nw ):
+    fig, axes = create_figure( 2 )
+    plot_network( nw, axes )
+    plt.show()
+
+
+
+# touchstone file as skrf.Network, read by the numpy reader of nanotiny (faster than skrf)
+def read_network( snp ):
+    nw = load_network( snp )
+    if isinstance( nw, rf.Network ): # read by skrf, e.g. touchstone 2.0
+        return nw
+    return rf.Network( frequency=rf.Frequency.from_f( nw.f, unit='hz' ), s=nw.s, z0=nw.z0, name=nw.name )
+
+
+
+# batch mode: render headless into files, the figures are created once per (worker) process
+def init_worker( outdir, image_format, dpi, xkcd ):
+    global batch_options
+    plt.switch_backend( 'Agg' )
+    if xkcd:
+        plt.xkcd() # :)
+    batch_options = outdir, image_format, dpi
+
+
+
+# batch mode: plot one touchstone file into the reused figure of its layout and save it
+# return the image file name or ( None, error message ), runs in the worker processes
+def render_file( snp ):
+    outdir, image_format, dpi = batch_options
+    try:
+        nw = read_network( snp )
+    except ( OSError, ValueError ) as error:
+        return None, str( error )
+    nports = 1 if nw.nports == 1 else 2
+    if nports not in figures:
+        fig, axes = create_figure( nports, smith=True )
+        # the artists of the empty figure (smith chart background) are kept, the others removed after each plot
+        background = { ax: ( set( ax.get_children() ), ax.get_position( original=True ), ax.get_xlim(), ax.get_ylim() )
+                       for ax in axes if ax is not None }
+        figures[ nports ] = fig, axes, background
+    fig, axes, background = figures[ nports ]
+    name = os.path.splitext( os.path.basename( snp ) )[ 0 ] + '.' + image_format
+    outfile = os.path.join( outdir if outdir is not None else os.path.dirname( snp ), name )
+    try:
+        plot_network( nw, axes )
+        fig.savefig( outfile, format=image_format, dpi=dpi )
+    except ( OSError, ValueError ) as error:
+        return None, f'{snp}: {error}'
+    finally:
+        # reset the axes to the new figure, the plot must not depend on the previous files
+        for ax, ( artists, position, xlim, ylim ) in background.items():
+            for artist in ax.get_children():
+                if artist not in artists:
+                    artist.remove()
+            ax.legend_ = None
+            ax._set_position( position ) # the layout starts from the new figure
+            ax.relim()
+            ax.set_xlim( xlim )
+            ax.set_ylim( ylim )
+            ax.set_autoscale_on( True ) # limits of the next network, not of the previous
+            ax.set_prop_cycle( None ) # same line colors as in a new figure
+    return outfile, None
+
+
+
+# plot magnitude and phase of one frequency point across all sweeps of a sweep history
+def plot_column( history, frequency ):
+    index = history.frequency_index( frequency )
+    times = [ datetime.fromtimestamp( t ) for t in history.times() ]
+    values = history.column( index ) # read only this column from the memory map
+
+    fig, ( mag, phase ) = plt.subplots( 2, 1, figsize=( 10, 5 ), sharex=True, constrained_layout=True )
+    names = ( 'S11', 'S21' )
+    for parameter in range( history.parameters ):
+        mag.plot( times, 20 * np.log10( np.abs( values[ :, parameter ] ) ), label=names[ parameter ] )
+        phase.plot( times, np.angle( values[ :, parameter ], deg=True ), label=names[ parameter ] )
+    mag.set_title( f'Magnitude at {history.frequencies[ index ]:.0f} Hz' )
+    mag.set_ylabel( 'dB' )
+    mag.legend()
+    phase.set_title( f'Phase at {history.frequencies[ index ]:.0f} Hz' )
+    phase.set_ylabel( 'deg' )
+
     plt.show()
 
 
 
+# one sweep of a sweep history as network
+def history_network( history, n ):
+    values = history.sweep( n )
+    s = np.zeros( ( history.points, history.parameters, history.parameters ), dtype=complex )
+    s[ :, 0, 0 ] = values[ :, 0 ] # S11
+    if history.parameters == 2:
+        s[ :, 1, 0 ] = values[ :, 1 ] # S21
+    name = datetime.fromtimestamp( history[ n ][ 'time' ] ).strftime( 'NanoVNA_%Y%m%d_%H%M%S' )
+    return rf.Network( frequency=rf.Frequency.from_f( history.frequencies, unit='hz' ), s=s, name=name )
+
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser( description='Plot S11 as smith chart and S22 as dB/phase' )
     parser.add_argument( '-x', '--xkcd', action='store_true',
                         help='draw the plot in xkcd style :)' );
-    parser.add_argument( 'infile', type=argparse.FileType('r', encoding='UTF-8'), 
-                        help='infile in touchstone format' )
+    parser.add_argument( '-H', '--history', action='store_true',
+                        help='infile is a sweep history file, plot one sweep or one frequency' );
+    parser.add_argument( '-n', '--sweep', type=int, default=-1,
+                        help='plot sweep SWEEP of the history, default = last sweep' );
+    parser.add_argument( '-f', '--frequency', type=float,
+                        help='plot the history of the values at FREQUENCY across all sweeps' );
+    parser.add_argument( '-o', '--outdir',
+                        help='batch mode: write the plots into OUTDIR, default = directory of each infile' );
+    parser.add_argument( '-t', '--format', choices=( 'png', 'svg' ),
+                        help='batch mode: image format of the plots, default = png' );
+    parser.add_argument( '--dpi', type=float, default=100,
+                        help='batch mode: resolution of png plots, default = 100' );
+    parser.add_argument( '-j', '--jobs', type=int, default=os.cpu_count(),
+                        help=f'batch mode: render in JOBS processes, default = {os.cpu_count()} (number of CPUs)' );
+    parser.add_argument( 'infile', nargs='+',
+                        help='infile in touchstone format, more files, glob patterns or directories render all headless into image files' )
     args = parser.parse_args()
 
-    if args.xkcd:
-        plt.xkcd() # :)
+    infiles = find_files( args.infile )
+    batch = len( infiles ) > 1 or args.outdir is not None or args.format is not None
+
+    if args.history and batch:
+        parser.error( 'the sweep history plot needs exactly one infile' )
+
+    if not batch: # one file, show the plot
+        if not infiles or not os.path.isfile( infiles[ 0 ] ):
+            parser.error( f'no file {args.infile[ 0 ]}' )
+        if args.xkcd:
+            plt.xkcd() # :)
+
+        if args.history:
+            with SweepHistory( infiles[ 0 ] ) as history:
+                if not len( history ):
+                    print( f'{history.filename}: no sweeps recorded' )
+                    sys.exit( 1 )
+                if args.frequency is not None:
+                    plot_column( history, args.frequency )
+                    sys.exit()
+                try:
+                    nw = history_network( history, args.sweep )
+                except IndexError as error:
+                    print( error )
+                    sys.exit( 1 )
+        else:
+            nw = rf.Network( infiles[ 0 ] )
 
-    nw = rf.Network( args.infile.name )
+        if nw.nports == 1:
+            plot_s1p( nw )
+        elif nw.nports == 2:
+            plot_s2p( nw )
+        sys.exit()
 
-    if nw.nports == 1:
-        plot_s1p( nw )
-    elif nw.nports == 2:
-        plot_s2p( nw )
+    if args.outdir is not None:
+        os.makedirs( args.outdir, exist_ok=True )
+    initargs = ( args.outdir, args.format or 'png', args.dpi, args.xkcd )
+    init_worker( *initargs )
+    errors = 0
+    # the files of one chunk are rendered by the same worker into its figures
+    rendered = map_files( render_file, infiles, args.jobs, init_worker, initargs, max_chunk=16 )
+    for outfile, error in rendered:
+        if outfile is None:
+            errors += 1
+            print( error, file=sys.stderr )
+        else:
+            print( outfile )
+    sys.exit( 1 if errors else 0 )